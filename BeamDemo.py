@@ -16,33 +16,85 @@
 #   See                 https://www1.qt.io/qt-licensing-terms/
 #                       https://www.qt.io/download
 #-------------------------------------------------------------------------------
+import time
+_startTime = time.perf_counter() #for the time to first frame
+
+import os
 import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from beamdef import BeamDefinition, NE, NW, SE, SW
-from fake_spiwrite import AwmfCommander, SpiInitException, SB_MODE, TX_MODE, RX_MODE
+from beamdef import BeamDefinition, NE, NW, SE, SW, loadPhaseCal
+from patterncache import PatternCache, patternKey, calIdentity
+from patternproc import PatternProcess, PatternView
+from qcutplot import QCutPlot
+from awmflog import getLogger
+import stagetime
 
 from PyQt5 import QtGui, QtCore, QtWidgets
 from PyQt5.QtWidgets import QDialog, QApplication
 from maingui import Ui_Dialog
 
+log = getLogger("demo")
 
 
 class MyApp(QDialog, Ui_Dialog):
+    #emitted from the beam queue's I/O thread, delivered on the GUI thread
+    beamProgrammed = QtCore.pyqtSignal(object)
+    #emitted from the adapter watcher thread when the interposer comes or goes
+    spiStateChanged = QtCore.pyqtSignal(bool)
+    #emitted from the background thread once the phase cal has loaded
+    phaseCalLoaded = QtCore.pyqtSignal()
+
     def __init__(self):
         super(MyApp, self).__init__()
         self.setupUi(self)
+        #principal plane cuts through the beam, next to the 3D view
+        self.cutPlot = QCutPlot(self.horizontalLayoutWidget)
+        self.cutPlot.setFixedSize(300, 300)
+        self.horizontalLayout.insertWidget(1, self.cutPlot)
+        extra = self.cutPlot.width() + self.horizontalLayout.spacing()
+        self.horizontalLayoutWidget.resize(self.horizontalLayoutWidget.width() + extra,
+                                           self.horizontalLayoutWidget.height())
+        self.resize(self.width() + extra, self.height())
         self.setFixedSize(self.size())
 
         self.beamDef = None
         self.phaseSettings = None
 
+        #the cal is loaded on a background thread; Lock waits for it (onPhaseCalLoaded)
+        self.background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="BeamDemoBg")
+        self.phaseCalFile = "phaseCal.yaml"
+        self.phaseCalId = calIdentity(self.phaseCalFile) #part of quantized pattern keys
+        self.phaseCal = None
+        self.phaseCalReady = False
+        self.beamDefButton.setEnabled(False)
+        #queued: even a cal that's already loaded is picked up from the event loop, after __init__
+        self.phaseCalLoaded.connect(self.onPhaseCalLoaded, QtCore.Qt.QueuedConnection)
+        self.phaseCalFuture = self.background.submit(loadPhaseCal, self.phaseCalFile)
+        self.phaseCalFuture.add_done_callback(lambda future: self.phaseCalLoaded.emit())
+        #patterns are worked out in another process and read from shared memory
+        self.patternProcess = PatternProcess()
+        self.patternRequest = 0
+        self.patternKeys = {} #request number -> patternKey, until it is drawn
+        #AWMF_QUANTIZED_PATTERN=1 draws what the registers produce, not the ideal beam
+        self.quantizedPattern = os.environ.get("AWMF_QUANTIZED_PATTERN", "") not in ("", "0")
+        self.glViewer.attachPatternBuffer(self.patternProcess.buffer,
+                                          accept=lambda request: request == self.patternRequest)
+        self.glViewer.sharedPatternShown.connect(self.onSharedPattern)
+        #patterns from last time, so the first frame needn't wait for one
+        self.patternCache = PatternCache("pattern_cache.bin")
+        self.patternCache.load()
+
+        #SPI is set up once the window is showing (see deferredInit)
+        self.awmf = None
+        self.beamQueue = None
+        self.adapterWatcher = None
+        self.beamProgrammed.connect(self.onBeamProgrammed)
         self.spiConnected = False
-        self.tryConnectSPI()
-
-        #Repeatedly check for spi interposer board
-        self.timer = QtCore.QTimer()
-        self.timer.timeout.connect(self.tryConnectSPI)
-        self.timer.start(1000)
+        self.spiStatusLabel.setText("SPI interposer not detected")
+        self.spiStateChanged.connect(self.onSpiStateChanged)
+        self.glViewer.firstFrame.connect(self.onFirstFrame)
 
         #Connect inputs
         self.thetaBox.valueChanged.connect(self.sketchAfPattern)
@@ -53,29 +105,56 @@ class MyApp(QDialog, Ui_Dialog):
         self.radio2x2Button.toggled.connect(self.setAntennaType)
         self.radio4x1Button.toggled.connect(self.setAntennaType) 
 
-        #initial antenna settings
+        #initial antenna settings -- also sketches the initial view
         self.aGrid = [[NE, NW, SE, SW]]
         self.aInvertPattern = [[True, False, True, False]]
         self.aSpacing = 5.4 * pow(10,-3)
         self.setAntennaType()
 
-        #initial view
-        self.sketchAfPattern()
+        #AWMF_STAGE_TIMING=1 shows the per stage timings over the view
+        self.glViewer.setStageOverlay(stagetime.isEnabled())
 
-    def tryConnectSPI(self):
-        if self.spiConnected:
-            return
+        QtCore.QTimer.singleShot(0, self.deferredInit)
+
+    def deferredInit(self):
+        """Runs from the event loop once the window is up: SPI side of the demo"""
+        from fake_spiwrite import AwmfCommander
+        from beamqueue import BeamQueue
+        from adapterwatch import AdapterWatcher
+
+        #SPI writes happen off the GUI thread
+        self.awmf = AwmfCommander()
+        self.awmf.enableTransactionLog(dumpPath="awmf_tx.bin")
+        self.beamQueue = BeamQueue(self.awmf)
+
+        #Look for the spi interposer board in the background
+        self.adapterWatcher = AdapterWatcher(onChange=self.spiStateChanged.emit, commander=self.awmf)
+        self.adapterWatcher.start()
+
+    def onPhaseCalLoaded(self):
+        """Runs on the GUI thread once the background cal load has finished"""
         try:
-            AwmfCommander.initSpi() 
-            self.spiConnected = True
+            self.phaseCal = self.phaseCalFuture.result() #done: doesn't block
+        except Exception:
+            log.exception("couldn't load %s, beams are uncalibrated", self.phaseCalFile)
+            self.phaseCal = None
+        self.phaseCalReady = True
+        self.beamDefButton.setEnabled(True)
+        if self.quantizedPattern:
+            self.sketchAfPattern() #now with the cal, and cacheable
+
+    def onFirstFrame(self):
+        log.info("first frame %.0f ms after start", 1e3 * (time.perf_counter() - _startTime))
+
+    def onSpiStateChanged(self, connected):
+        """Runs on the GUI thread when the adapter watcher finds or loses the interposer"""
+        self.spiConnected = connected
+        if connected:
             self.spiStatusLabel.setText("") #remove "not detected" label
-        except SpiInitException:
+        else:
             self.spiStatusLabel.setText("SPI interposer not detected")
-            self.spiConnected = False
             self.programButton.setEnabled(False)
 
-        return self.spiConnected
-
     def calculateWavelength(self):
         """Calculate wavelength from given f and speed of light"""
         frequency = (self.waveLengthBox.value()) * pow(10,9)
@@ -100,7 +179,8 @@ class MyApp(QDialog, Ui_Dialog):
         """prints the new beam settings based off the input frequency, theta, and
         phi and updates the drawing's current settings vector"""
         
-        self.beamDef = BeamDefinition(self.thetaO(), self.phiO(), self.calculateWavelength(), beamStrength=self.getBeamAmp())
+        self.beamDef = BeamDefinition(self.thetaO(), self.phiO(), self.calculateWavelength(), phaseCalFile=None, beamStrength=self.getBeamAmp())
+        self.beamDef.setPhaseCal(self.phaseCal) #loaded in the background at startup
         self.beamDef.setAntenna(self.aGrid, self.aInvertPattern, self.aSpacing)
         self.phaseSettings = self.beamDef.getPhaseSettings()
         self.glViewer.setCurrentSettingVector(self.thetaO(), self.phiO())
@@ -125,27 +205,90 @@ class MyApp(QDialog, Ui_Dialog):
             self.programButton.setEnabled(True)
 
     def sketchAfPattern(self):
-        """Temporarily calculates beam pattern and updates visuals"""
+        """Temporarily calculates beam pattern and updates visuals.
+        Cached patterns are drawn straight away, others are worked out by the
+        pattern process and picked up by the viewer"""
         if self.phiBox.value() < 0 or self.phiBox.value() >= 360: #regulate input
             self.phiBox.setValue(self.phiBox.value() % 360)
 
-        temp_bd = BeamDefinition(self.thetaO(), self.phiO(), self.calculateWavelength(), beamStrength=self.getBeamAmp())
-        temp_bd.setAntenna(self.aGrid, self.aInvertPattern, self.aSpacing)
-        self.glViewer.setAFPoints(temp_bd.generateAllAF())
+        self.sketchCuts()
+        self.patternRequest += 1
+        phaseCal = None
+        if self.quantizedPattern and self.phaseCalReady:
+            phaseCal = self.phaseCal
+        #a quantized pattern worked out before the cal has loaded is drawn but not cached
+        if not self.quantizedPattern or self.phaseCalReady:
+            key = patternKey(self.thetaO(), self.phiO(), self.calculateWavelength(),
+                             self.aGrid, self.aInvertPattern, self.aSpacing,
+                             quantized=self.quantizedPattern, calId=self.phaseCalId)
+            points = self.patternCache.get(key)
+            if points is not None:
+                self.glViewer.setAFPoints(points)
+                return
+            self.patternKeys[self.patternRequest] = key
+        self.patternProcess.request(self.patternRequest, self.thetaO(), self.phiO(), self.calculateWavelength(),
+                                    self.aGrid, self.aInvertPattern, self.aSpacing,
+                                    quantized=self.quantizedPattern, phaseCal=phaseCal)
+
+    def sketchCuts(self):
+        """The phi cut through the beam and the great circle across it, 0.1
+        degree apart. Only 1-D slices, so cheap enough to work out here"""
+        b = BeamDefinition(self.thetaO(), self.phiO(), self.calculateWavelength(), phaseCalFile=None)
+        b.setAntenna(self.aGrid, self.aInvertPattern, self.aSpacing)
+        if self.quantizedPattern and self.phaseCalReady:
+            b.setPhaseCal(self.phaseCal)
+        self.cutPlot.clearCuts()
+        self.cutPlot.setCut("phi = {0:g}".format(self.phiO()),
+                            b.phiCut(self.phiO(), quantized=self.quantizedPattern))
+        self.cutPlot.setCut("across beam", b.greatCircleCut(self.thetaO(), self.phiO(), heading=90,
+                                                            quantized=self.quantizedPattern))
+
+    def onSharedPattern(self, request):
+        """The viewer drew a pattern from the process: keep a copy for the cache"""
+        key = self.patternKeys.pop(request, None)
+        for old in [r for r in self.patternKeys if r < request]:
+            del self.patternKeys[old] #never drawn, superseded
+        if key is None:
+            return
+        view = self.glViewer.afPoints
+        points = list(view)
+        #the process may have reused the slot while we copied: drop a torn copy
+        if isinstance(view, PatternView) and not view.valid():
+            return
+        self.patternCache.put(key, points)
 
     def progSpi(self):
+        from fake_spiwrite import TX_MODE, RX_MODE
         mode = RX_MODE
         if self.radioButtonTx.isChecked():
             mode = TX_MODE
 
         #convert to awmf amplification settings here -> subtract by 31
-        try:
-            AwmfCommander.setBeam(mode, self.phaseSettings[0], self.phaseSettings[1], self.phaseSettings[2], self.phaseSettings[3],
-                31 - self.getBeamAmp(), 31 - self.getBeamAmp(), 31 - self.getBeamAmp(), 31 - self.getBeamAmp())
-        except SpiInitException:
-            self.spiStatusLabel.setText("SPI interposer not detected")
-            self.spiConnected = False
-            self.programButton.setEnabled(False)
+        self.beamQueue.submit(mode, self.phaseSettings[0], self.phaseSettings[1], self.phaseSettings[2], self.phaseSettings[3],
+            31 - self.getBeamAmp(), 31 - self.getBeamAmp(), 31 - self.getBeamAmp(), 31 - self.getBeamAmp(),
+            callback=self.beamProgrammed.emit)
+
+    def onBeamProgrammed(self, future):
+        """Runs on the GUI thread once the beam queue has written (or failed to write) a beam"""
+        from fake_spiwrite import SpiInitException
+        if future.cancelled():
+            return
+        if isinstance(future.exception(), SpiInitException):
+            self.onSpiStateChanged(False)
+            self.adapterWatcher.markDisconnected()
+
+    def closeEvent(self, event):
+        if stagetime.isEnabled():
+            stagetime.dumpJSON("stage_timing.json")
+        self.patternCache.save()
+        self.background.shutdown(wait=False)
+        self.glViewer.detachPatternBuffer()
+        self.patternProcess.stop()
+        if self.adapterWatcher is not None:
+            self.adapterWatcher.stop(wait=False)
+        if self.beamQueue is not None:
+            self.beamQueue.stop(wait=False)
+        super(MyApp, self).closeEvent(event)
 
     def setAntennaType(self):
         """Looks at whether 2x2 or 4x1 is selected and updates subcomponents to behave"""
@@ -167,6 +310,7 @@ class MyApp(QDialog, Ui_Dialog):
         self.sketchAfPattern()
 
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
     app = QApplication(sys.argv)
     window = MyApp()
     window.show()
@@ -0,0 +1,121 @@
+#-------------------------------------------------------------------------------
+# Name:        adapterwatch
+# Purpose:     Look for the SPI interposer in the background and report when
+#              it comes or goes
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+import threading
+
+from fake_spiwrite import SpiInitException
+
+def connectAwmf(awmf):
+  """default probe: True if the AwmfCommander awmf could open its adapter"""
+  try:
+    awmf.initSpi()
+  except SpiInitException:
+    return False
+  return True
+
+class AdapterWatcher:
+  """
+  Retries the connect probe on its own thread with exponential backoff
+  (minInterval, 2*minInterval, ... maxInterval) while no adapter is found.
+  Once connected it sleeps until markDisconnected() is called.
+
+  onChange(connected) is called from the watcher thread, only when the
+  state actually flips.
+
+  w = AdapterWatcher(onChange=lambda up: print(up), commander=AwmfCommander())
+  w.start()
+  """
+
+  def __init__(self, onChange, commander=None, connect=None, minInterval=0.5, maxInterval=16.0):
+    """
+    commander   AwmfCommander to open with connectAwmf
+    connect     probe to use instead, returns True once connected
+    """
+    self.onChange = onChange
+    if connect is None:
+      connect = lambda: connectAwmf(commander)
+    self.connect = connect
+    self.minInterval = minInterval
+    self.maxInterval = maxInterval
+
+    self.connected = False
+    self._wake = threading.Event()
+    self._stop = False
+    self._thread = None
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._thread = threading.Thread(target=self._run, name="AdapterWatcher", daemon=True)
+    self._thread.start()
+
+  def stop(self, wait=True):
+    self._stop = True
+    self._wake.set()
+    if wait and self._thread is not None:
+      self._thread.join()
+
+  def markDisconnected(self):
+    """The adapter stopped answering -- start looking again right away"""
+    self.connected = False
+    self._wake.set()
+
+  def retryNow(self):
+    """Skip the rest of the current backoff interval"""
+    self._wake.set()
+
+  def _run(self):
+    interval = self.minInterval
+    reported = None
+    while not self._stop:
+      if not self.connected:
+        self.connected = bool(self.connect())
+        if self.connected:
+          interval = self.minInterval
+
+      if self.connected != reported:
+        reported = self.connected
+        self.onChange(self.connected)
+
+      if self.connected:
+        #nothing to do until somebody says the adapter went away
+        self._wake.wait()
+        self._wake.clear() #before looking: a later markDisconnected sets it again
+        interval = self.minInterval
+        if not self.connected and not self._stop:
+          reported = False
+          self.onChange(False)
+      else:
+        self._wake.wait(interval)
+        self._wake.clear()
+        interval = min(2 * interval, self.maxInterval)
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  import time
+  attempts = []
+
+  def flakyConnect():
+    attempts.append(time.perf_counter())
+    return len(attempts) > 4 #plugged in on the fifth look
+
+  w = AdapterWatcher(onChange=lambda up: print("connected" if up else "not detected"),
+                     connect=flakyConnect, minInterval=0.01)
+  w.start()
+  time.sleep(0.5)
+  w.markDisconnected()
+  time.sleep(0.05)
+  w.stop()
+  gaps = [round(1e3 * (b - a)) for a, b in zip(attempts, attempts[1:])]
+  print("attempts: {0}, gaps (ms): {1}".format(len(attempts), gaps))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,211 @@
+#-------------------------------------------------------------------------------
+# Name:        awmfemu
+# Purpose:     Register level emulation of the awmf-0108 for the ni845x
+#              simulator. Decodes the packed stream AwmfCommander writes.
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# Bus model
+#
+#   CS0 low     select: the shift register is loaded from the latched
+#               registers, so whatever is clocked out is the current state
+#   SCLK        bits enter at the LSB, the MSB falls out on MISO
+#   CS1 (LDB)   low -> high copies the shift register into the registers
+#   DIO         bit 0 = TX_EN, bit 1 = RX_EN
+#
+# The payload is FRAME_WORDS 12-bit words. AwmfCommander packs word k into
+# bits 12k..12k+11 of one big integer and sends it MSB first, so after a full
+# frame word k sits in the same bits of the shift register.
+#-------------------------------------------------------------------------------
+
+import time
+
+from beamdef import NE, SE, SW, NW
+from fake_spiwrite import AwmfCommander, SB_MODE, TX_MODE, RX_MODE, RX_11_MODE, FRAME_WORDS
+
+WORD_WIDTH = 12
+
+#payload words holding (phase, amp) of each channel
+QUADRANT_ORDER = [NE, SE, SW, NW]
+RX_WORDS = dict((q, (4*i, 4*i + 1)) for i, q in enumerate(QUADRANT_ORDER))
+TX_WORDS = dict((q, (4*i + 2, 4*i + 3)) for i, q in enumerate(QUADRANT_ORDER))
+
+class Awmf0108Emulator:
+  """
+  One emulated awmf-0108. Plug it into the simulator with
+
+  lib = Ni845xSim()
+  chip = Awmf0108Emulator()
+  lib.attach(chip)
+  """
+
+  def __init__(self, nWords=FRAME_WORDS, wordWidth=WORD_WIDTH):
+    self.nWords = nWords
+    self.wordWidth = wordWidth
+    self.nBits = nWords * wordWidth
+    self._mask = (1 << self.nBits) - 1
+    self.reset()
+
+  def reset(self):
+    """power on state: everything 0, nothing selected"""
+    self.shiftReg = 0
+    self.latched = 0
+    self.selected = False
+    self.ldbLow = False
+    self.dio = 0
+    self.latchCount = 0
+    self.bitsClocked = 0
+    self.lastLatchTime = None
+
+  # ----------------------------------------------------------------------------
+  # bus side (called by ni845xsim)
+  # ----------------------------------------------------------------------------
+  def csLow(self, line):
+    if line == 0:
+      self.selected = True
+      self.shiftReg = self.latched
+    elif line == 1:
+      self.ldbLow = True
+
+  def csHigh(self, line):
+    if line == 0:
+      self.selected = False
+    elif line == 1 and self.ldbLow:
+      self.ldbLow = False
+      self.latch()
+
+  def transfer(self, value, nBits):
+    """clock nBits of value in (MSB first), return what fell out"""
+    if not self.selected:
+      return 0 #MISO is tristated
+    self.bitsClocked += nBits
+    combined = (self.shiftReg << nBits) | (value & ((1 << nBits) - 1))
+    self.shiftReg = combined & self._mask
+    return (combined >> self.nBits) & ((1 << nBits) - 1)
+
+  def dioWrite(self, portValue):
+    self.dio = portValue & 0x3
+
+  def latch(self):
+    self.latched = self.shiftReg
+    self.latchCount += 1
+    self.lastLatchTime = time.perf_counter()
+
+  # ----------------------------------------------------------------------------
+  # state
+  # ----------------------------------------------------------------------------
+  @property
+  def registers(self):
+    """latched payload as a list of words, same order as AwmfCommander builds it"""
+    w = self.wordWidth
+    m = (1 << w) - 1
+    return [(self.latched >> (w*k)) & m for k in range(self.nWords)]
+
+  @property
+  def mode(self):
+    """SB_MODE, TX_MODE, RX_MODE or RX_11_MODE from the enable lines"""
+    return {0: SB_MODE, 1: TX_MODE, 2: RX_MODE, 3: RX_11_MODE}[self.dio]
+
+  def getChannelState(self):
+    """
+    returns {"RX": {quadrant: (phase, amp)}, "TX": {quadrant: (phase, amp)}}
+    """
+    regs = self.registers
+    return {"RX": dict((q, (regs[p], regs[a])) for q, (p, a) in RX_WORDS.items()),
+            "TX": dict((q, (regs[p], regs[a])) for q, (p, a) in TX_WORDS.items())}
+
+  def getActiveChannels(self):
+    """(phase, amp) per quadrant for the enabled path, {} in standby"""
+    state = self.getChannelState()
+    if self.mode == RX_MODE:
+      return state["RX"]
+    elif self.mode == TX_MODE:
+      return state["TX"]
+    return {}
+
+
+class Awmf0108Chain:
+  """
+  Several emulated chips daisy chained: MOSI -> chips[0] -> chips[1] ... -> MISO
+  Chip selects, LDB and the enable lines are shared
+  """
+
+  def __init__(self, nChips, **kwargs):
+    self.chips = [Awmf0108Emulator(**kwargs) for _ in range(nChips)]
+
+  def csLow(self, line):
+    for chip in self.chips:
+      chip.csLow(line)
+
+  def csHigh(self, line):
+    for chip in self.chips:
+      chip.csHigh(line)
+
+  def transfer(self, value, nBits):
+    for chip in self.chips:
+      value = chip.transfer(value, nBits)
+    return value
+
+  def dioWrite(self, portValue):
+    for chip in self.chips:
+      chip.dioWrite(portValue)
+
+
+def emulatedLib(realTime=False, **kwargs):
+  """returns (lib, chip): a simulated adapter with one emulated chip on its bus"""
+  from ni845xsim import Ni845xSim
+  lib = Ni845xSim(realTime=realTime, **kwargs)
+  chip = Awmf0108Emulator()
+  lib.attach(chip)
+  return lib, chip
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def beamSwitchHarness(nBeams=320, realTime=False):
+  """
+  Programs nBeams different beams through AwmfCommander and checks every one
+  of them against the emulated chip. Returns a dict of throughput numbers
+  """
+  lib, chip = emulatedLib(realTime=realTime)
+  awmf = AwmfCommander(lib=lib)
+  awmf.initSpi()
+  adapter = next(iter(lib.adapters.values()))
+  adapter.busTime = 0.0
+  errors = 0
+
+  t0 = time.perf_counter()
+  for n in range(nBeams):
+    mode = RX_MODE if n % 2 else TX_MODE
+    phases = [(n + q) % 32 for q in range(4)]
+    amps = [(n + 2*q) % 32 for q in range(4)]
+    awmf.setBeam(mode, *(phases + amps))
+
+    expected = dict(zip(QUADRANT_ORDER, zip(phases, amps)))
+    if chip.mode != mode or chip.getActiveChannels() != expected:
+      errors += 1
+  elapsed = time.perf_counter() - t0
+
+  readBack = awmf.readRegisters()
+  if readBack != chip.registers:
+    errors += 1
+  awmf.closeSPI()
+
+  return {"beams": nBeams,
+          "errors": errors,
+          "latches": chip.latchCount,
+          "wallTime": elapsed,
+          "busTime": adapter.busTime,
+          "beamsPerSecondWall": nBeams / elapsed,
+          "beamsPerSecondBus": nBeams / adapter.busTime}
+
+def main():
+  r = beamSwitchHarness()
+  for key in sorted(r):
+    print("{0}:\t{1}".format(key, r[key]))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,170 @@
+#-------------------------------------------------------------------------------
+# Name:        awmflog
+# Purpose:     Logging for the SPI path: named loggers plus a binary ring
+#              buffer of the last few thousand bus transactions
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# Messages go through the standard logging module under "awmf.*". Hot paths
+# guard with isEnabledFor and pass arguments instead of formatted strings, so
+# a disabled level costs one integer compare. Nothing is shown below WARNING
+# unless the application configures logging, e.g.
+#
+#   logging.basicConfig(level=logging.INFO)
+#
+# TransactionLog keeps fixed size binary records in a preallocated
+# bytearray. Once full the oldest records are overwritten; dump() writes
+# what is held, oldest first, to a file that readDump() turns back into
+# TxRecord tuples.
+#-------------------------------------------------------------------------------
+
+import logging
+import struct
+import threading
+import time
+from collections import namedtuple
+
+def getLogger(name):
+  """logger under the awmf namespace"""
+  return logging.getLogger("awmf." + name)
+
+#record kinds
+TX_DIO = 1      #DIO lines written
+TX_WRITE = 2    #frame clocked and latched
+TX_READ = 3     #read back without latching
+TX_SEQ = 4      #one frame of a scripted sequence
+TX_FAIL = 5     #driver call failed; status holds its code
+
+KIND_NAMES = {TX_DIO: "DIO", TX_WRITE: "WRITE", TX_READ: "READ", TX_SEQ: "SEQ", TX_FAIL: "FAIL"}
+
+PAYLOAD_BYTES = 32
+
+#  time (double), kind, dio, status (int32), payload length, payload bytes
+_RECORD = struct.Struct("<dBBiH%ds" % PAYLOAD_BYTES)
+_HEADER = struct.Struct("<4sHHI")
+_MAGIC = b"AWTX"
+_VERSION = 1
+
+TxRecord = namedtuple('TxRecord', ['time', 'kind', 'dio', 'status', 'length', 'payload'])
+
+class TransactionLog:
+  """
+  Ring buffer of the last capacity bus transactions
+
+  log = TransactionLog(4096, dumpPath="awmf_tx.bin")
+  log.record(TX_WRITE, dio=2, payload=packed)
+  log.failure()          #dumps to dumpPath, if one was given
+  log.entries()          #[TxRecord], oldest first
+
+  Payloads longer than PAYLOAD_BYTES keep their first PAYLOAD_BYTES bytes;
+  length is always the full length.
+  """
+
+  def __init__(self, capacity=4096, dumpPath=None):
+    self.capacity = capacity
+    self.dumpPath = dumpPath
+    self._buf = bytearray(capacity * _RECORD.size)
+    self._next = 0      #total records ever written
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return min(self._next, self.capacity)
+
+  def clear(self):
+    with self._lock:
+      self._next = 0
+
+  def record(self, kind, dio=0, status=0, payload=b""):
+    payload = bytes(payload) if payload else b""
+    with self._lock:
+      _RECORD.pack_into(self._buf, (self._next % self.capacity) * _RECORD.size,
+                        time.time(), kind, dio & 0xFF, status, len(payload), payload[:PAYLOAD_BYTES])
+      self._next += 1
+
+  def _ordered(self):
+    """held records as bytes, oldest first"""
+    with self._lock:
+      n = min(self._next, self.capacity)
+      split = (self._next % self.capacity) * _RECORD.size
+      if self._next <= self.capacity:
+        return n, bytes(self._buf[:split])
+      return n, bytes(self._buf[split:]) + bytes(self._buf[:split])
+
+  def entries(self):
+    n, data = self._ordered()
+    return _unpackRecords(data, n)
+
+  def dump(self, path=None):
+    """writes the held records to path (default dumpPath). Returns the path"""
+    path = path or self.dumpPath
+    n, data = self._ordered()
+    with open(path, "wb") as stream:
+      stream.write(_HEADER.pack(_MAGIC, _VERSION, _RECORD.size, n))
+      stream.write(data)
+    return path
+
+  def failure(self):
+    """called on a failed transaction: dumps to dumpPath if set"""
+    if self.dumpPath is None:
+      return None
+    path = self.dump()
+    getLogger("txlog").error("bus failure, last %d transactions written to %s", len(self), path)
+    return path
+
+def _unpackRecords(data, n):
+  out = []
+  for i in range(n):
+    t, kind, dio, status, length, payload = _RECORD.unpack_from(data, i * _RECORD.size)
+    out.append(TxRecord(t, kind, dio, status, length, payload[:min(length, PAYLOAD_BYTES)]))
+  return out
+
+def readDump(path):
+  """[TxRecord] from a file written by TransactionLog.dump()"""
+  with open(path, "rb") as stream:
+    data = stream.read()
+  magic, version, size, n = _HEADER.unpack_from(data)
+  if magic != _MAGIC or size != _RECORD.size:
+    raise ValueError("{0} is not a transaction log".format(path))
+  return _unpackRecords(data[_HEADER.size:], n)
+
+def formatRecord(r):
+  return "{0:.6f} {1:<5} dio={2} status={3} len={4} {5}".format(
+    r.time, KIND_NAMES.get(r.kind, r.kind), r.dio, r.status, r.length, r.payload.hex())
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  import os
+  import sys
+  import tempfile
+
+  if len(sys.argv) > 1: #print a dump
+    for r in readDump(sys.argv[1]):
+      print(formatRecord(r))
+    return
+
+  log = TransactionLog(capacity=8)
+  for n in range(20):
+    log.record(TX_WRITE, dio=2, payload=bytes([n]) * 24)
+  log.record(TX_FAIL, status=-301)
+  path = os.path.join(tempfile.gettempdir(), "awmf_tx_test.bin")
+  log.dump(path)
+  records = readDump(path)
+  print("held {0}, first payload byte {1}, last kind {2}".format(
+    len(records), records[0].payload[0], KIND_NAMES[records[-1].kind]))
+  os.remove(path)
+
+  #cost of a disabled debug message
+  logger = getLogger("test")
+  t0 = time.perf_counter()
+  for n in range(100000):
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug("Writing in %s", n)
+  print("disabled debug: {0:.3f} us".format(10 * (time.perf_counter() - t0)))
+
+if __name__ == '__main__':
+  main()
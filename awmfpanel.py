@@ -0,0 +1,136 @@
+#-------------------------------------------------------------------------------
+# Name:        awmfpanel
+# Purpose:     Drive several awmf-0108s on several SPI interposers at once
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from fake_spiwrite import AwmfCommander
+
+class SpiSessionPool:
+  """
+  One AwmfCommander per adapter, each opened with ioOpenByName
+
+  pool = SpiSessionPool(["USB0::0x3923::0x7514::01A2B3C4::RAW", ...])
+  pool.get(name).setBeam(...)
+  """
+
+  def __init__(self, resourceNames, lib=None, spiClk=1000000):
+    self.sessions = OrderedDict((name, AwmfCommander(name, lib=lib, spiClk=spiClk))
+                                for name in resourceNames)
+    self._opened = set()
+
+  def names(self):
+    return list(self.sessions)
+
+  def open(self, name):
+    """opens the session for name if it isn't yet. Raises SpiInitException"""
+    awmf = self.sessions[name]
+    if name not in self._opened:
+      awmf.initSpi()
+      self._opened.add(name)
+    return awmf
+
+  def get(self, name):
+    return self.open(name)
+
+  def close(self, name=None):
+    """closes one session, or all of them"""
+    names = [name] if name is not None else list(self._opened)
+    for n in names:
+      if n in self._opened:
+        self._opened.discard(n)
+        self.sessions[n].closeSPI()
+
+class AwmfPanel:
+  """
+  Programs every chip of a panel concurrently, one I/O thread per adapter
+
+  panel = AwmfPanel(names)
+  panel.open()
+  panel.setBeams({name: (mode, NE_phase, SE_phase, SW_phase, NW_phase,
+                                NE_amp, SE_amp, SW_amp, NW_amp), ...})
+
+  setBeams returns once every chip has latched, so a panel switch takes as
+  long as the slowest adapter rather than the sum of all of them.
+  """
+
+  def __init__(self, resourceNames, lib=None, spiClk=1000000):
+    self.pool = SpiSessionPool(resourceNames, lib, spiClk)
+    self._io = OrderedDict((name, ThreadPoolExecutor(max_workers=1, thread_name_prefix="awmf%d" % i))
+                           for i, name in enumerate(resourceNames))
+
+  def _fanOut(self, calls):
+    """calls: {name: callable(awmf)}. Runs each on its adapter's thread, waits for all"""
+    futures = OrderedDict((name, self._io[name].submit(fn, self.pool.sessions[name]))
+                          for name, fn in calls.items())
+    wait(futures.values())
+    #every adapter is done -- now surface the first failure, if any
+    return OrderedDict((name, f.result()) for name, f in futures.items())
+
+  def open(self):
+    """opens every adapter in parallel. Raises the first SpiInitException"""
+    return self._fanOut(dict((name, lambda awmf, n=name: self.pool.open(n))
+                             for name in self.pool.names()))
+
+  def setBeams(self, beams):
+    """
+    beams: {resource name: setBeam arguments}
+    returns {resource name: read back}
+    """
+    return self._fanOut(dict((name, lambda awmf, a=tuple(args): awmf.setBeam(*a))
+                             for name, args in beams.items()))
+
+  def setBeam(self, *args):
+    """same setBeam arguments on every chip of the panel"""
+    return self.setBeams(dict((name, args) for name in self.pool.names()))
+
+  def close(self):
+    self.pool.close()
+    for io in self._io.values():
+      io.shutdown(wait=True)
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  import time
+  from ni845xsim import Ni845xSim
+  from awmfemu import Awmf0108Emulator
+  from fake_spiwrite import RX_MODE, TX_MODE
+
+  names = ["USB0::0x3923::0x7514::SIM%d::RAW" % i for i in range(4)]
+  lib = Ni845xSim(adapters=names, realTime=True)
+  chips = {}
+  for name in names:
+    chips[name] = Awmf0108Emulator()
+    lib.attach(chips[name], name)
+
+  panel = AwmfPanel(names, lib=lib)
+  panel.open()
+
+  nBeams = 20
+  t0 = time.perf_counter()
+  for n in range(nBeams):
+    mode = RX_MODE if n % 2 else TX_MODE
+    for name in names:
+      panel.pool.get(name).setBeam(mode, n, n, n, n, 8, 8, 8, 8)
+  serial = (time.perf_counter() - t0) / nBeams
+
+  t0 = time.perf_counter()
+  for n in range(nBeams):
+    mode = TX_MODE if n % 2 else RX_MODE
+    panel.setBeam(mode, n + 1, n + 1, n + 1, n + 1, 8, 8, 8, 8)
+  fanOut = (time.perf_counter() - t0) / nBeams
+
+  ok = all(chips[name].getActiveChannels()["NE"] == (nBeams, 8) for name in names)
+  print("{0} adapters: one at a time {1:.2f} ms, fan-out {2:.2f} ms per panel switch, chips ok: {3}"
+        .format(len(names), 1e3 * serial, 1e3 * fanOut, ok))
+  panel.close()
+
+if __name__ == '__main__':
+  main()
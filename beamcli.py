@@ -0,0 +1,225 @@
+#-------------------------------------------------------------------------------
+# Name:        beamcli
+# Purpose:     Headless beam engine: phase settings, codebooks and patterns
+#              for batches of directions, from the command line or python
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# python3 beamcli.py phase   [directions]     theta phi per line -> settings
+# python3 beamcli.py pattern [directions]     -> array factor points
+# python3 beamcli.py codebook --theta 0:60:5 --phi 0:360:15
+# python3 beamcli.py program [directions]     write each beam to the awmf-0108
+#
+# Directions come from the file given, or stdin ("-" or nothing). Lines are
+# "theta phi" in degrees, comma or space separated, # starts a comment.
+#
+#   --format json    one JSON document (default)
+#   --format jsonl   one JSON object per direction, written as it is done
+#   --format bin     packed little endian records, see the *_RECORD structs
+#
+# Nothing from Qt or OpenGL is imported. beamdef is imported when a
+# BeamEngine is made, fake_spiwrite/ni8452io only by "program".
+#-------------------------------------------------------------------------------
+
+import sys
+import struct
+
+DEFAULT_FREQ_GHZ = 28.0
+
+# bin format records
+#   phase/codebook   theta f32, phi f32, NE SE SW NW u8
+#   pattern          theta f32, phi f32, n u32, then n x (theta f32, phi f32, af f32)
+PHASE_RECORD = struct.Struct("<ff4B")
+PATTERN_HEADER = struct.Struct("<ffI")
+PATTERN_POINT = struct.Struct("<fff")
+
+ANTENNAS = {
+  "4x1": ([["NE", "NW", "SE", "SW"]], [[True, False, True, False]]),
+  "2x2": ([["NW", "NE"], ["SW", "SE"]], [[True, False], [True, False]]),
+}
+
+#-------------------------------------------------------------------------------
+# library entry points
+#-------------------------------------------------------------------------------
+class BeamEngine:
+  """
+  One BeamDefinition re-pointed for every direction, so the phase cal is
+  read once per run
+
+  eng = BeamEngine(freqGHz=28, antenna="4x1", phaseCalFile="phaseCal.yaml")
+  eng.phaseSettings(30, 90)        -> [NE, SE, SW, NW]
+  eng.pattern(30, 90, n=30)        -> [(theta, phi, af), ...]
+  """
+
+  def __init__(self, freqGHz=DEFAULT_FREQ_GHZ, antenna="4x1", phaseCalFile="phaseCal.yaml", spacing=5.4e-3):
+    from beamdef import BeamDefinition
+    self.waveLength = 3 * pow(10, 8) / (freqGHz * pow(10, 9))
+    self.beamDef = BeamDefinition(0, 0, self.waveLength, phaseCalFile=phaseCalFile)
+    grid, invert = ANTENNAS[antenna]
+    self.beamDef.setAntenna(grid, invert, spacing)
+
+  def phaseSettings(self, theta, phi):
+    self.beamDef.setDirection(theta, phi)
+    return list(self.beamDef.getPhaseSettings())
+
+  def pattern(self, theta, phi, n=30):
+    self.beamDef.setDirection(theta, phi)
+    return self.beamDef.generateAllAF(n_theta=n, n_phi=n)
+
+  def codebook(self, thetas, phis):
+    """
+    returns [(theta, phi, settings)] for the first direction of every
+    distinct setting vector on the theta x phi grid
+    """
+    seen = set()
+    book = []
+    for theta in thetas:
+      for phi in phis:
+        s = tuple(self.phaseSettings(theta, phi))
+        if s not in seen:
+          seen.add(s)
+          book.append((theta, phi, list(s)))
+    return book
+
+def readDirections(stream):
+  """yields (theta, phi) from text lines"""
+  for line in stream:
+    line = line.split("#", 1)[0].replace(",", " ").split()
+    if line:
+      yield float(line[0]), float(line[1]) if len(line) > 1 else 0.0
+
+def frange(spec):
+  """'start:stop:step' (stop excluded) -> list of floats"""
+  parts = [float(x) for x in spec.split(":")]
+  if len(parts) == 1:
+    return parts
+  start, stop = parts[0], parts[1]
+  step = parts[2] if len(parts) > 2 else 1.0
+  n = int(round((stop - start) / step))
+  return [start + i * step for i in range(max(n, 0))]
+
+#-------------------------------------------------------------------------------
+# output
+#-------------------------------------------------------------------------------
+class Writer:
+  """json collects and writes at close, jsonl and bin write as they go"""
+
+  def __init__(self, fmt, stream):
+    self.fmt = fmt
+    self.stream = stream
+    self.items = []
+
+  def phase(self, theta, phi, settings):
+    if self.fmt == "bin":
+      self.stream.write(PHASE_RECORD.pack(theta, phi, *settings))
+    else:
+      self._obj({"theta": theta, "phi": phi, "phase": settings})
+
+  def pattern(self, theta, phi, points):
+    if self.fmt == "bin":
+      out = [PATTERN_HEADER.pack(theta, phi, len(points))]
+      out.extend(PATTERN_POINT.pack(t, p, a) for t, p, a in points)
+      self.stream.write(b"".join(out))
+    else:
+      self._obj({"theta": theta, "phi": phi, "points": points})
+
+  def _obj(self, obj):
+    import json
+    if self.fmt == "jsonl":
+      self.stream.write(json.dumps(obj) + "\n")
+    else:
+      self.items.append(obj)
+
+  def close(self):
+    if self.fmt == "json":
+      import json
+      json.dump(self.items, self.stream)
+      self.stream.write("\n")
+    self.stream.flush()
+
+def _outStream(path, fmt):
+  if path in (None, "-"):
+    return sys.stdout.buffer if fmt == "bin" else sys.stdout
+  return open(path, "wb" if fmt == "bin" else "w")
+
+def _inStream(path):
+  if path in (None, "-"):
+    return sys.stdin
+  return open(path, "r")
+
+#-------------------------------------------------------------------------------
+# commands
+#-------------------------------------------------------------------------------
+def cmdPhase(args, eng, out):
+  for theta, phi in readDirections(_inStream(args.input)):
+    out.phase(theta, phi, eng.phaseSettings(theta, phi))
+
+def cmdPattern(args, eng, out):
+  for theta, phi in readDirections(_inStream(args.input)):
+    out.pattern(theta, phi, eng.pattern(theta, phi, args.points))
+
+def cmdCodebook(args, eng, out):
+  for theta, phi, settings in eng.codebook(frange(args.theta), frange(args.phi)):
+    out.phase(theta, phi, settings)
+
+def cmdProgram(args, eng, out):
+  from fake_spiwrite import AwmfCommander, RX_MODE, TX_MODE
+  awmf = AwmfCommander(args.resource)
+  awmf.initSpi()
+  mode = TX_MODE if args.tx else RX_MODE
+  try:
+    for theta, phi in readDirections(_inStream(args.input)):
+      settings = eng.phaseSettings(theta, phi)
+      awmf.setBeam(mode, *(settings + [args.amp] * 4))
+      out.phase(theta, phi, settings)
+  finally:
+    awmf.closeSPI()
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(description="awmf-0108 beam engine")
+  parser.add_argument("--freq", type=float, default=DEFAULT_FREQ_GHZ, help="GHz")
+  parser.add_argument("--antenna", choices=sorted(ANTENNAS), default="4x1")
+  parser.add_argument("--cal", default="phaseCal.yaml", help="phase cal yaml")
+  parser.add_argument("--format", choices=["json", "jsonl", "bin"], default="json")
+  parser.add_argument("-o", "--out", help="output file (default stdout)")
+  sub = parser.add_subparsers(dest="command")
+  sub.required = True
+
+  p = sub.add_parser("phase", help="phase settings per direction")
+  p.add_argument("input", nargs="?")
+  p.set_defaults(run=cmdPhase)
+
+  p = sub.add_parser("pattern", help="array factor per direction")
+  p.add_argument("input", nargs="?")
+  p.add_argument("--points", type=int, default=30, help="theta and phi resolution")
+  p.set_defaults(run=cmdPattern)
+
+  p = sub.add_parser("codebook", help="distinct settings over a direction grid")
+  p.add_argument("--theta", default="0:61:5", help="start:stop:step degrees")
+  p.add_argument("--phi", default="90", help="start:stop:step degrees")
+  p.set_defaults(run=cmdCodebook)
+
+  p = sub.add_parser("program", help="write each direction to the chip")
+  p.add_argument("input", nargs="?")
+  p.add_argument("--resource", help="VISA resource of the adapter")
+  p.add_argument("--amp", type=int, default=0, help="attenuation setting 0-31")
+  p.add_argument("--tx", action="store_true", help="TX mode (default RX)")
+  p.set_defaults(run=cmdProgram)
+
+  args = parser.parse_args(argv)
+  eng = BeamEngine(args.freq, args.antenna, args.cal)
+  stream = _outStream(args.out, args.format)
+  out = Writer(args.format, stream)
+  try:
+    args.run(args, eng, out)
+  finally:
+    out.close()
+    if stream not in (sys.stdout, sys.stdout.buffer):
+      stream.close()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,272 @@
+#-------------------------------------------------------------------------------
+# Name:        beamcompare
+# Purpose:     Qualify a codebook: compare the pattern the awmf-0108
+#              registers produce with the ideal one for every beam
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# python3 beamcompare.py                                  4x1, theta 0-60, phi 90
+# python3 beamcompare.py --antenna 2x2 --theta 0:61:5 --phi 0:360:30
+# python3 beamcompare.py --cal testPhaseCal.yaml --format jsonl
+#
+# For every codebook direction the ideal pattern (unquantized phases) and
+# the quantized one (register values plus calibration error, see
+# BeamDefinition.getQuantizedPhases) are sampled on the same direction grid.
+#
+#   pointingError    degrees between the ideal beam's peak and the quantized
+#                    beam's peak: what quantization moves the beam by
+#   steeringError    degrees between the requested direction and the ideal
+#                    beam's peak: the steering law's own error
+#   gainLossDb       ideal over quantized, each at its peak next to the
+#                    requested direction
+#   sidelobeRiseDb   quantized peak sidelobe level minus the ideal one
+#                    (each relative to its own peak)
+#
+# The direction dependent part of the array factor, e^(jk r.u) for every
+# element and direction, is one matrix shared by the whole codebook; each
+# pattern is then that matrix times an excitation vector. Peaks are found off
+# the grid, by a pattern search from the requested direction. A linear
+# array's maximum is a cone, not a point, so its pointing error is measured
+# as the angle off broadside in the plane of the array.
+#-------------------------------------------------------------------------------
+
+import sys
+from collections import namedtuple
+from math import radians, degrees, acos, asin, log10, sqrt
+from operator import mul
+
+from beamdef import afDirections, directionCosines
+
+BeamQuality = namedtuple('BeamQuality', ['theta', 'phi', 'settings', 'pointingError', 'steeringError',
+                                         'gainLossDb', 'idealSidelobeDb', 'sidelobeDb', 'sidelobeRiseDb'])
+
+class PatternGrid:
+  """
+  The generateAllAF direction grid of one array, with the steering matrix
+  e^(jk r.u) [direction][element] worked out once
+
+  grid = PatternGrid(beamDef.getElementPositions(), waveLength)
+  af = grid.arrayFactor(beamDef.getElementWeights())   #|AF| per direction
+  """
+
+  def __init__(self, positions, waveLength, n_theta=45, n_phi=90, backLobes=False):
+    from cmath import exp, pi
+    self.backLobes = backLobes
+    self.directions = afDirections(n_theta, n_phi, backLobes)
+    self.cosines = [directionCosines(radians(t), radians(p)) for t, p in self.directions]
+    k = 2 * pi / waveLength
+    self.scaled = [(k * x, k * y, k * z) for x, y, z in positions]
+    self.matrix = [[exp(1j * (kx * u + ky * v + kz * w)) for kx, ky, kz in self.scaled]
+                   for u, v, w in self.cosines]
+
+    self.axis = _lineAxis(positions)
+
+    #neighbours on the (theta, phi) grid, phi wrapping round
+    first = self.directions[0][0]
+    self.nPhi = sum(1 for t, p in self.directions if t == first)
+    self.nTheta = len(self.directions) // self.nPhi
+    self.neighbours = []
+    for n in range(len(self.directions)):
+      i, j = divmod(n, self.nPhi)
+      nb = [i * self.nPhi + (j + 1) % self.nPhi, i * self.nPhi + (j - 1) % self.nPhi]
+      if i > 0:
+        nb.append(n - self.nPhi)
+      if i < self.nTheta - 1:
+        nb.append(n + self.nPhi)
+      self.neighbours.append(nb)
+
+  def arrayFactor(self, weights):
+    """|AF| in every direction for element excitations weights"""
+    return [abs(sum(map(mul, row, weights))) for row in self.matrix]
+
+  def arrayFactorAt(self, weights, theta, phi):
+    """|AF| in one direction (degrees), off the grid"""
+    from cmath import exp
+    u, v, w = directionCosines(radians(theta), radians(phi))
+    return abs(sum(c * exp(1j * (kx * u + ky * v + kz * w)) for (kx, ky, kz), c in zip(self.scaled, weights)))
+
+  def refinePeak(self, weights, theta, phi, step=2.0, minStep=0.01):
+    """
+      (theta, phi, |AF|) of the maximum found by a pattern search from
+      theta/phi, halving the step down to minStep degrees. Only clear
+      improvements move it, so a flat ridge leaves it where it lands
+    """
+    tMax = 180.0 if self.backLobes else 90.0
+    best = self.arrayFactorAt(weights, theta, phi)
+    while step >= minStep:
+      moved = False
+      for dt, dp in ((step, 0), (-step, 0), (0, step), (0, -step)):
+        t, p = theta + dt, phi + dp
+        if t < 0:
+          t, p = -t, p + 180 #over the pole
+        t = min(t, tMax)
+        p = p % 360
+        a = self.arrayFactorAt(weights, t, p)
+        if a > best * (1 + 1e-9):
+          theta, phi, best, moved = t, p, a, True
+          break
+      if not moved:
+        step /= 2
+    return theta, phi, best
+
+  def pointingError(self, theta0, phi0, theta1, phi1):
+    """
+      degrees between two directions as this array can tell them apart: the
+      full angle, or for a linear array the difference in angle off broadside
+    """
+    if self.axis is None:
+      return angleBetween(theta0, phi0, theta1, phi1)
+    u0 = directionCosines(radians(theta0), radians(phi0))
+    u1 = directionCosines(radians(theta1), radians(phi1))
+    s0 = max(-1.0, min(1.0, sum(map(mul, u0, self.axis))))
+    s1 = max(-1.0, min(1.0, sum(map(mul, u1, self.axis))))
+    return abs(degrees(asin(s1) - asin(s0)))
+
+  def nearest(self, theta, phi):
+    """index of the grid direction closest to theta/phi (degrees)"""
+    u0 = directionCosines(radians(theta), radians(phi))
+    return max(range(len(self.cosines)), key=lambda n: sum(map(mul, self.cosines[n], u0)))
+
+
+  def climb(self, af, start):
+    """the local maximum reached by going uphill from direction start"""
+    n = start
+    while True:
+      best = max(self.neighbours[n], key=lambda m: af[m])
+      if af[best] <= af[n]:
+        return n
+      n = best
+
+  def mainLobe(self, af, peak):
+    """
+      directions connected to peak through the half power region, then only
+      going downhill: the main lobe (a whole ridge for a linear array)
+    """
+    halfPower = af[peak] / 2 ** 0.5
+    lobe = set([peak])
+    todo = [peak]
+    while todo:
+      n = todo.pop()
+      for m in self.neighbours[n]:
+        if m not in lobe and (af[m] <= af[n] or af[m] >= halfPower):
+          lobe.add(m)
+          todo.append(m)
+    return lobe
+
+  def peakSidelobeDb(self, af, peak):
+    """highest level outside the main lobe relative to the peak (None if there is none)"""
+    lobe = self.mainLobe(af, peak)
+    outside = [a for n, a in enumerate(af) if n not in lobe]
+    if not outside or max(outside) <= 0 or af[peak] <= 0:
+      return None
+    return 20 * log10(max(outside) / af[peak])
+
+def _lineAxis(positions):
+  """unit vector along the array if every element is on one line, else None"""
+  x0 = positions[0]
+  axis = None
+  for p in positions[1:]:
+    d = [a - b for a, b in zip(p, x0)]
+    length = sqrt(sum(c * c for c in d))
+    if length == 0:
+      continue
+    d = [c / length for c in d]
+    if axis is None:
+      axis = d
+    elif abs(abs(sum(map(mul, axis, d))) - 1) > 1e-9:
+      return None
+  return axis
+
+def angleBetween(theta0, phi0, theta1, phi1):
+  """degrees between two directions given in degrees"""
+  u0 = directionCosines(radians(theta0), radians(phi0))
+  u1 = directionCosines(radians(theta1), radians(phi1))
+  return degrees(acos(max(-1.0, min(1.0, sum(map(mul, u0, u1))))))
+
+def _rise(ideal, quant):
+  if ideal is None or quant is None:
+    return None
+  return quant - ideal
+
+def compareCodebook(beamDef, codebook, n_theta=45, n_phi=90, backLobes=False):
+  """
+    [BeamQuality] for every (theta, phi) of codebook (degrees), beamDef
+    giving the antenna, wavelength and calibration. beamDef is re-pointed
+  """
+  grid = PatternGrid(beamDef.getElementPositions(), beamDef.waveLength, n_theta, n_phi, backLobes)
+  results = []
+  for theta, phi in codebook:
+    beamDef.setDirection(theta, phi)
+    settings = list(beamDef.getPhaseSettings()) if beamDef.onChannels() else None
+    idealW = beamDef.getElementWeights()
+    quantW = beamDef.getElementWeights(quantized=True)
+    ideal = grid.arrayFactor(idealW)
+    quant = grid.arrayFactor(quantW)
+
+    start = grid.nearest(theta, phi)
+    idealSl = grid.peakSidelobeDb(ideal, grid.climb(ideal, start))
+    quantSl = grid.peakSidelobeDb(quant, grid.climb(quant, start))
+    idealPeak = grid.refinePeak(idealW, theta, phi)
+    quantPeak = grid.refinePeak(quantW, theta, phi)
+    results.append(BeamQuality(theta, phi, settings,
+                               grid.pointingError(idealPeak[0], idealPeak[1], quantPeak[0], quantPeak[1]),
+                               grid.pointingError(theta, phi, idealPeak[0], idealPeak[1]),
+                               20 * log10(idealPeak[2] / quantPeak[2]),
+                               idealSl, quantSl, _rise(idealSl, quantSl)))
+  return results
+
+def summarize(results):
+  """worst and mean of each figure over a compareCodebook result"""
+  out = {"beams": len(results)}
+  for field in ("pointingError", "steeringError", "gainLossDb", "sidelobeRiseDb"):
+    values = [getattr(r, field) for r in results if getattr(r, field) is not None]
+    if values:
+      out[field] = {"worst": max(values), "mean": sum(values) / len(values)}
+  return out
+
+
+# ------------------------------------------------------------------------------
+# MAIN PROGRAM
+# ------------------------------------------------------------------------------
+def _db(x):
+  return "   --" if x is None else "{0:5.1f}".format(x)
+
+def main(argv=None):
+  import argparse
+  import json
+  import time
+  from beamcli import BeamEngine, ANTENNAS, DEFAULT_FREQ_GHZ, frange
+
+  parser = argparse.ArgumentParser(description="awmf-0108 codebook qualification")
+  parser.add_argument("--freq", type=float, default=DEFAULT_FREQ_GHZ, help="GHz")
+  parser.add_argument("--antenna", choices=sorted(ANTENNAS), default="4x1")
+  parser.add_argument("--cal", default="phaseCal.yaml", help="phase cal yaml")
+  parser.add_argument("--theta", default="0:61:5", help="start:stop:step degrees")
+  parser.add_argument("--phi", default="90", help="start:stop:step degrees")
+  parser.add_argument("--resolution", type=int, default=45, help="theta points (phi gets twice as many)")
+  parser.add_argument("--format", choices=["table", "jsonl"], default="table")
+  args = parser.parse_args(argv)
+
+  beamDef = BeamEngine(args.freq, args.antenna, args.cal).beamDef
+  codebook = [(t, p) for t in frange(args.theta) for p in frange(args.phi)]
+  t0 = time.perf_counter()
+  results = compareCodebook(beamDef, codebook, args.resolution, 2 * args.resolution)
+  elapsed = time.perf_counter() - t0
+
+  if args.format == "jsonl":
+    for r in results:
+      sys.stdout.write(json.dumps(r._asdict()) + "\n")
+  else:
+    print(" theta   phi  settings          point  steer  loss   SLL(ideal)  SLL(quant)  rise")
+    for r in results:
+      print("{0:6.1f} {1:5.1f}  {2:<16}  {3:5.1f}  {4:5.1f}  {5:4.2f}  {6:>10}  {7:>10}  {8}".format(
+        r.theta, r.phi, str(r.settings), r.pointingError, r.steeringError, r.gainLossDb,
+        _db(r.idealSidelobeDb), _db(r.sidelobeDb), _db(r.sidelobeRiseDb)))
+  sys.stderr.write("{0} beams in {1:.0f} ms: {2}\n".format(len(results), 1e3 * elapsed,
+                                                          json.dumps(summarize(results))))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -10,17 +10,111 @@
 # Licence:     tbd by Anokiwave 
 #-------------------------------------------------------------------------------
 
-from math import sin, cos, atan, pow, e, pi, radians, trunc, degrees
+from math import sin, cos, atan, pow, e, pi, radians, trunc, degrees, sqrt
 from cmath import exp
-import yaml
 import copy
 
+from stagetime import timed
+
 #quadrant indexes
 NW = "NW"
 SW = "SW"
 SE = "SE"
 NE = "NE"
 
+#-------------------------------------------------------------------------------
+# element positions
+#   An array is a list of element positions (x, y, z) in meters -- an (N, 3)
+#   array. x runs down the rows of an antennaGrid (the phi = 0 direction), y
+#   along them (phi = 90), z is broadside.
+#-------------------------------------------------------------------------------
+def directionCosines(theta, phi):
+  """(u, v, w) unit vector of a direction given in radians"""
+  st = sin(theta)
+  return (st * cos(phi), st * sin(phi), cos(theta))
+
+def gridPositions(grid, spacing):
+  """positions of a regular antennaGrid, row major"""
+  return [(n * spacing, m * spacing, 0.0) for n in range(len(grid)) for m in range(len(grid[0]))]
+
+def rectangularLattice(nx, ny, dx, dy=None):
+  """nx rows by ny columns, dx apart down the rows and dy (default dx) along"""
+  dy = dx if dy is None else dy
+  return [(n * dx, m * dy, 0.0) for n in range(nx) for m in range(ny)]
+
+def triangularLattice(nx, ny, d):
+  """nx rows of ny elements d apart, every other row shifted by d/2"""
+  rowPitch = d * sqrt(3) / 2
+  return [(n * rowPitch, m * d + (d / 2 if n % 2 else 0.0), 0.0) for n in range(nx) for m in range(ny)]
+
+def offsetPositions(positions, dx=0.0, dy=0.0, dz=0.0, rotation=0.0):
+  """
+    positions rotated by rotation degrees about z, then moved by (dx, dy, dz)
+    -- to place one panel of a multi-panel assembly
+  """
+  c, s = cos(radians(rotation)), sin(radians(rotation))
+  return [(c * x - s * y + dx, s * x + c * y + dy, z + dz) for x, y, z in positions]
+
+def afDirections(n_theta=30, n_phi=30, backLobes=False):
+  """(theta, phi) in degrees of every generateAllAF point, in its order"""
+  t_max = 180 if backLobes else 90
+  p_max = 360
+  p_d = p_max / n_phi
+  t_d = t_max / n_theta
+  directions = []
+  t = 0
+  while t < t_max :
+    p = 0
+    while p < p_max :
+      directions.append((t, p))
+      p = p + p_d
+    t = t + t_d
+  return directions
+
+#-------------------------------------------------------------------------------
+# cuts
+#   1-D slices of the pattern: (u, v, w) of every point along a cut, for
+#   BeamDefinition.generateCut. Angles in degrees
+#-------------------------------------------------------------------------------
+def cutAngles(start, stop, step):
+  """start to stop inclusive, step apart"""
+  n = int(round((stop - start) / step))
+  return [start + i * step for i in range(n + 1)]
+
+def phiCutDirections(phi, thetas):
+  """the constant phi plane; negative theta is the phi + 180 half of it"""
+  return [directionCosines(radians(t), radians(phi)) for t in thetas]
+
+def thetaCutDirections(theta, phis):
+  """the constant theta cone"""
+  return [directionCosines(radians(theta), radians(p)) for p in phis]
+
+def greatCircleDirections(theta, phi, heading, angles):
+  """
+    the great circle through theta/phi, leaving it heading degrees from the
+    +theta direction towards +phi; angles are measured along it from theta/phi
+  """
+  t, p, h = radians(theta), radians(phi), radians(heading)
+  u0 = directionCosines(t, p)
+  eTheta = (cos(t) * cos(p), cos(t) * sin(p), -sin(t))
+  ePhi = (-sin(p), cos(p), 0.0)
+  eHeading = [cos(h) * a + sin(h) * b for a, b in zip(eTheta, ePhi)]
+  out = []
+  for s in angles:
+    c, sn = cos(radians(s)), sin(radians(s))
+    out.append(tuple(c * a + sn * b for a, b in zip(u0, eHeading)))
+  return out
+
+def steeringPhases(positions, waveLength, theta, phi):
+  """
+    phase (radians) each element needs to point at theta/phi (radians):
+    -k r.u, one row of the position x direction cosine product
+  """
+  k = 2 * pi / waveLength
+  u, v, w = directionCosines(theta, phi)
+  return [-k * (x * u + y * v + z * w) for x, y, z in positions]
+
+
 class BeamDefinition:
   """ Calculates AWMF phase settings from beam definition
   
@@ -75,6 +169,11 @@ class BeamDefinition:
     self.antennaInvert = [[True, False, True, False]]
     self.antennaSpacing = 5.4 * pow(10,-3) #space between the center of antennas (meters)
 
+    #explicit element positions (setElementPositions) -- None = use antennaGrid
+    self.elementPositions = None
+    self.elementChannels = None #awmf-0108 channel (NE, SE, SW, NW) of each element
+    self.elementInvert = None
+
     #Calculated awmf0108 settings... calculate when needed
     self.phaseSettings = []
     self.phaseSettingsRaw = []
@@ -84,6 +183,7 @@ class BeamDefinition:
     self.phaseCal = self.loadPhaseCal(phaseCalFile)
 
 
+  @timed("beamdef.getPhaseSettings")
   def getPhaseSettings(self):
     """
       returns:  array containing the phase offset for each antenna 
@@ -91,11 +191,15 @@ class BeamDefinition:
                 
                 returns a 1x4 array with settings for - NE-SE-SW-NW
 
-
+      With explicit element positions the elements must be the four channels
+      (see onChannels); getElementPhaseSettings has one setting per element.
     """
     if len(self.phaseSettings) > 0:
       return self.phaseSettings
 
+    if self.elementPositions is not None:
+      return self._positionPhaseSettings()
+
     k = 2 * pi / (self.waveLength) # wave number
     
     ##phi/theta to ew/ns angle 
@@ -137,16 +241,96 @@ class BeamDefinition:
     
     return n_offsets
 
+  def onChannels(self):
+    """True if the elements are exactly the four awmf-0108 channels, so getPhaseSettings applies"""
+    if self.elementPositions is None:
+      return True
+    channels = self.elementChannels
+    return channels is not None and sorted(channels) == sorted([NE, SE, SW, NW])
+
+  def _positionPhaseSettings(self):
+    """getPhaseSettings (NE-SE-SW-NW) for explicit element positions"""
+    if not self.onChannels():
+      raise ValueError("{0} elements aren't the four awmf-0108 channels: use getElementPhaseSettings".format(
+        len(self.elementPositions)))
+    self.phaseSettingsRaw = steeringPhases(self.elementPositions, self.waveLength, self.theta, self.phi)
+    byChannel = dict(zip(self.elementChannels, self.getElementPhaseSettings()))
+    self.phaseSettings = [byChannel[x] for x in [NE, SE, SW, NW]]
+    return self.phaseSettings
+
+  def getElementPhaseSettings(self):
+    """
+      awmf-0108 phase setting of every element, in getElementPositions order,
+      inverts and (for elements with a channel) calibration applied
+    """
+    raw = self.getRawPhaseSettings()
+    if self.elementPositions is None:
+      raw = [j for i in raw for j in i]
+      invert = [j for i in self.antennaInvert for j in i]
+      channels = [j for i in self.antennaGrid for j in i]
+    else:
+      invert = self.elementInvert or [False] * len(raw)
+      channels = self.elementChannels or [None] * len(raw)
+
+    settings = []
+    for r, inv, ch in zip(raw, invert, channels):
+      s = self._radiansToAwmf0108(r + pi if inv else r)
+      settings.append(self._applyCalibration(ch, s, self.phaseCal) if ch is not None else s)
+    return settings
+
+  def getQuantizedPhases(self):
+    """
+      Phase (radians) each element actually radiates with: its awmf-0108
+      register value plus that register's calibration error, the antiphase
+      feed of inverted elements taken back out. Flat, getElementPositions order
+    """
+    if self.elementPositions is None:
+      invert = [j for i in self.antennaInvert for j in i]
+      channels = [j for i in self.antennaGrid for j in i]
+    else:
+      invert = self.elementInvert or [False] * len(self.elementPositions)
+      channels = self.elementChannels or [None] * len(self.elementPositions)
+
+    step = self.phaseControlMax / self.phaseControlRange
+    phases = []
+    for reg, inv, ch in zip(self.getElementPhaseSettings(), invert, channels):
+      err = 0
+      if self.phaseCal and ch is not None:
+        errs = self.phaseCal[ch]
+        err = errs[min(errs.keys(), key=lambda x:abs(x - reg))]
+      phases.append((reg + err) * step - (pi if inv else 0))
+    return phases
+
+  def getElementWeights(self, quantized=False):
+    """
+      complex excitation I e^jd of every element, getElementPositions order.
+      quantized=True uses the phases the registers produce (getQuantizedPhases)
+    """
+    I = self.getRelativeGain()
+    if self.elementPositions is None:
+      I = [j for i in I for j in i]
+    if quantized:
+      d = self.getQuantizedPhases()
+    else:
+      d = self.getRawPhaseSettings()
+      if self.elementPositions is None:
+        d = [j for i in d for j in i]
+    return [a * exp(1j * ph) for a, ph in zip(I, d)]
+
   def getRawPhaseSettings(self):
     """
       Gets an array of phase settings as a 2D array - same mapping as self.antennaGrid, in radians
       Removes phase inverts to specified patches.
 
       Maps the information stored in self.phaseSettings to locations specified
-      by self.antennaGrid
+      by self.antennaGrid. With explicit element positions it is a flat list,
+      one phase per element.
     """
     if len(self.phaseSettingsRaw) == 0:
-      self.getPhaseSettings()
+      if self.elementPositions is not None:
+        self.phaseSettingsRaw = steeringPhases(self.elementPositions, self.waveLength, self.theta, self.phi)
+      else:
+        self.getPhaseSettings()
 
     return self.phaseSettingsRaw
 
@@ -158,6 +342,10 @@ class BeamDefinition:
     if len(self.gainSettings) > 0 :
       return self.gainSettings
 
+    if self.elementPositions is not None:
+      self.gainSettings = [self.beamStrength / self.beamStrength for x in self.elementPositions]
+      return self.gainSettings
+
     xdim = len(self.antennaGrid)
     ydim = len(self.antennaGrid[0])
     self.gainSettings = [[self.beamStrength / self.beamStrength for y in range(ydim)] for x in range(xdim)]
@@ -174,14 +362,60 @@ class BeamDefinition:
     self.antennaGrid = grid 
     self.antennaSpacing  = spacing
     self.antennaInvert = invertPattern
+    self.elementPositions = None
 
     #force recalulation of gain and phase settings
     self.phaseSettings = []
+    self.phaseSettingsRaw = []
+    self.gainSettings = []
+    return
+
+  def setElementPositions(self, positions, channels=None, invert=None):
+    """
+      Uses an explicit (N, 3) list of element positions (x, y, z) in meters
+      instead of antennaGrid/antennaSpacing: triangular lattices, thinned
+      arrays, several panels (see rectangularLattice, triangularLattice,
+      offsetPositions). (x, y) rows are taken as z = 0.
+
+      channels  awmf-0108 channel of each element (NE, SE, SW, NW), for the
+                calibration and for getPhaseSettings' NE-SE-SW-NW order
+      invert    True for each element fed in antiphase
+    """
+    self.elementPositions = [tuple(float(c) for c in p) + (0.0,) * (3 - len(p)) for p in positions]
+    n = len(self.elementPositions)
+    if channels is not None and len(channels) != n:
+      raise ValueError("{0} channels for {1} elements".format(len(channels), n))
+    if invert is not None and len(invert) != n:
+      raise ValueError("{0} inverts for {1} elements".format(len(invert), n))
+    self.elementChannels = list(channels) if channels is not None else None
+    self.elementInvert = list(invert) if invert is not None else None
+
+    self.phaseSettings = []
+    self.phaseSettingsRaw = []
     self.gainSettings = []
     return
 
+  def getElementPositions(self):
+    """(x, y, z) of every element in meters -- explicit or from antennaGrid"""
+    if self.elementPositions is not None:
+      return self.elementPositions
+    return gridPositions(self.antennaGrid, self.antennaSpacing)
+
 
-  def generateAllAF(self, n_theta=30, n_phi=30, normalized=True, absAf=True, backLobes=False):
+  def setDirection(self, theta, phi):
+    """
+      Re-points the beam (degrees, same as the constructor) without reloading
+      the phase calibration. Cached settings are recalculated when next asked for.
+    """
+    self.theta = radians(theta)
+    self.phi = radians(phi)
+    self.phaseSettings = []
+    self.phaseSettingsRaw = []
+    return
+
+
+  @timed("beamdef.generateAllAF")
+  def generateAllAF(self, n_theta=30, n_phi=30, normalized=True, absAf=True, backLobes=False, quantized=False):
     """
       n_theta: resolution of display in points 
 
@@ -192,67 +426,103 @@ class BeamDefinition:
         AF is normalized to 1 by default
         Only uses the magnitude component of the Af by default
         backLobes -- set true if you want to see the pattern on the back of the antenna
+        quantized -- pattern of the register values actually written (5 bit
+          phase states, calibration) instead of the ideal phases
         
     """
-    t = 0
-    p = 0
-    t_max = 180 if backLobes else 90
-    p_max = 360
-
-    p_d = p_max / n_phi
-    t_d = t_max / n_theta
-
     points = []
     
     af_max = -1
 
-    while t < t_max :
-      while p < p_max :
-        a = self._calculateArrayFactor(radians(t), radians(p), self.getRelativeGain(), self.getRawPhaseSettings(), self.waveLength);
+    terms = self._elementTerms(quantized)
+    for t, p in afDirections(n_theta, n_phi, backLobes):
+      a = self._calculateArrayFactor(directionCosines(radians(t), radians(p)), terms)
 
-        if absAf:
-          a = abs(a)
+      if absAf:
+        a = abs(a)
 
-        points.append( (t, p, a) )
+      points.append( (t, p, a) )
 
-        if abs(a) > abs(af_max):
-          af_max = a
-
-        p = p + p_d
-      p = 0
-      t = t + t_d
+      if abs(a) > abs(af_max):
+        af_max = a
     
     if normalized:
       return [(t, p, a/abs(af_max)) for (t, p, a) in points] #divide all afs by af_max
     else:
       return points
 
-  def _calculateArrayFactor(self, theta, phi, I, d, waveLength):
+  @timed("beamdef.generateCut")
+  def generateCut(self, directions, angles, normalized=True, absAf=True, quantized=False):
+    """
+      AF along a cut: [(angle, AF)] for (u, v, w) directions (see
+      phiCutDirections, thetaCutDirections, greatCircleDirections) labelled
+      with angles. normalized, absAf and quantized as for generateAllAF;
+      normalized is to the largest AF on the cut
+    """
+    terms = self._elementTerms(quantized)
+    points = []
+    for angle, d in zip(angles, directions):
+      a = self._calculateArrayFactor(d, terms)
+      points.append((angle, abs(a) if absAf else a))
+    if normalized:
+      af_max = max(abs(a) for angle, a in points) if points else 0
+      af_max = af_max or 1.0
+      return [(angle, a / af_max) for angle, a in points]
+    return points
+
+  def phiCut(self, phi, start=-90, stop=90, step=0.1, **kwargs):
+    """[(theta, AF)] in the constant phi plane (degrees), generateCut's kwargs"""
+    thetas = cutAngles(start, stop, step)
+    return self.generateCut(phiCutDirections(phi, thetas), thetas, **kwargs)
+
+  def thetaCut(self, theta, start=0, stop=360, step=0.1, **kwargs):
+    """[(phi, AF)] round the constant theta cone (degrees)"""
+    phis = cutAngles(start, stop, step)
+    return self.generateCut(thetaCutDirections(theta, phis), phis, **kwargs)
+
+  def greatCircleCut(self, theta, phi, heading=0, start=-90, stop=90, step=0.1, **kwargs):
+    """[(angle from theta/phi, AF)] along a great circle (greatCircleDirections)"""
+    angles = cutAngles(start, stop, step)
+    return self.generateCut(greatCircleDirections(theta, phi, heading, angles), angles, **kwargs)
+
+  def getBeamMetrics(self, quantized=False, grid=None):
+    """
+      Peak, 3 dB beamwidths, peak sidelobe level and nulls of the current beam
+      without a dense pattern (beammetrics.BeamMetrics). quantized as for
+      generateAllAF; grid, a beammetrics.MetricsGrid of this array, can be
+      shared between many beams
+    """
+    from beammetrics import beamMetrics
+    return beamMetrics(self, quantized, grid)
+
+  def _elementTerms(self, quantized=False):
+    """
+    private: (k x, k y, k z, I e^jd) of every element -- everything in the
+    array factor that doesn't depend on the direction, worked out once
+    """
+    k = 2 * pi / self.waveLength # k = wave numer
+    return [(k * x, k * y, k * z, c)
+            for (x, y, z), c in zip(self.getElementPositions(), self.getElementWeights(quantized))]
+
+  def _calculateArrayFactor(self, direction, terms):
     """ 
-    private: calculate the strength of a configuratio at angle theta/phi
-    on a square plane antenna array.
-    
-    I:  2D array of amplitudes of each element in square array (scale from 0 to 1.0)
-    d:  2D array of phases of each element in square array (radians)
-      **Must have dimensions self.antennaGrid
+    private: calculate the strength of a configuration in one direction
+      sum of I e^j(d + k r.u) over the elements
+
+    direction:  (u, v, w) direction cosines (see directionCosines)
+    terms:      from _elementTerms
     
     return: scalar ArrayFactor (not normalized)
     """
-
-    dist = self.antennaSpacing 
-    k = 2 * pi / waveLength # k = wave numer
-    
+    u, v, w = direction
     cumulativeAF = 0
-    for n in range(0, len(self.antennaGrid)):
-      for m in range(0, len(self.antennaGrid[0])):
-        #exponential terms to calculate AF
-        costerm = k*dist*n*sin(theta)*cos(phi)
-        sinterm = k*dist*m*sin(theta)*sin(phi)
-        cumulativeAF += I[n][m] * exp(1j *(d[n][m] + costerm + sinterm))
+    for kx, ky, kz, c in terms:
+      cumulativeAF += c * exp(1j * (kx * u + ky * v + kz * w))
 
     return cumulativeAF
 
 
+  @timed("beamdef.calibration")
   def _applyCalibration(self, quadrant, setting, calMap):
     """ 
     Applies a calibration to a single setting _if the calibration map exists_
@@ -307,13 +577,34 @@ class BeamDefinition:
         PHASE_SETTING: [Measurement - Setting]
       }
     """
-    #load the dictionary raw
-    try:
-      with open(phaseCalFile, "r") as stream:
-        dataMap = yaml.safe_load(stream) #just assume its correct
-    except IOError: 
-      return None
-    return dataMap
+    return loadPhaseCal(phaseCalFile)
+
+  def setPhaseCal(self, calMap):
+    """
+      Swaps in a calibration map loaded elsewhere (see loadPhaseCal).
+      Settings are recalculated when next asked for.
+    """
+    self.phaseCal = calMap
+    self.phaseSettings = []
+    return
+
+
+def loadPhaseCal(phaseCalFile):
+  """
+    BeamDefinition.loadPhaseCal without a BeamDefinition, so the cal can be
+    read ahead of time (or on another thread). None or a missing file -> None
+  """
+  if phaseCalFile is None:
+    return None
+  #load the dictionary raw
+  try:
+    with open(phaseCalFile, "r") as stream:
+      #yaml takes longer to import than everything else here -- only when there's a cal
+      import yaml
+      dataMap = yaml.safe_load(stream) #just assume its correct
+  except IOError: 
+    return None
+  return dataMap
 
 
 ################################################################################
@@ -381,9 +672,59 @@ def testAfGen():
   b1.setAntenna( [[NE, NW, SE, SW]], [[ True, False, True, False]],5.4 * pow(10,-3))
   d2 = b1.generateAllAF()
 
+def testElementPositions():
+  """Explicit positions of the 1x4 grid must give the grid's answers"""
+  w = 3 * pow(10, 8) / (28 * pow(10,9))
+  d = 5.4 * pow(10,-3)
+  for t, p in [(30, 90), (10, 90), (20, 45), (0, 0)]:
+    grid = BeamDefinition(t, p, w, phaseCalFile="testPhaseCal.yaml")
+    grid.setAntenna([[NE, NW, SE, SW]], [[True, False, True, False]], d)
+    pos = BeamDefinition(t, p, w, phaseCalFile="testPhaseCal.yaml")
+    pos.setElementPositions(rectangularLattice(1, 4, d), [NE, NW, SE, SW], [True, False, True, False])
+    afGrid = grid.generateAllAF()
+    afPos = pos.generateAllAF()
+    print("({0}, {1}) grid {2} positions {3} AF max diff {4:.1e}".format(
+      t, p, grid.getPhaseSettings(), pos.getPhaseSettings(),
+      max(abs(a[2] - b[2]) for a, b in zip(afGrid, afPos))))
+
+  #an 8x8 triangular lattice: 64 elements, one setting each
+  tri = BeamDefinition(20, 30, w, phaseCalFile=None)
+  tri.setElementPositions(triangularLattice(8, 8, w / 2))
+  peak = max(tri.generateAllAF(n_theta=90, n_phi=90), key=lambda x: x[2])
+  print("triangular 8x8: {0} settings, peak at theta {1:.0f} phi {2:.0f}".format(
+    len(tri.getElementPhaseSettings()), peak[0], peak[1]))
+
+def testCuts():
+  """A phi cut must match generateAllAF's points in that plane, at a fraction of the cost"""
+  from time import perf_counter
+  w = 3 * pow(10, 8) / (28 * pow(10,9))
+  b = BeamDefinition(20, 90, w, phaseCalFile=None)
+  b.setElementPositions(rectangularLattice(8, 8, w / 2))
+  full = b.generateAllAF(n_theta=90, n_phi=4)
+  onCut = dict((t, a) for t, p, a in full if p == 90)
+  cut = b.phiCut(90, 0, 89, 1.0)
+  af_max = max(a for t, p, a in full)
+  scale = max(a for t, a in cut) / af_max
+  print("phi = 90 cut vs generateAllAF: max diff {0:.1e}".format(
+    max(abs(a * scale - onCut[t]) for t, a in cut)))
+
+  t0 = perf_counter()
+  b.phiCut(90, step=0.1)
+  b.phiCut(0, step=0.1)
+  tCut = perf_counter() - t0
+  t0 = perf_counter()
+  b.generateAllAF(n_theta=90, n_phi=360) #1 degree: the 0.1 degree sphere is 100x more
+  tFull = perf_counter() - t0
+  print("two 0.1 degree cuts {0:.1f} ms, 1 degree sphere {1:.0f} ms".format(1e3 * tCut, 1e3 * tFull))
+
+  gc = b.greatCircleCut(20, 90, heading=90, start=-10, stop=10, step=5)
+  print("across the beam: " + ", ".join("{0:+.0f} {1:.2f}".format(s, a) for s, a in gc))
+
 if __name__ == '__main__':
   beamDefTest = False
   afGenTest = True
+  positionTest = True
+  cutTest = True
 
   if beamDefTest:
     from time import time
@@ -394,3 +735,7 @@ if __name__ == '__main__':
     print("Total time elapsed: " + tt.__str__() + "s")
   if afGenTest:
     testAfGen()
+  if positionTest:
+    testElementPositions()
+  if cutTest:
+    testCuts()
@@ -0,0 +1,320 @@
+#-------------------------------------------------------------------------------
+# Name:        beammetrics
+# Purpose:     Beam figures of merit without a dense pattern: main lobe peak,
+#              3 dB beamwidths, peak sidelobe level and nulls
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# python3 beammetrics.py                                  4x1, theta 0-60, phi 90
+# python3 beammetrics.py --antenna 2x2 --theta 0:61:5 --phi 0:360:15 --quantized
+# python3 beammetrics.py --antenna 2x2 --check            against a dense grid
+#
+# m = beamDef.getBeamMetrics()              #BeamMetrics of the current beam
+# grid = MetricsGrid(positions, waveLength) #share one between many beams
+# codebookMetrics(beamDef, codebook)
+#
+# generateAllAF samples the whole hemisphere finely just to find af_max. Here
+# the pattern is sampled on a coarse grid (step about half a beamwidth, from
+# the array's size), which is enough to find every lobe; the lobes are then
+# refined off the grid:
+#
+#   peak        climb the coarse grid from the requested direction, then a
+#               pattern search from there and from the requested direction
+#   beamwidth   two great circle cuts through the peak, along theta and
+#               along phi, walked outwards until the half power point, which
+#               is then bisected
+#   nulls       local minima along the cuts, refined by golden section
+#               search; the first one each side bounds the main lobe
+#   sidelobes   maxima along the cuts past the first null, and local maxima
+#               of the coarse grid outside the main lobe (PatternGrid.mainLobe),
+#               each refined
+#
+# For a linear array the main lobe is a cone; "outside the main lobe" is then
+# measured as angle off broadside (beamcompare.PatternGrid.pointingError).
+#-------------------------------------------------------------------------------
+
+import sys
+from collections import namedtuple
+from cmath import exp
+from math import sin, cos, acos, atan2, radians, degrees, log10, sqrt, ceil
+
+from beamdef import directionCosines
+from beamcompare import PatternGrid
+
+#metrics of one beam, angles in degrees
+#   theta, phi          requested direction
+#   peakTheta, peakPhi  main lobe peak;  peakAf its |AF| (not normalized)
+#   pointingError       requested direction to peak (see PatternGrid.pointingError)
+#   beamwidthTheta      3 dB width of the cut along theta through the peak,
+#   beamwidthPhi        and of the one across it; None if it doesn't close
+#   sidelobeDb          peak sidelobe level relative to the peak (None: no sidelobe)
+#   sidelobeTheta/Phi   where it is
+#   nulls               [(theta, phi, levelDb)] minima along the cuts deeper
+#                       than nullDb, nearest the peak first
+BeamMetrics = namedtuple('BeamMetrics', ['theta', 'phi', 'peakTheta', 'peakPhi', 'peakAf', 'pointingError',
+                                         'beamwidthTheta', 'beamwidthPhi', 'sidelobeDb',
+                                         'sidelobeTheta', 'sidelobePhi', 'nulls'])
+
+_GOLDEN = (sqrt(5) - 1) / 2
+
+def _toAngles(d):
+  """(theta, phi) degrees of a unit vector"""
+  u, v, w = d
+  return degrees(acos(max(-1.0, min(1.0, w)))), degrees(atan2(v, u)) % 360
+
+def _db(a, peak):
+  return 20 * log10(a / peak) if a > 0 else -300.0
+
+class MetricsGrid:
+  """
+  The coarse direction grid of one array, shared between beams
+
+  step      coarse grid spacing in degrees; default half the array's
+            beamwidth, between 2 and 15 degrees
+  cutStep   spacing of the samples along the cuts; default step / 4
+  nullDb    minima shallower than this (dB below the peak) aren't reported
+  maxLobes  coarse sidelobe candidates refined per beam
+  """
+
+  def __init__(self, positions, waveLength, step=None, cutStep=None, nullDb=-20.0,
+               maxLobes=8, backLobes=False):
+    if step is None:
+      extent = sqrt(sum((max(p[i] for p in positions) - min(p[i] for p in positions)) ** 2 for i in range(3)))
+      step = degrees(waveLength / (2 * extent)) if extent > 0 else 15.0
+      step = min(max(step, 2.0), 15.0)
+    self.step = step
+    self.cutStep = cutStep or max(step / 4, 0.25)
+    self.nullDb = nullDb
+    self.maxLobes = maxLobes
+    self.backLobes = backLobes
+    tMax = 180 if backLobes else 90
+    self.grid = PatternGrid(positions, waveLength, int(ceil(tMax / step)), int(ceil(360 / step)), backLobes)
+    self.scaled = self.grid.scaled
+
+  def arrayFactorAt(self, weights, d):
+    """|AF| towards unit vector d"""
+    u, v, w = d
+    return abs(sum(c * exp(1j * (kx * u + ky * v + kz * w)) for (kx, ky, kz), c in zip(self.scaled, weights)))
+
+  #-----------------------------------------------------------------------------
+  # cuts
+  #-----------------------------------------------------------------------------
+  def _cutDirection(self, u0, e, s):
+    """s degrees from u0 along the great circle towards e"""
+    c, sn = cos(radians(s)), sin(radians(s))
+    return tuple(c * a + sn * b for a, b in zip(u0, e))
+
+  def _golden(self, f, a, b, tol=1e-3):
+    """(x, f(x)) minimizing f between a and b"""
+    x1 = b - _GOLDEN * (b - a)
+    x2 = a + _GOLDEN * (b - a)
+    f1, f2 = f(x1), f(x2)
+    while b - a > tol:
+      if f1 < f2:
+        b, x2, f2 = x2, x1, f1
+        x1 = b - _GOLDEN * (b - a)
+        f1 = f(x1)
+      else:
+        a, x1, f1 = x1, x2, f2
+        x2 = a + _GOLDEN * (b - a)
+        f2 = f(x2)
+    return (x1, f1) if f1 < f2 else (x2, f2)
+
+  def _side(self, weights, u0, e, peak):
+    """
+      one half of a cut: (half power angle or None, [(s, |AF|) minima],
+      (s, |AF|) of the highest maximum past the first minimum or None)
+    """
+    af = lambda s: self.arrayFactorAt(weights, self._cutDirection(u0, e, s))
+    samples = [(0.0, peak)]
+    s = self.cutStep
+    while s <= 180:
+      d = self._cutDirection(u0, e, s)
+      if d[2] < 0 and not self.backLobes:
+        break
+      samples.append((s, self.arrayFactorAt(weights, d)))
+      s += self.cutStep
+
+    halfPower = peak / sqrt(2)
+    half = None
+    for (s0, a0), (s1, a1) in zip(samples, samples[1:]):
+      if a1 < halfPower:
+        while s1 - s0 > 1e-3:
+          m = (s0 + s1) / 2
+          if af(m) < halfPower:
+            s1 = m
+          else:
+            s0 = m
+        half = (s0 + s1) / 2
+        break
+
+    minima = []
+    for i in range(1, len(samples) - 1):
+      if samples[i][1] <= samples[i - 1][1] and samples[i][1] < samples[i + 1][1]:
+        minima.append(self._golden(af, samples[i - 1][0], samples[i + 1][0]))
+
+    #ripple on a linear array's ridge isn't a null: the main lobe ends at
+    #the first minimum past the half power point
+    minima = [m for m in minima if half is not None and m[0] > half]
+    lobe = None
+    if minima:
+      past = [x for x in samples if x[0] > minima[0][0]]
+      if past:
+        i = samples.index(max(past, key=lambda x: x[1]))
+        if 0 < i < len(samples) - 1:
+          s, a = self._golden(lambda s: -af(s), samples[i - 1][0], samples[i + 1][0])
+          lobe = (s, -a)
+        else:
+          lobe = samples[i]
+    return half, minima, lobe
+
+  #-----------------------------------------------------------------------------
+  # metrics
+  #-----------------------------------------------------------------------------
+  def metrics(self, weights, theta, phi):
+    """BeamMetrics of element excitations weights steered at theta/phi (degrees)"""
+    grid = self.grid
+    if theta < 0:
+      theta, phi = -theta, phi + 180
+    phi = phi % 360
+
+    #peak: coarse climb, then refine from there and from the request
+    coarse = grid.arrayFactor(weights)
+    start = grid.climb(coarse, grid.nearest(theta, phi))
+    candidates = [grid.refinePeak(weights, theta, phi, step=self.step / 2),
+                  grid.refinePeak(weights, grid.directions[start][0], grid.directions[start][1], step=self.step / 2)]
+    peakTheta, peakPhi, peak = max(candidates, key=lambda c: c[2])
+    if peak <= 0:
+      return BeamMetrics(theta, phi, peakTheta, peakPhi, peak, None, None, None, None, None, None, [])
+
+    #cuts along theta and along phi through the peak
+    t, p = radians(peakTheta), radians(peakPhi)
+    u0 = directionCosines(t, p)
+    eTheta = (cos(t) * cos(p), cos(t) * sin(p), -sin(t))
+    ePhi = (-sin(p), cos(p), 0.0)
+    widths = []
+    nulls = []
+    cutLobes = []
+    firstNulls = []
+    for e in (eTheta, ePhi):
+      halves = []
+      for sign in (1, -1):
+        direction = tuple(sign * c for c in e)
+        half, minima, lobe = self._side(weights, u0, direction, peak)
+        halves.append(half)
+        if minima:
+          firstNulls.append(minima[0][0])
+        for s, a in minima:
+          if _db(a, peak) <= self.nullDb:
+            nulls.append((s, _toAngles(self._cutDirection(u0, direction, s)) + (_db(a, peak),)))
+        if lobe is not None:
+          cutLobes.append(_toAngles(self._cutDirection(u0, direction, lobe[0])) + (lobe[1],))
+      widths.append(sum(halves) if None not in halves else None)
+
+    #sidelobes off the cuts: coarse grid maxima outside the coarse main lobe
+    #that don't climb back into it when refined (the lobe needn't be round:
+    #its nearest null bounds it)
+    radius = min(firstNulls) if firstNulls else self.step
+    mainLobe = grid.mainLobe(coarse, start)
+    maxima = [n for n, a in enumerate(coarse)
+              if n not in mainLobe and all(a >= coarse[m] for m in grid.neighbours[n])]
+    maxima.sort(key=lambda n: coarse[n], reverse=True)
+    sidelobeOk = lambda x: x[2] < peak * (1 - 1e-6) and grid.pointingError(peakTheta, peakPhi, x[0], x[1]) > radius
+    lobes = [x for x in cutLobes if sidelobeOk(x)]
+    for n in maxima[:self.maxLobes]:
+      #the coarse grid samples every lobe within 6 dB of its peak, so lower
+      #ones can't beat the best found so far
+      if lobes and coarse[n] < max(x[2] for x in lobes) / 2:
+        break
+      lobe = grid.refinePeak(weights, grid.directions[n][0], grid.directions[n][1], step=self.step / 2)
+      if sidelobeOk(lobe):
+        lobes.append(lobe)
+    sidelobe = max(lobes, key=lambda x: x[2]) if lobes else None
+
+    nulls.sort(key=lambda x: x[0])
+    return BeamMetrics(theta, phi, peakTheta, peakPhi, peak,
+                       grid.pointingError(theta, phi, peakTheta, peakPhi), widths[0], widths[1],
+                       _db(sidelobe[2], peak) if sidelobe else None,
+                       sidelobe[0] if sidelobe else None, sidelobe[1] if sidelobe else None,
+                       [x[1] for x in nulls])
+
+def beamMetrics(beamDef, quantized=False, grid=None):
+  """
+    BeamMetrics of beamDef's current beam; quantized as for generateAllAF.
+    grid (a MetricsGrid of the same array) saves building one
+  """
+  if grid is None:
+    grid = MetricsGrid(beamDef.getElementPositions(), beamDef.waveLength)
+  return grid.metrics(beamDef.getElementWeights(quantized), degrees(beamDef.theta), degrees(beamDef.phi))
+
+def codebookMetrics(beamDef, codebook, quantized=False, **options):
+  """[BeamMetrics] for every (theta, phi) of codebook (degrees). beamDef is re-pointed"""
+  grid = MetricsGrid(beamDef.getElementPositions(), beamDef.waveLength, **options)
+  results = []
+  for theta, phi in codebook:
+    beamDef.setDirection(theta, phi)
+    results.append(beamMetrics(beamDef, quantized, grid))
+  return results
+
+
+# ------------------------------------------------------------------------------
+# MAIN PROGRAM
+# ------------------------------------------------------------------------------
+def _fmt(x, f="{0:5.1f}"):
+  return "   --" if x is None else f.format(x)
+
+def _dense(beamDef, quantized, res):
+  """(peak theta, peak phi, sidelobe dB) from a dense generateAllAF style grid"""
+  grid = PatternGrid(beamDef.getElementPositions(), beamDef.waveLength, res, 2 * res)
+  w = beamDef.getElementWeights(quantized)
+  af = grid.arrayFactor(w)
+  peak = grid.climb(af, grid.nearest(degrees(beamDef.theta), degrees(beamDef.phi)))
+  return grid.directions[peak] + (grid.peakSidelobeDb(af, peak),)
+
+def main(argv=None):
+  import argparse
+  import time
+  from beamcli import BeamEngine, ANTENNAS, DEFAULT_FREQ_GHZ, frange
+
+  parser = argparse.ArgumentParser(description="awmf-0108 beam metrics")
+  parser.add_argument("--freq", type=float, default=DEFAULT_FREQ_GHZ, help="GHz")
+  parser.add_argument("--antenna", choices=sorted(ANTENNAS), default="4x1")
+  parser.add_argument("--cal", default="phaseCal.yaml", help="phase cal yaml")
+  parser.add_argument("--theta", default="0:61:5", help="start:stop:step degrees")
+  parser.add_argument("--phi", default="90", help="start:stop:step degrees")
+  parser.add_argument("--quantized", action="store_true", help="pattern of the register values")
+  parser.add_argument("--check", type=int, nargs="?", const=90, metavar="RES",
+                      help="also find peak and sidelobes on a dense RES x 2 RES grid")
+  args = parser.parse_args(argv)
+
+  beamDef = BeamEngine(args.freq, args.antenna, args.cal).beamDef
+  codebook = [(t, p) for t in frange(args.theta) for p in frange(args.phi)]
+  t0 = time.perf_counter()
+  results = codebookMetrics(beamDef, codebook, args.quantized)
+  elapsed = time.perf_counter() - t0
+
+  print(" theta   phi   peak theta   phi  point  bw(th)  bw(ph)    SLL  nulls" +
+        ("   dense: theta   phi    SLL" if args.check else ""))
+  denseTime = 0
+  for r in results:
+    line = "{0:6.1f} {1:5.1f}  {2:11.2f} {3:5.1f}  {4}   {5}   {6}  {7}  {8:5}".format(
+      r.theta, r.phi, r.peakTheta, r.peakPhi, _fmt(r.pointingError, "{0:4.2f}"),
+      _fmt(r.beamwidthTheta), _fmt(r.beamwidthPhi), _fmt(r.sidelobeDb), len(r.nulls))
+    if args.check:
+      beamDef.setDirection(r.theta, r.phi)
+      t1 = time.perf_counter()
+      dt, dp, dsl = _dense(beamDef, args.quantized, args.check)
+      denseTime += time.perf_counter() - t1
+      line += "   {0:11.1f} {1:5.1f}  {2}".format(dt, dp, _fmt(dsl))
+    print(line)
+  sys.stderr.write("{0} beams in {1:.0f} ms ({2:.2f} ms a beam)".format(
+    len(results), 1e3 * elapsed, 1e3 * elapsed / max(len(results), 1)))
+  if args.check:
+    sys.stderr.write(", dense grid {0:.0f} ms".format(1e3 * denseTime))
+  sys.stderr.write("\n")
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,262 @@
+#-------------------------------------------------------------------------------
+# Name:        beampanel
+# Purpose:     Panels tiled from many awmf-0108s: per chip settings, their
+#              place on the SPI chain, and the pattern as chip lattice factor
+#              times subarray factor
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# Every chip drives the same four element subarray (the NE/SE/SW/NW
+# quadrants), sitting at its own point of the chip lattice. The array
+# factor in direction u is then
+#
+#   AF(u) = sum over chips i of  e^(jk R_i.u) S_i(u)
+#   S_i(u) = sum over the chip's elements e of  w_ie e^(jk r_e.u)
+#
+# R_i the chip position, r_e the element position within the chip. S_i only
+# depends on chip i's four settings, so it is worked out once per distinct
+# setting vector (and cached between calls), and a direction costs
+# chips + (distinct chips x elements per chip) instead of chips x elements.
+# With ideal=True (unquantized phases) the weights factor exactly and every
+# chip shares one S.
+#
+# Logical chip i is chipPositions[i]; chainOrder[i] is its place on the SPI
+# daisy chain, as for fake_spiwrite.ChainFrameBuilder.
+#-------------------------------------------------------------------------------
+
+from collections import namedtuple, OrderedDict
+from math import pi, radians
+from cmath import exp
+
+from beamdef import (BeamDefinition, NE, SE, SW, NW, afDirections, directionCosines,
+                     rectangularLattice, steeringPhases)
+
+#element layout of one chip, positions relative to the chip's reference point
+#   positions   [(x, y, z)] meters
+#   channels    awmf-0108 channel driving each element
+#   invert      True for elements fed in antiphase
+Subarray = namedtuple('Subarray', ['positions', 'channels', 'invert'])
+
+def quadSubarray(spacing=5.4e-3):
+  """the 2x2 layout of the demo board: [[NW, NE], [SW, SE]], west column inverted"""
+  return Subarray([(0.0, 0.0, 0.0), (0.0, spacing, 0.0), (spacing, 0.0, 0.0), (spacing, spacing, 0.0)],
+                  [NW, NE, SW, SE], [True, False, True, False])
+
+def chipLattice(nx, ny, pitch):
+  """chip reference points of an nx by ny tiling"""
+  return rectangularLattice(nx, ny, pitch)
+
+class TiledPanel:
+  """
+  panel = TiledPanel(chipLattice(8, 8, 10.8e-3), quadSubarray(5.4e-3))
+  settings = panel.chipSettings(20, 90, waveLength)   #[NE, SE, SW, NW] per chip
+  panel.program(awmf, RX_MODE, settings, amp=8)       #one chain transaction
+  panel.pattern(settings, waveLength)                 #like generateAllAF
+
+  cacheSize   distinct subarray factors kept between pattern calls
+  """
+
+  def __init__(self, chipPositions, subarray=None, chainOrder=None, phaseCalFile=None, cacheSize=64):
+    self.chipPositions = [tuple(float(c) for c in p) + (0.0,) * (3 - len(p)) for p in chipPositions]
+    self.subarray = subarray or quadSubarray()
+    self.nChips = len(self.chipPositions)
+    if chainOrder is None:
+      chainOrder = list(range(self.nChips))
+    if sorted(chainOrder) != list(range(self.nChips)):
+      raise ValueError("chainOrder must be a permutation of range(nChips)")
+    self.chainOrder = list(chainOrder)
+    self.phaseCalFile = phaseCalFile
+    self.cacheSize = cacheSize
+    self._subCache = OrderedDict() #(settings, waveLength, directions) -> [S(u)]
+    self._flat = None              #BeamDefinition over every element, for chipSettings
+
+  #-----------------------------------------------------------------------------
+  # layout
+  #-----------------------------------------------------------------------------
+  def elementPositions(self):
+    """every element of the panel, chip by chip (logical order)"""
+    return [(X + x, Y + y, Z + z) for X, Y, Z in self.chipPositions for x, y, z in self.subarray.positions]
+
+  def chainPosition(self, chip):
+    """SPI chain position of logical chip (0 = the chip wired to MOSI)"""
+    return self.chainOrder[chip]
+
+  #-----------------------------------------------------------------------------
+  # settings and programming
+  #-----------------------------------------------------------------------------
+  def chipSettings(self, theta, phi, waveLength):
+    """
+      [NE, SE, SW, NW] awmf-0108 phase settings of every logical chip to point
+      at theta/phi (degrees)
+    """
+    if self._flat is None:
+      self._flat = BeamDefinition(theta, phi, waveLength, phaseCalFile=self.phaseCalFile)
+      self._flat.setElementPositions(self.elementPositions(),
+                                     self.subarray.channels * self.nChips,
+                                     self.subarray.invert * self.nChips)
+    else:
+      self._flat.waveLength = waveLength
+      self._flat.setDirection(theta, phi)
+    flat = self._flat.getElementPhaseSettings()
+    n = len(self.subarray.positions)
+    settings = []
+    for chip in range(self.nChips):
+      byChannel = dict(zip(self.subarray.channels, flat[chip * n:(chip + 1) * n]))
+      settings.append([byChannel[x] for x in [NE, SE, SW, NW]])
+    return settings
+
+  def chainBeams(self, settings, amp=0):
+    """
+      setChainBeams beams for settings: logical order, amp the attenuation
+      setting for every channel. The commander's chainOrder puts them on the
+      chain (see makeCommander)
+    """
+    return [tuple(s) + (amp,) * 4 for s in settings]
+
+  def makeCommander(self, resourceName=None, lib=None, **kwargs):
+    """an AwmfCommander whose chain matches this panel"""
+    from fake_spiwrite import AwmfCommander
+    return AwmfCommander(resourceName, lib=lib, chainLength=self.nChips, chainOrder=self.chainOrder, **kwargs)
+
+  def program(self, commander, mode, settings, amp=0, force=False):
+    """every chip in one transaction (AwmfCommander.setChainBeams)"""
+    if commander.chain.nChips != self.nChips or commander.chain.chainOrder != self.chainOrder:
+      raise ValueError("commander chain doesn't match the panel (see makeCommander)")
+    return commander.setChainBeams(mode, self.chainBeams(settings, amp), force)
+
+  #-----------------------------------------------------------------------------
+  # pattern
+  #-----------------------------------------------------------------------------
+  def pattern(self, settings, waveLength, n_theta=30, n_phi=30, normalized=True, backLobes=False):
+    """
+      |AF| of the panel programmed with settings (per chip [NE, SE, SW, NW]),
+      as generateAllAF's [(theta, phi, af)]
+    """
+    step = 2 * pi / 32
+    sub = self.subarray
+    chipKeys = []
+    weights = {}
+    for s in settings:
+      byChannel = dict(zip([NE, SE, SW, NW], s))
+      #the antiphase feed undoes the inverting pi in the setting
+      key = tuple(byChannel[ch] * step - (pi if inv else 0.0) for ch, inv in zip(sub.channels, sub.invert))
+      chipKeys.append(key)
+      weights[key] = [exp(1j * ph) for ph in key]
+    return self._pattern(chipKeys, weights, [1.0] * self.nChips, waveLength,
+                         n_theta, n_phi, normalized, backLobes)
+
+  def idealPattern(self, theta, phi, waveLength, n_theta=30, n_phi=30, normalized=True, backLobes=False):
+    """
+      |AF| steered with unquantized phases: chip factor x one shared subarray
+      factor, the pattern the settings approximate
+    """
+    t, p = radians(theta), radians(phi)
+    chipPhases = steeringPhases(self.chipPositions, waveLength, t, p)
+    elementPhases = steeringPhases(self.subarray.positions, waveLength, t, p)
+    key = ("ideal",) + tuple(elementPhases)
+    weights = {key: [exp(1j * ph) for ph in elementPhases]}
+    return self._pattern([key] * self.nChips, weights, [exp(1j * ph) for ph in chipPhases], waveLength,
+                         n_theta, n_phi, normalized, backLobes)
+
+  def _pattern(self, chipKeys, weights, chipWeights, waveLength, n_theta, n_phi, normalized, backLobes):
+    directions = afDirections(n_theta, n_phi, backLobes)
+    cosines = [directionCosines(radians(t), radians(p)) for t, p in directions]
+    gridKey = (waveLength, n_theta, n_phi, backLobes)
+
+    #subarray factor over every direction, once per distinct chip setting
+    subFactors = {}
+    for key, w in weights.items():
+      subFactors[key] = self._subarrayFactor(key, w, waveLength, gridKey, cosines)
+
+    k = 2 * pi / waveLength
+    #chips sharing a setting share S(u): add their lattice terms up first
+    groups = {}
+    for (X, Y, Z), key, c in zip(self.chipPositions, chipKeys, chipWeights):
+      groups.setdefault(key, []).append((k * X, k * Y, k * Z, c))
+
+    points = []
+    for n, (u, v, w) in enumerate(cosines):
+      a = 0
+      for key, chips in groups.items():
+        lattice = 0
+        for kx, ky, kz, c in chips:
+          lattice += c * exp(1j * (kx * u + ky * v + kz * w))
+        a += lattice * subFactors[key][n]
+      points.append(abs(a))
+
+    af_max = max(points) if normalized else 1.0
+    af_max = af_max or 1.0
+    return [(t, p, a / af_max) for (t, p), a in zip(directions, points)]
+
+  def _subarrayFactor(self, key, w, waveLength, gridKey, cosines):
+    cacheKey = (key, gridKey)
+    factor = self._subCache.get(cacheKey)
+    if factor is not None:
+      self._subCache.move_to_end(cacheKey)
+      return factor
+    k = 2 * pi / waveLength
+    terms = [(k * x, k * y, k * z, c) for (x, y, z), c in zip(self.subarray.positions, w)]
+    factor = []
+    for u, v, w3 in cosines:
+      s = 0
+      for kx, ky, kz, c in terms:
+        s += c * exp(1j * (kx * u + ky * v + kz * w3))
+      factor.append(s)
+    self._subCache[cacheKey] = factor
+    while len(self._subCache) > self.cacheSize:
+      self._subCache.popitem(last=False)
+    return factor
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  import time
+  waveLength = 3 * pow(10, 8) / (28 * pow(10, 9))
+  d = 5.4e-3
+  panel = TiledPanel(chipLattice(8, 8, 2 * d), quadSubarray(d), chainOrder=list(reversed(range(64))))
+  flat = BeamDefinition(20, 90, waveLength, phaseCalFile=None)
+  flat.setElementPositions(panel.elementPositions())
+
+  for theta, phi in [(0, 0), (20, 90), (30, 45)]:
+    settings = panel.chipSettings(theta, phi, waveLength)
+    distinct = len(set(tuple(s) for s in settings))
+
+    panel._subCache.clear()
+    t0 = time.perf_counter()
+    tiled = panel.idealPattern(theta, phi, waveLength)
+    tTiled = time.perf_counter() - t0
+    flat.setDirection(theta, phi)
+    t0 = time.perf_counter()
+    direct = flat.generateAllAF()
+    tFlat = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    panel.pattern(settings, waveLength)
+    tQuant = time.perf_counter() - t0
+    print("({0:2}, {1:2}) 256 elements: flat {2:6.1f} ms, tiled {3:5.1f} ms, max diff {4:.1e}; "
+          "quantized {5} distinct chips {6:5.1f} ms".format(
+      theta, phi, 1e3 * tFlat, 1e3 * tTiled,
+      max(abs(a[2] - b[2]) for a, b in zip(tiled, direct)), distinct, 1e3 * tQuant))
+
+  #all chips the same: the subarray factor comes from the cache the second time
+  same = [[3, 7, 11, 15]] * panel.nChips
+  panel.pattern(same, waveLength)
+  t0 = time.perf_counter()
+  panel.pattern(same, waveLength)
+  print("identical chips, cached subarray: {0:.1f} ms".format(1e3 * (time.perf_counter() - t0)))
+
+  from awmfemu import emulatedLib
+  from fake_spiwrite import RX_MODE
+  lib, chip = emulatedLib()
+  awmf = panel.makeCommander(lib=lib)
+  awmf.initSpi()
+  panel.program(awmf, RX_MODE, panel.chipSettings(20, 90, waveLength), amp=8)
+  print("programmed 64 chips, logical chip 0 at chain position {0}".format(panel.chainPosition(0)))
+  awmf.closeSPI()
+
+if __name__ == '__main__':
+  main()
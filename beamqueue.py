@@ -0,0 +1,175 @@
+#-------------------------------------------------------------------------------
+# Name:        beamqueue
+# Purpose:     Non-blocking front end for AwmfCommander: beam commands are
+#              queued and written by a dedicated I/O thread
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+import threading
+import time
+import asyncio
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+
+from fake_spiwrite import AwmfCommander
+
+#what a beam command resolves to
+#   readBack    data returned by setBeam (None if superseded)
+#   queued      seconds between submit and the start of the write
+#   ioTime      seconds spent inside setBeam
+#   latency     seconds between submit and completion
+#   superseded  True if a newer command for the same chip replaced this one
+BeamResult = namedtuple('BeamResult', ['readBack', 'queued', 'ioTime', 'latency', 'superseded'])
+
+class _Command:
+  """one pending beam for one chip (None = every chip)"""
+  def __init__(self, chip, args, submitted, future):
+    self.chip = chip
+    self.args = args
+    self.submitted = submitted
+    self.future = future
+
+class BeamQueue:
+  """
+  Accepts beam commands from any thread and writes them on an I/O thread
+
+  q = BeamQueue(AwmfCommander())
+  f = q.submit(RX_MODE, 1, 2, 3, 4, 8, 8, 8, 8, callback=done)
+  f.result()   #BeamResult, or raises SpiInitException
+
+  Commands for the same chip coalesce: if a command is still waiting when a
+  newer one arrives, only the newer one is written and the old future
+  resolves straight away with superseded=True.
+
+  chip=None (the default) writes the beam to every chip on the chain, like
+  AwmfCommander.setBeam. A chip number writes only that chip of the chain
+  (AwmfCommander.setChipBeam); the others keep what they have latched.
+  """
+
+  def __init__(self, commander, start=True):
+    self.commander = commander
+    self._pending = OrderedDict() #chip -> _Command, oldest first
+    self._cond = threading.Condition()
+    self._running = False
+    self._thread = None
+    if start:
+      self.start()
+
+  def start(self):
+    with self._cond:
+      if self._running:
+        return
+      self._running = True
+    self._thread = threading.Thread(target=self._run, name="BeamQueue", daemon=True)
+    self._thread.start()
+
+  def stop(self, wait=True):
+    """stops the I/O thread after the command in flight. Pending ones are cancelled"""
+    with self._cond:
+      self._running = False
+      pending = list(self._pending.values())
+      self._pending.clear()
+      self._cond.notify_all()
+    for cmd in pending:
+      cmd.future.cancel()
+    if wait and self._thread is not None and self._thread is not threading.current_thread():
+      self._thread.join()
+
+  def pendingCount(self):
+    with self._cond:
+      return len(self._pending)
+
+  def submit(self, mode, NE_phase, SE_phase, SW_phase, NW_phase,
+                   NE_amp, SE_amp, SW_amp, NW_amp, chip=None, callback=None):
+    """
+    Queues a setBeam for chip (None = all of them). Returns a concurrent.futures.Future
+    callback(future) runs on the I/O thread once the future is resolved
+    """
+    future = Future()
+    if callback is not None:
+      future.add_done_callback(callback)
+    now = time.perf_counter()
+    cmd = _Command(chip, (mode, NE_phase, SE_phase, SW_phase, NW_phase,
+                    NE_amp, SE_amp, SW_amp, NW_amp), now, future)
+
+    with self._cond:
+      if not self._running:
+        raise RuntimeError("BeamQueue is stopped")
+      old = self._pending.pop(chip, None)
+      self._pending[chip] = cmd
+      self._cond.notify()
+
+    if old is not None and old.future.set_running_or_notify_cancel():
+      old.future.set_result(BeamResult(None, 0.0, 0.0, now - old.submitted, True))
+    return future
+
+  async def setBeamAsync(self, *args, **kwargs):
+    """asyncio flavour of submit(): awaits the BeamResult"""
+    return await asyncio.wrap_future(self.submit(*args, **kwargs))
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while self._running and not self._pending:
+          self._cond.wait()
+        if not self._running:
+          return
+        _, cmd = self._pending.popitem(last=False)
+
+      if not cmd.future.set_running_or_notify_cancel():
+        continue
+
+      start = time.perf_counter()
+      try:
+        if cmd.chip is None:
+          readBack = self.commander.setBeam(*cmd.args)
+        else:
+          readBack = self.commander.setChipBeam(cmd.chip, *cmd.args)
+      except Exception as e:
+        cmd.future.set_exception(e)
+        continue
+      end = time.perf_counter()
+      cmd.future.set_result(BeamResult(readBack, start - cmd.submitted, end - start,
+                                       end - cmd.submitted, False))
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  from awmfemu import emulatedLib
+  from fake_spiwrite import RX_MODE
+
+  lib, chip = emulatedLib(realTime=True)
+  awmf = AwmfCommander(lib=lib)
+  awmf.initSpi()
+
+  q = BeamQueue(awmf)
+  futures = [q.submit(RX_MODE, n % 32, 0, 0, 0, 8, 8, 8, 8) for n in range(100)]
+  results = [f.result() for f in futures]
+  q.stop()
+
+  written = [r for r in results if not r.superseded]
+  print("submitted {0}, written {1}".format(len(results), len(written)))
+  print("last beam on chip: {0}".format(chip.getActiveChannels()))
+  print("worst latency: {0:.2f} ms".format(1e3 * max(r.latency for r in written)))
+  awmf.closeSPI()
+
+  #two chips on one chain: a beam for one leaves the other alone
+  from ni845xsim import Ni845xSim
+  from awmfemu import Awmf0108Chain
+  lib, chain = Ni845xSim(), Awmf0108Chain(2)
+  lib.attach(chain)
+  awmf = AwmfCommander(lib=lib, chainLength=2)
+  awmf.initSpi()
+  q = BeamQueue(awmf)
+  q.submit(RX_MODE, 1, 1, 1, 1, 8, 8, 8, 8).result()
+  q.submit(RX_MODE, 5, 5, 5, 5, 8, 8, 8, 8, chip=0).result()
+  q.submit(RX_MODE, 9, 9, 9, 9, 8, 8, 8, 8, chip=1).result()
+  q.stop()
+  print("chain: {0}".format([c.getActiveChannels()["NE"] for c in chain.chips]))
+  awmf.closeSPI()
+
+if __name__ == '__main__':
+  main()
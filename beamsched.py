@@ -0,0 +1,299 @@
+#-------------------------------------------------------------------------------
+# Name:        beamsched
+# Purpose:     Fire a precomputed beam-hopping schedule at requested times
+#              and report how far off the switches landed
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+import time
+from math import sqrt
+
+#an entry of the schedule
+#   t       seconds after the start of the run
+#   mode    SB/TX/RX/RX_11 mode
+#   beams   setBeam settings (NE_phase, ..., NW_amp) for one chip, or a list
+#           of them for every chip of a daisy chain
+def scheduleEntry(t, mode, beams):
+  return (t, mode, beams)
+
+def sleepUntil(target, spinTime=2e-3):
+  """coarse sleep, then spin on perf_counter for the last spinTime. Returns the wake time"""
+  while True:
+    now = time.perf_counter()
+    left = target - now
+    if left <= 0:
+      return now
+    if left > spinTime:
+      time.sleep(left - spinTime)
+
+class JitterStats:
+  """
+  Achieved-minus-requested switch times
+
+  stats.add(requested, achieved)
+  stats.add(requested, achieved, modeled=True)  #achieved worked out, not timed
+  stats.histogram()  -> [(bin start in us, count), ...]
+  stats.summary()    -> dict of mean/std/percentiles in us
+  """
+
+  def __init__(self, binUs=10.0):
+    self.binUs = binUs
+    self.errors = [] #seconds, positive = late
+    self.modeled = 0 #how many of them come from a model rather than a clock
+
+  def add(self, requested, achieved, modeled=False):
+    self.errors.append(achieved - requested)
+    if modeled:
+      self.modeled += 1
+
+  def histogram(self):
+    bins = {}
+    for e in self.errors:
+      b = int((e * 1e6) // self.binUs)
+      bins[b] = bins.get(b, 0) + 1
+    return [(b * self.binUs, bins[b]) for b in sorted(bins)]
+
+  def percentile(self, p):
+    if not self.errors:
+      return 0.0
+    s = sorted(self.errors)
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+  def summary(self):
+    n = len(self.errors)
+    if n == 0:
+      return {"n": 0}
+    mean = sum(self.errors) / n
+    std = sqrt(sum((e - mean) ** 2 for e in self.errors) / n)
+    return {"n": n,
+            "modeled": self.modeled,
+            "meanUs": 1e6 * mean,
+            "stdUs": 1e6 * std,
+            "p50Us": 1e6 * self.percentile(50),
+            "p99Us": 1e6 * self.percentile(99),
+            "maxAbsUs": 1e6 * max(abs(e) for e in self.errors)}
+
+  def report(self):
+    """histogram as text, one bar per bin"""
+    hist = self.histogram()
+    if not hist:
+      return "no samples"
+    peak = max(count for _, count in hist)
+    lines = ["{0:>9.0f} us |{1:<40}| {2}".format(start, "#" * int(40 * count / peak), count)
+             for start, count in hist]
+    if self.modeled:
+      lines.append("{0} of {1} achieved times modeled from the adapter script timing, not measured".format(
+        self.modeled, len(self.errors)))
+    return "\n".join(lines)
+
+
+class BeamScheduler:
+  """
+  Plays a schedule of (t, mode, beams) entries through an AwmfCommander
+
+  sched = BeamScheduler(awmf, schedule)   #packs every frame up front
+  stats = sched.run()                     #JitterStats
+
+  Entries closer together than usbRtt can't be hit one USB round trip at a
+  time, so they are sent as one adapter script (commitSequence) whose gaps
+  are timed by the adapter. Each batch's script is built before its send
+  time (prepareSequence), so only running it is on the critical path.
+
+  Each send starts early by the lead, to cover the time between the call and
+  the first latch. A fixed lead (seconds) can be given; with lead=None it is
+  seeded per path (single frame or batch) by a warm-up transaction before
+  the run, which writes the first entry's beam early, and then learnt from
+  every send.
+
+  latchClock() returns the perf_counter times of the LDB strobes since it
+  was last called (Ni845xSim.takeStrobeTimes for the simulator, or a
+  hardware capture). With it every switch time is measured. Without it a
+  single frame counts as switched when commitFrame returns, and a batch's
+  entries are worked back from the end of the script through the frame and
+  gap timing: those are counted as modeled in the JitterStats.
+  """
+
+  def __init__(self, commander, schedule, usbRtt=1e-3, lead=None, spinTime=2e-3,
+               maxBatch=64, binUs=10.0, latchClock=None):
+    self.commander = commander
+    self.usbRtt = usbRtt
+    self.lead = lead
+    self._overhead = {} #path ('single' or 'batch') -> smoothed time from send to first latch
+    self.spinTime = spinTime
+    self.maxBatch = maxBatch
+    self.binUs = binUs
+    self.latchClock = latchClock
+
+    schedule = sorted(schedule, key=lambda e: e[0])
+    self.times = [e[0] for e in schedule]
+    self.frames = [commander.prepareFrame(mode, self._chainBeams(beams))
+                   for _, mode, beams in schedule]
+    self.batches = self._batch()
+
+  def _chainBeams(self, beams):
+    if beams and not isinstance(beams[0], (list, tuple)):
+      return [beams] * self.commander.chain.nChips #one chip's settings, broadcast
+    return beams
+
+  def _frameTime(self, frame):
+    """seconds the adapter spends clocking and latching one frame"""
+    if frame.packed is None:
+      return 0.0
+    spi = self.commander.testSPI
+    clockHz = 1e3 * min(getattr(spi, 'spiClk', 50000), 50000)
+    return 8 * len(frame.packed) / clockHz + 1e-6 * (spi.delayCS2LDB + spi.delayLDB)
+
+  def _batch(self):
+    """groups entry indexes that are closer together than usbRtt"""
+    batches = []
+    for i, t in enumerate(self.times):
+      if (batches and t - self.times[batches[-1][-1]] < self.usbRtt
+          and len(batches[-1]) < self.maxBatch):
+        batches[-1].append(i)
+      else:
+        batches.append([i])
+    return batches
+
+  def _gapsUs(self, batch):
+    """adapter-timed gaps: next entry's time minus the next frame's clocking"""
+    gapsUs = []
+    for k in range(len(batch) - 1):
+      gap = self.times[batch[k + 1]] - self.times[batch[k]] - self._frameTime(self.frames[batch[k + 1]])
+      gapsUs.append(max(0.0, 1e6 * gap))
+    gapsUs.append(0.0)
+    return gapsUs
+
+  def _modelLatches(self, frames, gapsUs):
+    """seconds from the start of a script to each frame's latch"""
+    latch = []
+    elapsed = 0.0
+    for k, f in enumerate(frames):
+      elapsed += self._frameTime(f)
+      latch.append(elapsed)
+      elapsed += 1e-6 * round(gapsUs[k])
+    return latch
+
+  def _latches(self):
+    return self.latchClock() if self.latchClock is not None else []
+
+  def _lead(self, path):
+    if self.lead is not None:
+      return self.lead
+    return self._overhead.get(path, self.usbRtt) #one round trip until measured
+
+  def _learn(self, path, overhead):
+    if path in self._overhead:
+      overhead = 0.75 * self._overhead[path] + 0.25 * overhead
+    self._overhead[path] = overhead
+
+  def _warmUp(self):
+    """seeds the lead of each path from one transaction writing the first entry's beam"""
+    frame = self.frames[0]
+    if frame.packed is None:
+      return
+    self.commander.commitFrame(frame) #DIO lines into place, untimed
+    self.commander.invalidateShadow(payloadOnly=True)
+    self._latches() #drop anything from before
+
+    sent = time.perf_counter()
+    self.commander.commitFrame(frame)
+    end = time.perf_counter()
+    latches = self._latches()
+    self._overhead['single'] = (latches[0] if latches else end) - sent
+
+    if any(len(batch) > 1 for batch in self.batches):
+      sequence = self.commander.prepareSequence([frame, frame], [0.0, 0.0])
+      sent = time.perf_counter()
+      self.commander.commitSequence(sequence)
+      end = time.perf_counter()
+      self.commander.releaseSequence(sequence)
+      latches = self._latches()
+      self._overhead['batch'] = latches[0] - sent if latches else end - sent - self._frameTime(frame)
+    self.commander.invalidateShadow(payloadOnly=True) #the first entry goes out on time
+
+  def run(self):
+    """fires the schedule, returns the JitterStats of the switch times"""
+    stats = JitterStats(self.binUs)
+    if not self.batches:
+      return stats
+    if self.lead is None:
+      self._warmUp()
+
+    def prepare(batch):
+      if len(batch) == 1:
+        return None, None
+      gapsUs = self._gapsUs(batch)
+      return self.commander.prepareSequence([self.frames[i] for i in batch], gapsUs), gapsUs
+
+    sequence, gapsUs = prepare(self.batches[0])
+    start = time.perf_counter() + self.usbRtt #leave room for the first entry
+
+    for b, batch in enumerate(self.batches):
+      t0 = start + self.times[batch[0]]
+      path = 'single' if len(batch) == 1 else 'batch'
+      self._latches() #drop anything from before the send
+      sent = sleepUntil(t0 - self._lead(path), self.spinTime)
+
+      if len(batch) == 1:
+        self.commander.commitFrame(self.frames[batch[0]])
+        end = time.perf_counter()
+        latches = self._latches()
+        stats.add(t0, latches[-1] if latches else end)
+        self._learn(path, (latches[-1] if latches else end) - sent)
+      else:
+        self.commander.commitSequence(sequence)
+        end = time.perf_counter()
+        latches = self._latches()
+        frames = sequence.frames
+        model = self._modelLatches(frames, gapsUs)
+        written = [k for k, f in enumerate(frames) if f.packed is not None]
+        measured = dict(zip(written, latches)) if len(latches) == len(written) else {}
+        for k, i in enumerate(batch):
+          if k in measured:
+            stats.add(start + self.times[i], measured[k])
+          else:
+            #work back from the end of the script to when the frame latched
+            stats.add(start + self.times[i], end - (model[-1] - model[k]), modeled=True)
+        if measured:
+          self._learn(path, measured[written[0]] - sent)
+        else:
+          self._learn(path, end - sent - model[-1] + model[0])
+        self.commander.releaseSequence(sequence)
+
+      #off the critical path: the next batch's script
+      if b + 1 < len(self.batches):
+        sequence, gapsUs = prepare(self.batches[b + 1])
+
+    return stats
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  from awmfemu import emulatedLib
+  from fake_spiwrite import AwmfCommander, RX_MODE
+
+  lib, chip = emulatedLib(realTime=True)
+  awmf = AwmfCommander(lib=lib)
+  awmf.initSpi()
+
+  #32-beam sweep every 5 ms, then three bursts hopping every 200 us
+  schedule = [scheduleEntry(0.005 * n, RX_MODE, (n, 31 - n, n, 31 - n, 8, 8, 8, 8)) for n in range(32)]
+  for burst in range(3):
+    schedule += [scheduleEntry(0.2 + 0.05 * burst + 0.0002 * n, RX_MODE, (n, n, n, n, 4, 4, 4, burst))
+                 for n in range(32)]
+
+  for latchClock in (None, lib.takeStrobeTimes):
+    sched = BeamScheduler(awmf, schedule, usbRtt=2e-3, latchClock=latchClock)
+    chip.latchCount = 0
+    stats = sched.run()
+    print("latch times {0}: {1} entries in {2} transactions, {3} latches".format(
+      "measured" if latchClock else "modeled", len(schedule), len(sched.batches), chip.latchCount))
+    print(stats.summary())
+    print(stats.report())
+  awmf.closeSPI()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,424 @@
+#-------------------------------------------------------------------------------
+# Name:        beamserver
+# Purpose:     Local asyncio server in front of one AwmfCommander, so several
+#              scripts can steer the same chip without fighting over it
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# python3 beamserver.py                          serve on 127.0.0.1:5018
+# python3 beamserver.py --unix /tmp/awmf.sock    serve on a unix socket
+# python3 beamserver.py --no-hw                  phase settings only
+# python3 beamserver.py --client -n 2000 -c 16   load test a running server
+# python3 beamserver.py --selftest               server on the simulator and
+#                                                a load test in one process
+#
+# Protocol: one JSON object per line each way. A request
+#
+#   {"id": 7, "theta": 30, "phi": 90, "freq": 28.0, "mode": "RX", "amp": 8}
+#
+# (freq in GHz, mode RX/TX/SB, amp the 0-31 attenuation setting, add
+# "program": false for the settings only) is answered, in completion order, by
+#
+#   {"id": 7, "phase": [NE, SE, SW, NW], "batch": 5, "ioUs": 1210.4, "latencyUs": 1530.2}
+#
+# or {"id": 7, "error": "..."}. ioUs is the bus transaction the request went
+# out in, latencyUs runs from the server reading the line to writing the
+# reply.
+#
+# Requests waiting when the server gets round to them are handled as one
+# batch: each distinct direction is worked out once, and every frame of the
+# batch is written in a single adapter script (AwmfCommander.commitSequence),
+# so a batch costs one USB round trip. One task owns the commander; the next
+# batch is computed while the current one is on the bus.
+#-------------------------------------------------------------------------------
+
+import asyncio
+import json
+import sys
+import time
+from math import isfinite
+from concurrent.futures import ThreadPoolExecutor
+
+from beamcli import BeamEngine, DEFAULT_FREQ_GHZ
+from awmflog import getLogger
+
+DEFAULT_PORT = 5018
+
+log = getLogger("server")
+
+class _Request:
+  """one parsed request line and where its reply goes"""
+  def __init__(self, msg, writer, received):
+    self.msg = msg
+    self.writer = writer
+    self.received = received
+    self.phase = None
+    self.error = None
+
+class BeamServer:
+  """
+  server = BeamServer(awmf)            #awmf already initSpi()'d, or None
+  await server.start(port=5018)        #or start(path="/tmp/awmf.sock")
+  await server.serveForever()
+
+  maxBatch     most requests written in one adapter script
+  batchWindow  seconds to wait for more requests once one has arrived
+  """
+
+  def __init__(self, commander=None, phaseCalFile="phaseCal.yaml", antenna="4x1",
+               maxBatch=64, batchWindow=0.0):
+    self.commander = commander
+    self.phaseCalFile = phaseCalFile
+    self.antenna = antenna
+    self.maxBatch = maxBatch
+    self.batchWindow = batchWindow
+
+    self._engines = {}        #freq GHz -> BeamEngine
+    self._settings = {}       #(freq, theta, phi) -> phase settings
+    self._server = None
+    self._incoming = None
+    self._ioQueue = None
+    self._tasks = []
+    self._connections = {}    #handler task -> its writer
+    #the commander blocks, so it runs on one thread of its own
+    self._ioExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="BeamServerIO")
+
+    self.requests = 0
+    self.batches = 0
+
+  async def start(self, host="127.0.0.1", port=DEFAULT_PORT, path=None):
+    self._incoming = asyncio.Queue()
+    self._ioQueue = asyncio.Queue(maxsize=2)
+    self._tasks = [asyncio.ensure_future(self._batcher()),
+                   asyncio.ensure_future(self._io())]
+    if path is not None:
+      self._server = await asyncio.start_unix_server(self._handle, path=path)
+    else:
+      self._server = await asyncio.start_server(self._handle, host, port)
+    log.info("listening on %s", path or "{0}:{1}".format(host, port))
+    return self
+
+  async def serveForever(self):
+    await self._server.serve_forever()
+
+  async def close(self):
+    self._server.close()
+    #closing the transports ends the handlers' reads, so they finish by themselves
+    for writer in list(self._connections.values()):
+      writer.close()
+    if self._connections:
+      await asyncio.wait(list(self._connections), timeout=1.0)
+    await self._server.wait_closed()
+    for task in self._tasks:
+      task.cancel()
+    self._ioExecutor.shutdown(wait=True)
+
+  def meanBatch(self):
+    return self.requests / self.batches if self.batches else 0.0
+
+  #-----------------------------------------------------------------------------
+  # connections
+  #-----------------------------------------------------------------------------
+  async def _handle(self, reader, writer):
+    task = asyncio.current_task()
+    self._connections[task] = writer
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        received = time.perf_counter()
+        msg = None
+        try:
+          msg = json.loads(line)
+          float(msg["theta"]), float(msg["phi"])
+          freq = float(msg.get("freq", DEFAULT_FREQ_GHZ))
+          if not isfinite(freq) or freq <= 0:
+            raise ValueError("freq {0} is not a positive frequency".format(msg.get("freq")))
+        except (ValueError, KeyError, TypeError) as e:
+          _reply(writer, {"id": msg.get("id") if isinstance(msg, dict) else None,
+                          "error": "bad request: {0}".format(e)})
+          continue
+        self._incoming.put_nowait(_Request(msg, writer, received))
+    except ConnectionError:
+      pass
+    finally:
+      del self._connections[task]
+      writer.close()
+
+  #-----------------------------------------------------------------------------
+  # batching and phase settings
+  #-----------------------------------------------------------------------------
+  async def _batcher(self):
+    while True:
+      batch = [await self._incoming.get()]
+      if self.batchWindow > 0:
+        await asyncio.sleep(self.batchWindow)
+      while len(batch) < self.maxBatch and not self._incoming.empty():
+        batch.append(self._incoming.get_nowait())
+      self._phaseSettings(batch)
+      await self._ioQueue.put(batch)
+
+  def _engine(self, freq):
+    eng = self._engines.get(freq)
+    if eng is None:
+      eng = self._engines[freq] = BeamEngine(freq, self.antenna, self.phaseCalFile)
+    return eng
+
+  def _phaseSettings(self, batch):
+    """
+      fills in req.phase, each distinct (freq, theta, phi) worked out once. A
+      request that can't be worked out gets req.error; the rest carry on
+    """
+    for req in batch:
+      msg = req.msg
+      try:
+        key = (float(msg.get("freq", DEFAULT_FREQ_GHZ)), float(msg["theta"]), float(msg["phi"]))
+        phase = self._settings.get(key)
+        if phase is None:
+          if len(self._settings) >= 65536:
+            self._settings.clear()
+          phase = self._settings[key] = self._engine(key[0]).phaseSettings(key[1], key[2])
+        req.phase = phase
+      except Exception as e:
+        req.error = "bad request: {0}".format(e)
+
+  #-----------------------------------------------------------------------------
+  # the bus
+  #-----------------------------------------------------------------------------
+  async def _io(self):
+    loop = asyncio.get_event_loop()
+    while True:
+      batch = await self._ioQueue.get()
+      toWrite = []
+      frames = []
+      if self.commander is not None:
+        for req in batch:
+          if req.error is not None or not req.msg.get("program", True):
+            continue
+          try:
+            frames.append(self._frame(req.msg, req.phase))
+            toWrite.append(req)
+          except (KeyError, ValueError, TypeError) as e:
+            req.error = "bad request: {0}".format(e)
+
+      ioTime = 0.0
+      if frames:
+        start = time.perf_counter()
+        try:
+          await loop.run_in_executor(self._ioExecutor, self.commander.commitSequence, frames)
+        except Exception as e:
+          error = "spi: {0}".format(getattr(e, "msg", None) or e)
+          log.error("batch of %d failed: %s", len(frames), error)
+          for req in toWrite:
+            req.error = error
+        ioTime = time.perf_counter() - start
+
+      self.requests += len(batch)
+      self.batches += 1
+      writers = set()
+      now = time.perf_counter()
+      for req in batch:
+        reply = {"id": req.msg.get("id")}
+        if req.error is not None:
+          reply["error"] = req.error
+        else:
+          reply.update(phase=req.phase, batch=len(batch), ioUs=round(1e6 * ioTime, 1),
+                       latencyUs=round(1e6 * (now - req.received), 1))
+        _reply(req.writer, reply)
+        writers.add(req.writer)
+      for writer in writers:
+        try:
+          await writer.drain()
+        except ConnectionError:
+          pass
+
+  def _frame(self, msg, phase):
+    from fake_spiwrite import MODE_NAMES
+    modes = dict((name[:-len("_MODE")], mode) for mode, name in MODE_NAMES.items())
+    mode = modes[str(msg.get("mode", "RX")).upper()]
+    amp = int(msg.get("amp", 0))
+    if not 0 <= amp < 32:
+      raise ValueError("amp {0} not in 0-31".format(amp))
+    beam = list(phase) + [amp] * 4
+    return self.commander.prepareFrame(mode, [beam] * self.commander.chain.nChips)
+
+def _reply(writer, obj):
+  writer.write((json.dumps(obj) + "\n").encode())
+
+#-------------------------------------------------------------------------------
+# client
+#-------------------------------------------------------------------------------
+class BeamClient:
+  """
+  client = await BeamClient.connect(port=5018)     #or connect(path=...)
+  reply = await client.request(theta=30, phi=90, mode="TX", amp=8)
+  await client.close()
+
+  Any number of requests may be outstanding; replies are matched by id.
+  """
+
+  def __init__(self, reader, writer):
+    self.reader = reader
+    self.writer = writer
+    self._nextId = 0
+    self._waiting = {}
+    self._readTask = asyncio.ensure_future(self._readReplies())
+
+  @classmethod
+  async def connect(cls, host="127.0.0.1", port=DEFAULT_PORT, path=None):
+    if path is not None:
+      reader, writer = await asyncio.open_unix_connection(path)
+    else:
+      reader, writer = await asyncio.open_connection(host, port)
+    return cls(reader, writer)
+
+  async def request(self, **msg):
+    self._nextId += 1
+    msg["id"] = self._nextId
+    future = self._waiting[self._nextId] = asyncio.get_event_loop().create_future()
+    self.writer.write((json.dumps(msg) + "\n").encode())
+    await self.writer.drain()
+    return await future
+
+  async def _readReplies(self):
+    while True:
+      line = await self.reader.readline()
+      if not line:
+        break
+      reply = json.loads(line)
+      future = self._waiting.pop(reply.get("id"), None)
+      if future is not None and not future.done():
+        future.set_result(reply)
+    for future in self._waiting.values():
+      if not future.done():
+        future.set_exception(ConnectionError("server closed the connection"))
+
+  async def close(self):
+    self.writer.close()
+    await self.writer.wait_closed()
+    await self._readTask
+
+async def loadTest(n=2000, concurrency=16, host="127.0.0.1", port=DEFAULT_PORT, path=None, **extra):
+  """
+  concurrency clients sharing n requests between them. returns a dict of
+  throughput, round trip percentiles, mean batch size and error count
+  """
+  clients = [await BeamClient.connect(host, port, path) for _ in range(concurrency)]
+  roundTrips = []
+  batches = []
+  errors = [0]
+
+  async def worker(client, k):
+    for i in range(k, n, concurrency):
+      msg = dict(theta=(7 * i) % 60, phi=(15 * i) % 360, mode="RX" if i % 2 else "TX", amp=i % 32)
+      msg.update(extra)
+      t0 = time.perf_counter()
+      reply = await client.request(**msg)
+      roundTrips.append(time.perf_counter() - t0)
+      if "error" in reply:
+        errors[0] += 1
+      else:
+        batches.append(reply["batch"])
+
+  t0 = time.perf_counter()
+  await asyncio.gather(*[worker(c, k) for k, c in enumerate(clients)])
+  elapsed = time.perf_counter() - t0
+  for c in clients:
+    await c.close()
+
+  roundTrips.sort()
+  def pct(p):
+    return 1e3 * roundTrips[min(len(roundTrips) - 1, int(p / 100.0 * len(roundTrips)))]
+  return {"requests": n, "clients": concurrency, "perSecond": n / elapsed,
+          "p50Ms": pct(50), "p99Ms": pct(99), "maxMs": 1e3 * roundTrips[-1],
+          "meanBatch": sum(batches) / len(batches) if batches else 0.0, "errors": errors[0]}
+
+def _printLoad(name, r):
+  print("{0:<12} {1:6.0f} req/s  p50 {2:6.2f} ms  p99 {3:6.2f} ms  mean batch {4:5.1f}  errors {5}".format(
+    name, r["perSecond"], r["p50Ms"], r["p99Ms"], r["meanBatch"], r["errors"]))
+
+
+# ------------------------------------------------------------------------------
+# MAIN PROGRAM
+# ------------------------------------------------------------------------------
+async def _selftest(n, concurrency):
+  """the simulator in real time, with and without batching"""
+  from awmfemu import emulatedLib
+  from fake_spiwrite import AwmfCommander
+
+  for name, maxBatch in [("unbatched", 1), ("batched", 64)]:
+    lib, chip = emulatedLib(realTime=True)
+    awmf = AwmfCommander(lib=lib)
+    awmf.initSpi()
+    server = BeamServer(awmf, maxBatch=maxBatch)
+    await server.start(port=0)
+    port = server._server.sockets[0].getsockname()[1]
+    _printLoad(name, await loadTest(n, concurrency, port=port))
+
+    #bad requests get an error each and the server keeps answering
+    client = await BeamClient.connect(port=port)
+    replies = []
+    for msg in [dict(theta=10, phi=90, freq="abc"), dict(theta=10, phi=90, freq=0),
+                dict(theta=10, phi=90, freq=float("inf")), dict(theta=10, phi=90)]:
+      replies.append(await asyncio.wait_for(client.request(**msg), 2.0))
+    await client.close()
+    #and one that gets past the connection's checks fails on its own
+    bad = _Request({"id": 0, "theta": 10, "phi": 90, "freq": "abc"}, None, 0.0)
+    server._phaseSettings([bad])
+    ok = all("error" in r for r in replies[:3]) and "phase" in replies[3] and bad.error is not None
+    print("{0:<12} bad freq rejected, server still answering: {1}".format(name, ok))
+    if not ok:
+      raise SystemExit("bad requests: {0}".format(replies))
+    await server.close()
+    awmf.closeSPI()
+
+def main(argv=None):
+  import argparse
+  import logging
+  parser = argparse.ArgumentParser(description="awmf-0108 beam server")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+  parser.add_argument("--unix", help="listen on / connect to this unix socket instead")
+  parser.add_argument("--resource", help="VISA resource of the adapter")
+  parser.add_argument("--cal", default="phaseCal.yaml", help="phase cal yaml")
+  parser.add_argument("--max-batch", type=int, default=64)
+  parser.add_argument("--batch-window", type=float, default=0.0, help="seconds")
+  parser.add_argument("--no-hw", action="store_true", help="phase settings only, no adapter")
+  parser.add_argument("--client", action="store_true", help="load test a running server")
+  parser.add_argument("--selftest", action="store_true", help="server on the simulator plus a load test")
+  parser.add_argument("-n", type=int, default=2000, help="load test requests")
+  parser.add_argument("-c", type=int, default=16, help="load test clients")
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO)
+
+  if args.selftest:
+    asyncio.run(_selftest(args.n, args.c))
+    return 0
+  if args.client:
+    _printLoad("load", asyncio.run(loadTest(args.n, args.c, args.host, args.port, args.unix)))
+    return 0
+
+  awmf = None
+  if not args.no_hw:
+    from fake_spiwrite import AwmfCommander
+    awmf = AwmfCommander(args.resource)
+    awmf.initSpi()
+
+  async def serve():
+    server = BeamServer(awmf, args.cal, maxBatch=args.max_batch, batchWindow=args.batch_window)
+    await server.start(args.host, args.port, args.unix)
+    await server.serveForever()
+  try:
+    asyncio.run(serve())
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if awmf is not None:
+      awmf.closeSPI()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,287 @@
+#-------------------------------------------------------------------------------
+# Name:        beamtrack
+# Purpose:     Keep the beam on a moving target: predict where it will be at
+#              the next update, precompute that beam and commit it on time
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+import socket
+import threading
+import time
+from collections import namedtuple
+from math import sin, cos, asin, atan2, sqrt, radians, degrees
+
+from beamdef import BeamDefinition
+from beamsched import JitterStats, sleepUntil
+from fake_spiwrite import RX_MODE
+
+#one target report. t is on the perf_counter clock, angles in degrees
+TrackPoint = namedtuple('TrackPoint', ['t', 'theta', 'phi'])
+
+def _toUV(theta, phi):
+  """direction cosines -- no wrap around at phi = 360 or theta = 0"""
+  t = radians(theta)
+  p = radians(phi)
+  return sin(t) * cos(p), sin(t) * sin(p)
+
+def _fromUV(u, v):
+  r = sqrt(u*u + v*v)
+  if r > 1.0: #extrapolated past the horizon
+    u, v, r = u / r, v / r, 1.0
+  return degrees(asin(r)), degrees(atan2(v, u)) % 360
+
+class LinearPredictor:
+  """Extrapolates the last two reports to time t, in direction cosines"""
+
+  def __init__(self):
+    self.last = None
+    self.previous = None
+
+  def add(self, point):
+    self.previous, self.last = self.last, point
+
+  def ready(self):
+    return self.last is not None
+
+  def predict(self, t):
+    """(theta, phi) at t"""
+    if self.previous is None or self.last.t <= self.previous.t:
+      return self.last.theta, self.last.phi
+    u0, v0 = _toUV(self.previous.theta, self.previous.phi)
+    u1, v1 = _toUV(self.last.theta, self.last.phi)
+    k = (t - self.last.t) / (self.last.t - self.previous.t)
+    return _fromUV(u1 + k * (u1 - u0), v1 + k * (v1 - v0))
+
+
+class BeamTracker:
+  """
+  Commits a beam every 1/rate seconds, pointed where the target is predicted
+  to be at that tick
+
+  tracker = BeamTracker(awmf, waveLength)
+  tracker.start()
+  tracker.feed(theta, phi)     #from any thread, as reports come in
+  tracker.stop()
+
+  Right after a commit the next beam is predicted, its phase settings worked
+  out and its frame packed, so the tick itself only has to write the frame.
+  A tick whose 5-bit settings match the last committed beam writes nothing.
+
+  The write starts early by a lead, so that the chip latches on the tick
+  rather than one commit later. A fixed lead (seconds) can be given; with
+  lead=None it starts at usbRtt and is learnt from the measured commit time,
+  as BeamScheduler does.
+  """
+
+  def __init__(self, commander, waveLength, rate=100.0, mode=RX_MODE, amp=0,
+               phaseCalFile="phaseCal.yaml", antenna=None, predictor=None, spinTime=2e-3,
+               lead=None, usbRtt=1e-3):
+    """
+    amp       awmf attenuation setting applied to every channel
+    antenna   optional (grid, invertPattern, spacing) for BeamDefinition.setAntenna
+    """
+    self.commander = commander
+    self.period = 1.0 / rate
+    self.mode = mode
+    self.amp = amp
+    self.spinTime = spinTime
+    self.lead = lead
+    self.usbRtt = usbRtt
+    self._overhead = None #smoothed commitFrame time, seconds
+    self.predictor = predictor if predictor is not None else LinearPredictor()
+
+    self.beamDef = BeamDefinition(0, 0, waveLength, phaseCalFile=phaseCalFile)
+    if antenna is not None:
+      self.beamDef.setAntenna(*antenna)
+
+    self._lock = threading.Lock()
+    self._running = False
+    self._thread = None
+    self.resetStats()
+
+  def resetStats(self):
+    self.jitter = JitterStats()
+    self.ticks = 0
+    self.commits = 0
+    self.skipped = 0
+    self.missed = 0            #ticks started after the next one was due
+    self.computeTime = 0.0     #worst predict + pack time, seconds
+    self.lastSettings = None
+
+  def feed(self, theta, phi, t=None):
+    """a new target report (degrees). t defaults to now"""
+    if t is None:
+      t = time.perf_counter()
+    with self._lock:
+      self.predictor.add(TrackPoint(t, theta, phi))
+
+  def _prepare(self, t):
+    """settings and frame for tick time t, or (None, None) if no report yet"""
+    with self._lock:
+      if not self.predictor.ready():
+        return None, None
+      theta, phi = self.predictor.predict(t)
+    self.beamDef.setDirection(theta, phi)
+    settings = tuple(self.beamDef.getPhaseSettings())
+    if settings == self.lastSettings:
+      return settings, None
+    beam = settings + (self.amp,) * 4
+    return settings, self.commander.prepareFrame(self.mode, [beam] * self.commander.chain.nChips)
+
+  def _lead(self):
+    if self.lead is not None:
+      return self.lead
+    return self.usbRtt if self._overhead is None else self._overhead
+
+  def _learn(self, overhead):
+    if self._overhead is not None:
+      overhead = 0.75 * self._overhead + 0.25 * overhead
+    self._overhead = overhead
+
+  def run(self, duration=None):
+    """tracks on the calling thread until stop() or duration seconds"""
+    self._running = True
+    tick = time.perf_counter() + self.period
+    end = None if duration is None else tick + duration
+    settings, frame = self._prepare(tick)
+
+    while self._running and (end is None or tick < end):
+      wake = tick - self._lead() if frame is not None else tick
+      now = sleepUntil(wake, self.spinTime)
+      self.ticks += 1
+      if now - wake > self.period:
+        self.missed += 1
+
+      if frame is not None:
+        self.commander.commitFrame(frame)
+        done = time.perf_counter()
+        self._learn(done - now)
+        self.jitter.add(tick, done)
+        self.lastSettings = settings
+        self.commits += 1
+      elif settings is not None:
+        self.skipped += 1
+
+      #off the critical path: the next tick's beam
+      tick += self.period
+      t0 = time.perf_counter()
+      settings, frame = self._prepare(tick)
+      self.computeTime = max(self.computeTime, time.perf_counter() - t0)
+    self._running = False
+
+  def start(self):
+    self._thread = threading.Thread(target=self.run, name="BeamTracker", daemon=True)
+    self._thread.start()
+
+  def stop(self, wait=True):
+    self._running = False
+    if wait and self._thread is not None:
+      self._thread.join()
+
+  def summary(self):
+    d = {"ticks": self.ticks, "commits": self.commits, "skipped": self.skipped,
+         "missed": self.missed, "computeUs": 1e6 * self.computeTime}
+    d.update(self.jitter.summary())
+    return d
+
+
+# ------------------------------------------------------------------------------
+# Target sources
+# ------------------------------------------------------------------------------
+def readTrackFile(path):
+  """
+  Yields (t, theta, phi) from a text file, one report per line, t in seconds
+  from the start of the track. Blank lines and # comments are skipped.
+  """
+  with open(path, "r") as stream:
+    for line in stream:
+      line = line.split("#", 1)[0].replace(",", " ").split()
+      if line:
+        yield tuple(float(x) for x in line[:3])
+
+def playTrackFile(tracker, path):
+  """feeds a track file to tracker in real time (blocking)"""
+  start = time.perf_counter()
+  for t, theta, phi in readTrackFile(path):
+    sleepUntil(start + t)
+    tracker.feed(theta, phi, start + t)
+
+class TrackSocket:
+  """
+  Listens for target reports on a local UDP port, one "theta phi" datagram
+  per report, and feeds them to a tracker
+
+  src = TrackSocket(tracker, port=5005)
+  src.start()
+  """
+
+  def __init__(self, tracker, port=5005, host="127.0.0.1"):
+    self.tracker = tracker
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.bind((host, port))
+    self.sock.settimeout(0.2)
+    self.badPackets = 0
+    self._running = False
+    self._thread = None
+
+  def start(self):
+    self._running = True
+    self._thread = threading.Thread(target=self._run, name="TrackSocket", daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._running = False
+    if self._thread is not None:
+      self._thread.join()
+    self.sock.close()
+
+  def _run(self):
+    while self._running:
+      try:
+        data, _ = self.sock.recvfrom(256)
+      except socket.timeout:
+        continue
+      try:
+        theta, phi = (float(x) for x in data.decode().split()[:2])
+      except ValueError:
+        self.badPackets += 1
+        continue
+      self.tracker.feed(theta, phi)
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  from awmfemu import emulatedLib
+  from fake_spiwrite import AwmfCommander
+
+  lib, chip = emulatedLib(realTime=True)
+  awmf = AwmfCommander(lib=lib)
+  awmf.initSpi()
+
+  f = 28 * pow(10,9)
+  tracker = BeamTracker(awmf, 3 * pow(10, 8) / f, rate=100.0, amp=8)
+
+  #target crossing the sky at 20 deg/s, reported every 25 ms over UDP
+  src = TrackSocket(tracker, port=0)
+  port = src.sock.getsockname()[1]
+  src.start()
+  out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  tracker.start()
+  t0 = time.perf_counter()
+  while time.perf_counter() - t0 < 2.0:
+    theta = -20 + 20 * (time.perf_counter() - t0)
+    out.sendto("{0:.3f} 90".format(theta).encode(), ("127.0.0.1", port))
+    time.sleep(0.025)
+  tracker.stop()
+  src.stop()
+
+  print(tracker.summary())
+  print("last beam on chip: {0}".format(chip.getActiveChannels()))
+  awmf.closeSPI()
+
+if __name__ == '__main__':
+  main()
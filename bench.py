@@ -0,0 +1,270 @@
+#-------------------------------------------------------------------------------
+# Name:        bench
+# Purpose:     Headless benchmarks of the beam compute, pack, SPI and drawing
+#              paths, with a stored baseline to catch regressions
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# python3 bench.py                          run everything, print JSON
+# python3 bench.py -k pack -k setBeam       only benchmarks matching a name
+# python3 bench.py --out bench_output.txt   also write the JSON to a file
+# python3 bench.py --save-baseline          store the results as the baseline
+# python3 bench.py --baseline bench_baseline.json --threshold 0.2
+#                                           exit 1 if anything got >20% slower
+#
+# Each benchmark reports the median time per call over several repeats; a
+# repeat runs the call enough times to last at least minTime seconds.
+#-------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from statistics import median
+
+from beamdef import BeamDefinition, NE, NW, SE, SW, triangularLattice
+
+BASELINE = "bench_baseline.json"
+WAVELENGTH = 3 * pow(10, 8) / (28 * pow(10, 9))
+
+#-------------------------------------------------------------------------------
+# timing
+#-------------------------------------------------------------------------------
+def measure(fn, minTime=0.05, repeats=5):
+  """returns (median seconds per call, best seconds per call, calls per repeat)"""
+  n = 1
+  while True: #find a call count that lasts minTime
+    t0 = time.perf_counter()
+    for _ in range(n):
+      fn()
+    elapsed = time.perf_counter() - t0
+    if elapsed >= minTime or n >= 1 << 20:
+      break
+    n *= 2 if elapsed <= 0 else max(2, min(10, int(1.2 * minTime / elapsed) + 1))
+
+  samples = [elapsed / n]
+  for _ in range(repeats - 1):
+    t0 = time.perf_counter()
+    for _ in range(n):
+      fn()
+    samples.append((time.perf_counter() - t0) / n)
+  return median(samples), min(samples), n
+
+#-------------------------------------------------------------------------------
+# benchmarks: each yields (name, callable)
+#-------------------------------------------------------------------------------
+def _grid(nx, ny):
+  """nx x ny antenna grid for setAntenna, the four quadrant names repeated"""
+  names = [NE, NW, SE, SW]
+  grid = [[names[(i * ny + j) % 4] for j in range(ny)] for i in range(nx)]
+  invert = [[(j % 2) == 0 for j in range(ny)] for i in range(nx)]
+  return grid, invert
+
+def benchAF():
+  for nx, ny in [(1, 4), (2, 2), (4, 4), (8, 8)]:
+    for res in [15, 30, 60]:
+      b = BeamDefinition(20, 90, WAVELENGTH, phaseCalFile="0phaseCal.yaml")
+      grid, invert = _grid(nx, ny)
+      b.setAntenna(grid, invert, 5.4 * pow(10,-3))
+      yield ("generateAllAF[{0}x{1},{2}]".format(nx, ny, res),
+             lambda b=b, res=res: b.generateAllAF(n_theta=res, n_phi=res))
+  b = BeamDefinition(20, 90, WAVELENGTH, phaseCalFile=None)
+  b.setElementPositions(triangularLattice(8, 8, WAVELENGTH / 2))
+  yield ("generateAllAF[tri8x8,30]", lambda: b.generateAllAF())
+  yield ("phiCut[tri8x8,0.1deg]", lambda: b.phiCut(90, step=0.1))
+
+def benchMetrics():
+  from beammetrics import MetricsGrid
+  for name, (nx, ny) in [("2x2", (2, 2)), ("8x8", (8, 8))]:
+    b = BeamDefinition(20, 30, WAVELENGTH, phaseCalFile=None)
+    grid, invert = _grid(nx, ny)
+    b.setAntenna(grid, invert, 5.4 * pow(10,-3))
+    metricsGrid = MetricsGrid(b.getElementPositions(), b.waveLength)
+    yield ("getBeamMetrics[{0}]".format(name), lambda b=b, g=metricsGrid: b.getBeamMetrics(grid=g))
+
+def benchPhaseSettings():
+  b = BeamDefinition(0, 0, WAVELENGTH, phaseCalFile="testPhaseCal.yaml")
+  angles = [(t, p) for t in range(0, 60, 5) for p in range(0, 360, 30)]
+  def run():
+    for t, p in angles:
+      b.setDirection(t, p)
+      b.getPhaseSettings()
+  yield ("getPhaseSettings[x{0}]".format(len(angles)), run)
+
+def benchCalibration():
+  b = BeamDefinition(0, 0, WAVELENGTH, phaseCalFile="testPhaseCal.yaml")
+  sparse = b.phaseCal
+  dense = dict((q, dict((s, (s * 7 + i) % 5 - 2) for s in range(32)))
+               for i, q in enumerate([NE, SE, SW, NW]))
+  for name, cal in [("sparse", sparse), ("dense", dense), ("none", None)]:
+    def run(cal=cal):
+      for q in (NE, SE, SW, NW):
+        for s in range(32):
+          b._applyCalibration(q, s, cal)
+    yield ("applyCalibration[{0},x128]".format(name), run)
+
+def benchPack():
+  from fake_spiwrite import AwmfCommander, FRAME_WORDS
+  pack = AwmfCommander._AwmfCommander__packValues
+  for nChips in [1, 4]:
+    words = [(7 * k) % 4096 for k in range(FRAME_WORDS * nChips)]
+    yield ("packValues[{0} chip]".format(nChips), lambda words=words: pack(words))
+
+def benchSetBeam():
+  from awmfemu import emulatedLib
+  from fake_spiwrite import AwmfCommander, RX_MODE, TX_MODE
+  lib, chip = emulatedLib(realTime=False)
+  awmf = AwmfCommander(lib=lib)
+  awmf.initSpi()
+  state = [0]
+  def run():
+    n = state[0] = (state[0] + 1) % 32
+    awmf.setBeam(RX_MODE if n % 2 else TX_MODE, n, n, n, n, 8, 8, 8, 8)
+  yield ("setBeam[sim]", run)
+  yield ("readRegisters[sim]", awmf.readRegisters)
+
+class RecordingGL:
+  """
+  Stands in for OpenGL.GL: every gl* call is counted, nothing is drawn.
+  Constants resolve to their names
+  """
+  def __init__(self):
+    self.calls = {}
+    self._nextList = 0
+
+  def __getattr__(self, name):
+    if name.startswith("GL_"):
+      return name
+    if not name.startswith("gl"):
+      raise AttributeError(name)
+    calls = self.calls
+    def call(*args):
+      calls[name] = calls.get(name, 0) + 1
+      if name == "glGenLists":
+        self._nextList += 1
+        return self._nextList
+    setattr(self, name, call)
+    return call
+
+def benchBeamPattern():
+  """makeBeamPattern with the GL module swapped for RecordingGL"""
+  try:
+    import PyQt5 #noqa: F401
+  except ImportError:
+    yield ("makeBeamPattern", None) #skipped
+    return
+
+  os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+  recorder = RecordingGL()
+  try:
+    import OpenGL.GL #noqa: F401
+  except ImportError:
+    import types
+    sys.modules["OpenGL"] = types.ModuleType("OpenGL")
+    sys.modules["OpenGL.GL"] = recorder
+
+  from PyQt5.QtWidgets import QApplication
+  import qantennaviewer
+  qantennaviewer.gl = recorder
+  app = QApplication.instance() or QApplication(sys.argv[:1])
+
+  for res in [30, 60]:
+    b = BeamDefinition(20, 90, WAVELENGTH, phaseCalFile="0phaseCal.yaml")
+    viewer = qantennaviewer.QAntennaViewer()
+    viewer.setAFPoints(b.generateAllAF(n_theta=res, n_phi=res), n_phi=res, n_theta=res)
+    yield ("makeBeamPattern[{0}]".format(res), viewer.makeBeamPattern)
+
+BENCHMARKS = [benchAF, benchMetrics, benchPhaseSettings, benchCalibration, benchPack, benchSetBeam, benchBeamPattern]
+
+#-------------------------------------------------------------------------------
+# running and comparing
+#-------------------------------------------------------------------------------
+def runAll(patterns=None, minTime=0.05, repeats=5):
+  results = {}
+  skipped = []
+  failed = {} #name -> error: one broken case doesn't stop the others
+  for bench in BENCHMARKS:
+    try:
+      cases = list(bench())
+    except Exception as e:
+      failed[bench.__name__] = "{0}: {1}".format(type(e).__name__, e)
+      continue
+    for name, fn in cases:
+      if patterns and not any(p in name for p in patterns):
+        continue
+      if fn is None:
+        skipped.append(name)
+        continue
+      try:
+        med, best, n = measure(fn, minTime, repeats)
+      except Exception as e:
+        failed[name] = "{0}: {1}".format(type(e).__name__, e)
+        continue
+      results[name] = {"medianUs": 1e6 * med, "bestUs": 1e6 * best, "calls": n}
+  return {"meta": {"python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+          "results": results,
+          "skipped": skipped,
+          "failed": failed}
+
+def unbaselined(current, baseline):
+  """names in current with nothing to compare against in baseline"""
+  known = baseline.get("results", {})
+  return sorted(name for name in current["results"]
+                if name not in known or known[name]["medianUs"] <= 0)
+
+def compare(current, baseline, threshold):
+  """returns a list of (name, baseline us, current us, ratio) slower than 1 + threshold"""
+  regressions = []
+  for name, r in current["results"].items():
+    b = baseline.get("results", {}).get(name)
+    if b is None or b["medianUs"] <= 0:
+      continue
+    ratio = r["medianUs"] / b["medianUs"]
+    if ratio > 1 + threshold:
+      regressions.append((name, b["medianUs"], r["medianUs"], ratio))
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="awmf-0108 demo benchmarks")
+  parser.add_argument("-k", dest="patterns", action="append", help="only run benchmarks containing this")
+  parser.add_argument("--out", help="also write the JSON results here")
+  parser.add_argument("--baseline", help="compare against this results file")
+  parser.add_argument("--save-baseline", action="store_true", help="write the results to " + BASELINE)
+  parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown (0.2 = 20%%)")
+  parser.add_argument("--min-time", type=float, default=0.05)
+  parser.add_argument("--repeats", type=int, default=5)
+  args = parser.parse_args(argv)
+
+  current = runAll(args.patterns, args.min_time, args.repeats)
+  text = json.dumps(current, indent=2, sort_keys=True)
+  print(text)
+  for name, error in sorted(current["failed"].items()):
+    sys.stderr.write("FAILED {0}: {1}\n".format(name, error))
+  if args.out:
+    with open(args.out, "w") as stream:
+      stream.write(text)
+  if args.save_baseline:
+    with open(BASELINE, "w") as stream:
+      stream.write(text)
+
+  if args.baseline:
+    with open(args.baseline, "r") as stream:
+      baseline = json.load(stream)
+    regressions = compare(current, baseline, args.threshold)
+    for name in unbaselined(current, baseline):
+      sys.stderr.write("NO BASELINE {0}: not gated, re-record with --save-baseline\n".format(name))
+    for name, before, after, ratio in regressions:
+      sys.stderr.write("REGRESSION {0}: {1:.1f} us -> {2:.1f} us ({3:.2f}x)\n".format(name, before, after, ratio))
+    if regressions:
+      return 1
+    sys.stderr.write("no regressions over {0:.0%}\n".format(args.threshold))
+  return 1 if current["failed"] else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
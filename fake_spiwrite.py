@@ -11,7 +11,16 @@
 # Licence:     <tbd Anokiwave>
 #-------------------------------------------------------------------------------
 
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
 from ni8452io import SPI
+from stagetime import timed
+from awmflog import getLogger, TransactionLog, TX_DIO, TX_WRITE, TX_READ, TX_SEQ, TX_FAIL
 #dll name is Ni845x.dll
 
 #enumerate TXMODE, RXMODE, RX_11, SB
@@ -20,130 +29,529 @@ TX_MODE = 1
 RX_MODE = 2
 RX_11_MODE = 3
 
+MODE_NAMES = {SB_MODE: "SB_MODE", TX_MODE: "TX_MODE", RX_MODE: "RX_MODE", RX_11_MODE: "RX_11_MODE"}
+
+log = getLogger("spi")
+
+#number of 12-bit words latched into the chip per beam
+FRAME_WORDS = 16
+
+#where _modeFrame puts each setBeam setting (NE_phase, ..., NW_amp), by DIO value
+_BEAM_WORDS = {2: (0, 4, 8, 12, 1, 5, 9, 13),   #RX_MODE
+               1: (2, 6, 10, 14, 3, 7, 11, 15)} #TX_MODE
+
 class SpiInitException(Exception):
   """Error from initializing SPI bus"""
   def __init__(self, fret, msg=""):
     self.fret = fret
     self.msg = msg 
 
+#reported by verified programming when a read back doesn't match
+#   time        time.time() the mismatch was found
+#   expected    payload words that should have been latched
+#   actual      payload words the chip shifted out
+#   words       indexes of the words that differ
+VerifyMismatch = namedtuple('VerifyMismatch', ['time', 'expected', 'actual', 'words'])
+
+#a chain frame built and packed ahead of time (AwmfCommander.prepareFrame)
+#   mode, dio   requested mode and the DIO value it needs
+#   words       payload words for the whole chain, None if nothing is programmed
+#   packed      *words* as they go out on the wire
+PreparedFrame = namedtuple('PreparedFrame', ['mode', 'dio', 'words', 'packed'])
+
+#a commitSequence adapter script built ahead of time (AwmfCommander.prepareSequence)
+#   frames      the PreparedFrames it writes
+#   script      ni8452io.SeqScript, None if the adapter wasn't open
+PreparedSequence = namedtuple('PreparedSequence', ['frames', 'script'])
+
+def _serialized(method):
+  """Runs a commander method while holding that commander's ioLock"""
+  @wraps(method)
+  def locked(self, *args, **kwargs):
+    with self.ioLock:
+      return method(self, *args, **kwargs)
+  return locked
+
+class ChipShadow:
+  """
+  Shadow copy of what was last committed to one awmf-0108
+
+  dio       last value written to the DIO port (TX_EN/RX_EN lines)
+  frame     last 16-word payload latched into the chip
+  packed    *frame* as it went out on the wire
+  readBack  data the chip shifted out while *frame* was written
+
+  None means unknown -- the next request always goes out on the wire
+  """
+  def __init__(self):
+    self.invalidate()
+
+  def invalidate(self):
+    """Forget everything. Call whenever the chip state can't be trusted"""
+    self.dio = None
+    self.frame = None
+    self.packed = None
+    self.readBack = []
+
+class ChainFrameBuilder:
+  """
+  Builds one packed stream for several awmf-0108s daisy chained on a bus
+
+  Chain position 0 is the chip wired to MOSI. Its words go out last, so
+  after one transfer every chip holds its own 16 words and a single LDB
+  strobe latches all of them at the same moment.
+
+  chain = ChainFrameBuilder(3, chainOrder=[2, 0, 1])
+  dio, words = chain.build(RX_MODE, [beam0, beam1, beam2])
+  """
+
+  def __init__(self, nChips=1, chainOrder=None):
+    """
+    nChips       number of chips on the chain
+    chainOrder   chainOrder[i] = chain position of logical chip i (default i)
+    """
+    if chainOrder is None:
+      chainOrder = list(range(nChips))
+    if sorted(chainOrder) != list(range(nChips)):
+      raise ValueError("chainOrder must be a permutation of range(nChips)")
+    self.nChips = nChips
+    self.chainOrder = list(chainOrder)
+
+  def build(self, mode, beams):
+    """
+    beams[i] = (NE_phase, SE_phase, SW_phase, NW_phase, NE_amp, SE_amp, SW_amp, NW_amp)
+               for logical chip i
+    returns (dio, words) -- words is None if the mode programs nothing
+    """
+    if len(beams) != self.nChips:
+      raise ValueError("expected {0} beams, got {1}".format(self.nChips, len(beams)))
+    frames = [None] * self.nChips
+    dio = 0
+    for chip, beam in enumerate(beams):
+      dio, frame = AwmfCommander._modeFrame(mode, *beam)
+      if frame is None:
+        return dio, None
+      frames[self.chainOrder[chip]] = frame
+    return dio, [w for frame in frames for w in frame]
+
+  def split(self, words):
+    """inverse of build: per logical chip list of FRAME_WORDS words"""
+    return [words[FRAME_WORDS * pos:FRAME_WORDS * (pos + 1)] for pos in self.chainOrder]
+
+  def pack(self, words):
+    """the bytes ioWriteSPI2 sends for words"""
+    return AwmfCommander._AwmfCommander__packValues(words)
+
 class AwmfCommander:
   """
-  Sends commands to the awmf through the SPI interposer 
+  Sends commands to the awmf through one SPI interposer 
   usage:
 
-  AwmfCommander.initSpi()
-  AwmfCommander.setBeam(....)
+  awmf = AwmfCommander()           #or AwmfCommander("USB0::...::RAW")
+  awmf.initSpi()
+  awmf.setBeam(....)
+
+  Each instance owns its own adapter session, so several adapters can be
+  driven side by side (see awmfpanel). Several chips daisy chained on one
+  adapter are programmed in a single transaction (setChainBeams).
+
+  Keeps a shadow of the last committed chip state: repeating a request is
+  free, and changing only the mode costs a single DIO write.
+
+  Verified programming (enableVerify) checks every frame for free: the chip
+  shifts out its latched frame N while frame N+1 is written, so that read
+  back is compared against the shadow and mismatches are handed to a
+  callback on another thread.
   """
 
-  #SPi interface handle placeholder
-  testSPI = 0 
+  def __init__(self, resourceName=None, lib=None, spiClk=1000000, chainLength=1, chainOrder=None):
+    """
+    resourceName    VISA resource of the adapter, None = first one found
+    lib             ni845x backend to talk through (see ni8452io.SPI), None = default
+    spiClk          SPI clock handed to ioSetConfig
+    chainLength     number of daisy chained chips on this adapter
+    chainOrder      chain position of each logical chip (see ChainFrameBuilder)
+    """
+    self.resourceName = resourceName
+    self.lib = lib
+    self.spiClk = spiClk
+    self.chain = ChainFrameBuilder(chainLength, chainOrder)
+
+    #SPi interface handle placeholder
+    self.testSPI = 0 
+
+    #last state committed to the chip
+    self.shadow = ChipShadow()
+
+    #one bus transaction at a time (GUI thread, BeamQueue thread, ...)
+    self.ioLock = threading.RLock()
+
+    #verified programming: callback(VerifyMismatch), None = off
+    self.verifyCallback = None
+    self.verifyCount = 0
+    self.mismatchCount = 0
+    self._verifyPool = None
 
-  @classmethod
-  def initSpi(cls):
+    #binary log of the last bus transactions, None = off
+    self.txLog = None
+
+  def enableTransactionLog(self, capacity=4096, dumpPath=None):
+    """
+    Keeps the last capacity transactions in an awmflog.TransactionLog.
+    If dumpPath is given the log is written there when a transaction fails
+    """
+    self.txLog = TransactionLog(capacity, dumpPath)
+    return self.txLog
+
+  def _busFailure(self, fRet, what):
+    """a transaction failed: forget the shadow, close the adapter and raise"""
+    self.shadow.invalidate()
+    if self.txLog is not None:
+      self.txLog.record(TX_FAIL, status=fRet)
+      self.txLog.failure()
+    log.error("%s failed (%s), closing the adapter", what, fRet)
+    try:
+      self.closeSPI()
+    except:
+      pass
+    raise SpiInitException(fRet, what)
+
+  @_serialized
+  def initSpi(self):
     """ 
     opens the connection to the SPI bus and sets the clock
     """
     #open spi
-    print("Searching for SPI Interface")
+    log.debug("Searching for SPI Interface")
 
-    cls.testSPI = SPI()
-    fRet = cls.testSPI.ioOpen()
+    #new session -- whatever we think the chip holds is stale
+    self.shadow.invalidate()
+
+    self.testSPI = SPI(self.lib)
+    if self.resourceName is None:
+      fRet = self.testSPI.ioOpen()
+    else:
+      fRet = self.testSPI.ioOpenByName(self.resourceName)
     #print('ioOpen():  \t{0}'.format(fRet))
     if fRet != 0:
-      cls.testSPI.ioClose()
+      self.testSPI.ioClose()
       raise SpiInitException(fRet, "ioOpen()")
 
     #set clock rate
-    fRet = cls.testSPI.ioSetConfig(spiClk=1000000)
+    fRet = self.testSPI.ioSetConfig(spiClk=self.spiClk)
     #print('ioSetConfig():\t{0}'.format(fRet))
     if fRet != 0:
-      cls.testSPI.ioClose()
+      self.testSPI.ioClose()
       raise SpiInitException(fRet, "ioSetConfig()")
 
-    fRet = cls.testSPI.ioInit()
+    fRet = self.testSPI.ioInit()
     #print('ioInit():  \t{0}'.format(fRet))
     if fRet != 0:
-      cls.testSPI.ioClose()
+      self.testSPI.ioClose()
       raise SpiInitException(fRet, "ioInit()")
 
-    print("SPI initialized successfully")
+    log.info("SPI initialized successfully")
 
-  @classmethod
-  def closeSPI(cls):
+  @_serialized
+  def closeSPI(self):
     """
     Close the SPI port and reset all ports to 0V
     """
-    r = cls.testSPI.ioSafe()
-    r1 = cls.testSPI.ioClose()
+    self.shadow.invalidate()
+    r = self.testSPI.ioSafe()
+    r1 = self.testSPI.ioClose()
     if(r == 0 and r1 == 0):
-      print("SPI closed successfully")
+      log.info("SPI closed successfully")
     else: 
       raise SpiInitException(r1, "ioClose()")
+
+  def invalidateShadow(self, payloadOnly=False):
+    """
+    Forces the next setBeam to rewrite both the DIO lines and the payload
+    (payloadOnly=True: just the payload, the DIO lines are trusted)
+    """
+    dio = self.shadow.dio
+    self.shadow.invalidate()
+    if payloadOnly:
+      self.shadow.dio = dio
     
-  @classmethod
-  def setBeam(cls, mode, NE_phase, SE_phase, SW_phase, NW_phase,
-                    NE_amp, SE_amp, SW_amp, NW_amp):
+  @_serialized
+  def setBeam(self, mode, NE_phase, SE_phase, SW_phase, NW_phase,
+                    NE_amp, SE_amp, SW_amp, NW_amp, force=False):
     """
     Writes fake signals on to the the spi bus.
       Doesn't actually use Anokiwave's SPI interface because I signed an NDA
+
+    Only sends what differs from the shadow of the last committed state:
+      an identical request returns the previous read back without touching
+      the bus, and a mode change to an already latched payload only writes
+      the DIO lines. force=True always writes everything.
+
+    On a daisy chain every chip gets the same settings.
     """
-      
-    #determine message and pack it 
-    unpackedData = []
-    fRet = 0
-    if(mode == RX_MODE):
-      print("Writing in RX_MODE")
-      fRet = cls.testSPI.ioWriteDIO(2) #Set DIO RX_EN pin
-      unpackedData = [NE_phase, NE_amp,
-                   0x3D9, 0x3D9,
-                   SE_phase, SE_amp,
-                   0x3D9, 0x3D9,
-                   SW_phase, SW_amp,
-                   0x379, 0x379,
-                   NW_phase, NW_amp,
-                   0x379, 0x379]
-    elif(mode == TX_MODE):
-      print("Writing in TX_MODE")
-      fRet = cls.testSPI.ioWriteDIO(1)
-      unpackedData = [0x3DF, 0x3DF,
-                   NE_phase, NE_amp,
-                   0x3DF, 0x3DF,
-                   SE_phase, SE_amp,
-                   0x37F, 0x37F,
-                   SW_phase, SW_amp,
-                   0x37F, 0x37F,
-                   NW_phase, NW_amp]
-    elif(mode == SB_MODE):
-      print("SB mode")
-      fRet = cls.testSPI.ioWriteDIO(0)
-      return []#Nothing programmed
+    beam = (NE_phase, SE_phase, SW_phase, NW_phase, NE_amp, SE_amp, SW_amp, NW_amp)
+    return self.setChainBeams(mode, [beam] * self.chain.nChips, force)
+
+  @_serialized
+  def setChainBeams(self, mode, beams, force=False):
+    """
+    Programs every chip of the daisy chain in one transaction
+      beams[i] = setBeam settings (NE_phase, ..., NW_amp) for logical chip i
+    All chips latch on the same LDB strobe. Same shadow rules as setBeam
+    """
+    return self.commitFrame(self.prepareFrame(mode, beams), force)
+
+  @_serialized
+  def setChipBeam(self, chip, mode, NE_phase, SE_phase, SW_phase, NW_phase,
+                        NE_amp, SE_amp, SW_amp, NW_amp, force=False):
+    """
+    Programs logical chip of the daisy chain; the other chips are rewritten
+    with the beams the shadow has for them. If the shadow doesn't know them
+    (nothing latched yet, or the lines are in a mode that programs nothing)
+    every chip gets this beam, as with setBeam
+    """
+    if not 0 <= chip < self.chain.nChips:
+      raise ValueError("chip {0} isn't on a chain of {1}".format(chip, self.chain.nChips))
+    beam = (NE_phase, SE_phase, SW_phase, NW_phase, NE_amp, SE_amp, SW_amp, NW_amp)
+    beams = self.shadowBeams()
+    if beams is None:
+      beams = [beam] * self.chain.nChips
     else:
-      fRet = cls.testSPI.ioWriteDIO(3)
-      print("RX_11 mode is not implemented ") 
-      return []
+      beams[chip] = beam
+    return self.setChainBeams(mode, beams, force)
 
-    if fRet != 0:
-      try:
-        self.closeSPI()
-      except: 
-        pass 
-      raise SpiInitException(fRet, "ioWriteDIO()")
+  def shadowBeams(self):
+    """setBeam settings of each logical chip as last latched, None if not known"""
+    slots = _BEAM_WORDS.get(self.shadow.dio)
+    if slots is None or self.shadow.frame is None:
+      return None
+    return [tuple(words[i] for i in slots) for words in self.chain.split(self.shadow.frame)]
+
+  def prepareFrame(self, mode, beams):
+    """
+    Builds and packs a chain frame ahead of time (nothing touches the bus)
+      beams[i] = setBeam settings for logical chip i
+    returns a PreparedFrame for commitFrame/commitSequence
+    """
+    dio, unpackedData = self.chain.build(mode, beams)
+    packed = self.__packValues(unpackedData) if unpackedData is not None else None
+    return PreparedFrame(mode, dio, unpackedData, packed)
 
-    wArr = cls.__packValues(unpackedData)
+  @_serialized
+  def commitFrame(self, frame, force=False):
+    """
+    Writes a PreparedFrame. Same shadow rules as setBeam
+    """
+    if force:
+      self.shadow.invalidate()
+
+    mode = frame.mode
+    dio = frame.dio
+    unpackedData = frame.words
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug("Writing in %s", MODE_NAMES.get(mode, mode))
+    if mode == RX_11_MODE:
+      log.warning("RX_11 mode is not implemented")
+
+    if dio != self.shadow.dio:
+      fRet = self.testSPI.ioWriteDIO(dio)
+      if fRet != 0:
+        self._busFailure(fRet, "ioWriteDIO()")
+      if self.txLog is not None:
+        self.txLog.record(TX_DIO, dio)
+      self.shadow.dio = dio
+
+    if unpackedData is None:
+      return []#Nothing programmed
+
+    if unpackedData == self.shadow.frame:
+      return self.shadow.readBack #already latched
+
+    wArr = frame.packed
     # ioWriteSPI hits LDB pin automatically
-    rData, fRet = cls.testSPI.ioWriteSPI2(wArr, 8) #send bits 8
+    rData, fRet = self.testSPI.ioWriteSPI2(wArr, 8) #send bits 8
 
     if fRet != 0:
-      try:
-        self.closeSPI()
-      except:
-        pass
-      raise SpiInitException(fRet, "ioWriteSPI2")
+      self._busFailure(fRet, "ioWriteSPI2")
+    if self.txLog is not None:
+      self.txLog.record(TX_WRITE, dio, payload=wArr)
+
+    #frame N comes back out while frame N+1 goes in
+    if self.verifyCallback is not None and self.shadow.packed is not None:
+      self._verify(self.shadow.frame, self.shadow.packed, rData)
 
+    self.shadow.frame = unpackedData
+    self.shadow.packed = wArr
+    self.shadow.readBack = rData
     return rData #return data from device
+
+  @_serialized
+  def commitSequence(self, frames, gapsUs=None):
+    """
+    Writes several PreparedFrames in one adapter script: one USB round trip,
+    each frame latched by its own LDB strobe, gapsUs[i] us after frame i
+    timed by the adapter. Mode changes are scripted on the DIO lines.
+    frames can also be a PreparedSequence, whose script is only run here.
+    returns the read back of each frame ([] where nothing was written)
+    """
+    if isinstance(frames, PreparedSequence):
+      sequence, frames = frames, frames.frames
+      if sequence.script is None:
+        return []
+      rFrames, fRet = self.testSPI.ioRunSPI2Seq(sequence.script)
+    else:
+      if not frames:
+        return []
+      rFrames, fRet = self.testSPI.ioWriteSPI2Seq([f.packed for f in frames],
+                                                  self._sequenceDios(frames, self.shadow.dio), gapsUs, 8)
+
+    if fRet != 0:
+      self._busFailure(fRet, "ioWriteSPI2Seq")
+    if len(rFrames) != len(frames):
+      return rFrames #adapter not open: nothing went out, so the chip is as it was
+    if self.txLog is not None:
+      for f in frames:
+        self.txLog.record(TX_SEQ, f.dio, payload=f.packed)
+
+    self.shadow.dio = frames[-1].dio
+    written = [(f, r) for f, r in zip(frames, rFrames) if f.words is not None]
+    if written:
+      if self.verifyCallback is not None:
+        #each frame's read back is the one latched before it
+        previous = (self.shadow.frame, self.shadow.packed)
+        for f, r in written:
+          if previous[1] is not None:
+            self._verify(previous[0], previous[1], r)
+          previous = (f.words, f.packed)
+      f, r = written[-1]
+      self.shadow.frame = f.words
+      self.shadow.packed = f.packed
+      self.shadow.readBack = r
+    return rFrames
+
+  @staticmethod
+  def _sequenceDios(frames, dio):
+    """DIO value to script before each frame, None where the lines already match"""
+    dios = []
+    for f in frames:
+      dios.append(f.dio if f.dio != dio else None)
+      dio = f.dio
+    return dios
+
+  @_serialized
+  def prepareSequence(self, frames, gapsUs=None):
+    """
+    Builds the commitSequence script for frames now, so that committing it
+    only has to run it. The DIO lines are always set for the first frame, as
+    the shadow may have moved on by then. Free it with releaseSequence
+    """
+    if not frames:
+      return PreparedSequence([], None)
+    script, fRet = self.testSPI.ioPrepareSPI2Seq([f.packed for f in frames],
+                                                 self._sequenceDios(frames, None), gapsUs, 8)
+    if fRet != 0:
+      self._busFailure(fRet, "ioPrepareSPI2Seq")
+    return PreparedSequence(list(frames), script)
+
+  @_serialized
+  def releaseSequence(self, sequence):
+    """frees the adapter script of a PreparedSequence"""
+    if sequence.script is not None:
+      self.testSPI.ioCloseSPI2Seq(sequence.script)
+
+  def enableVerify(self, callback):
+    """
+    Turns on verified programming. callback(VerifyMismatch) is called on a
+    separate thread for every frame that didn't read back as written
+    """
+    if self._verifyPool is None:
+      self._verifyPool = ThreadPoolExecutor(max_workers=1)
+    self.verifyCount = 0
+    self.mismatchCount = 0
+    self.verifyCallback = callback
+
+  def disableVerify(self):
+    self.verifyCallback = None
+
+  @_serialized
+  def flushVerify(self):
+    """
+    Checks the last frame of a sequence, which no later write will shift out.
+    Costs one read back. Returns True if it matched (or nothing to check)
+    """
+    if self.shadow.frame is None:
+      return True
+    actual = self.readRegisters()
+    self.verifyCount += 1
+    if actual == self.shadow.frame:
+      return True
+    self._reportMismatch(self.shadow.frame, actual)
+    return False
+
+  def _verify(self, expectedFrame, expectedPacked, rData):
+    self.verifyCount += 1
+    if rData != expectedPacked:
+      self._reportMismatch(expectedFrame, self._unpackValues(rData, len(expectedFrame)))
+
+  def _reportMismatch(self, expected, actual):
+    self.mismatchCount += 1
+    callback = self.verifyCallback
+    if callback is None:
+      return
+    words = [i for i, (e, a) in enumerate(zip(expected, actual)) if e != a]
+    self._verifyPool.submit(callback, VerifyMismatch(time.time(), list(expected), actual, words))
+
+  @_serialized
+  def readRegisters(self):
+    """
+    Clocks the latched payload back out without strobing LDB
+    returns the FRAME_WORDS words per chip in the order setChainBeams builds them
+    """
+    rData = self.testSPI.ioReadSPI2(FRAME_WORDS * self.chain.nChips, 12)
+    if not isinstance(rData, list):
+      if self.txLog is not None:
+        self.txLog.record(TX_FAIL, status=rData)
+        self.txLog.failure()
+      raise SpiInitException(rData, "ioReadSPI2()")
+    if self.txLog is not None:
+      self.txLog.record(TX_READ, self.shadow.dio or 0, payload=b"".join(w.to_bytes(2, "big") for w in rData))
+    #first word out is the last one packed
+    return rData[::-1]
+
+  @staticmethod
+  def _modeFrame(mode, NE_phase, SE_phase, SW_phase, NW_phase,
+                       NE_amp, SE_amp, SW_amp, NW_amp):
+    """
+    returns (dio, payload) for a request
+      dio       value for the DIO port (bit 0 = TX_EN, bit 1 = RX_EN)
+      payload   list of 16 12-bit words to latch, None if nothing is programmed
+    """
+    if(mode == RX_MODE):
+      return 2, [NE_phase, NE_amp,
+                 0x3D9, 0x3D9,
+                 SE_phase, SE_amp,
+                 0x3D9, 0x3D9,
+                 SW_phase, SW_amp,
+                 0x379, 0x379,
+                 NW_phase, NW_amp,
+                 0x379, 0x379]
+    elif(mode == TX_MODE):
+      return 1, [0x3DF, 0x3DF,
+                 NE_phase, NE_amp,
+                 0x3DF, 0x3DF,
+                 SE_phase, SE_amp,
+                 0x37F, 0x37F,
+                 SW_phase, SW_amp,
+                 0x37F, 0x37F,
+                 NW_phase, NW_amp]
+    elif(mode == SB_MODE):
+      return 0, None
+    else:
+      return 3, None
     
 
   @staticmethod
+  @timed("awmf.packValues")
   def __packValues(vals, in_width = 12, packed_size = 8, big_endian=True):
     """
     takes a list of values (integers) and packs them as densely
@@ -179,16 +587,32 @@ class AwmfCommander:
 
     return byteArray
 
+  @staticmethod
+  def _unpackValues(byteArray, n_vals, in_width = 12, packed_size = 8, big_endian=True):
+    """
+    inverse of __packValues: returns the first n_vals values packed in byteArray
+    """
+    if big_endian:
+      byteArray = byteArray[::-1]
+    bits = 0
+    for i, b in enumerate(byteArray):
+      bits |= b << (i * packed_size)
+    mask = (1 << in_width) - 1
+    return [(bits >> (in_width * k)) & mask for k in range(n_vals)]
+
 
 
 # ------------------------------------------------------------------------------
 # Tests 
 # ------------------------------------------------------------------------------
 def main():
+  logging.basicConfig(level=logging.INFO, format="%(name)s: %(message)s")
 
   pvTest = False
   dioTest = False
   spiTest = True
+  verifyTest = False
+  chainTest = False
   
   ######__pack_values
   if pvTest:
@@ -196,47 +620,89 @@ def main():
     c1 = pv(range(20))
     pass #break here and inspect manually
 
+  awmf = AwmfCommander()
+
   ##### Verify dio pins 
   if dioTest:
     print("**Interactive setBeam test. Get out an o'scope")
-    AwmfCommander.initSpi()
+    awmf.initSpi()
 
     print("Verify that everything is low")
     _ = raw_input("Press Enter to continue: \n")
 
 
-    r = AwmfCommander.setBeam(RX_11_MODE, 16, 16, 1, 1, 8, 8, 8, 8)
+    r = awmf.setBeam(RX_11_MODE, 16, 16, 1, 1, 8, 8, 8, 8)
     print(r)
     print("Verify that RX_EN and TX_EN are high")
     _ = raw_input("Press Enter to continue: \n")
     
-    r = AwmfCommander.setBeam(RX_MODE, 16, 16, 1, 1, 8, 8, 8, 8)
+    r = awmf.setBeam(RX_MODE, 16, 16, 1, 1, 8, 8, 8, 8)
     print(r)
     print("Verify that RX_EN is high")
     _ = raw_input("Press Enter to continue: \n")
     
-    r = AwmfCommander.setBeam(TX_MODE, 16, 16, 1, 1, 8, 8, 8, 8)
+    r = awmf.setBeam(TX_MODE, 16, 16, 1, 1, 8, 8, 8, 8)
     print(r)
     print("Verify that TX_EN is high")
     _ = raw_input("Press Enter to continue: \n")
     
-    r = AwmfCommander.setBeam(SB_MODE, 16, 16, 1, 1, 8, 8, 8, 8)
+    r = awmf.setBeam(SB_MODE, 16, 16, 1, 1, 8, 8, 8, 8)
     print(r)
     assert(r == [])
     print("Verify that TX_EN and RX_EN are low")
     _ = raw_input("Press Enter to continue: \n")
     
-    AwmfCommander.closeSPI()    
+    awmf.closeSPI()    
     
   if spiTest:
-    AwmfCommander.initSpi()
+    awmf.initSpi()
     
     print("** Look at what the spi bus says when its talking")
     for x in range(10):
       for d in range(32):
-        r = AwmfCommander.setBeam(RX_MODE, 5, 6, 7, 8, 9, 10, 11, 12)
+        r = awmf.setBeam(RX_MODE, 5, 6, 7, 8, 9, 10, 11, 12)
         
-    AwmfCommander.closeSPI()
+    awmf.closeSPI()
+
+  ##### Verified programming against the emulated chip, one upset injected
+  if verifyTest:
+    from awmfemu import emulatedLib
+    lib, chip = emulatedLib()
+    awmf = AwmfCommander(lib=lib)
+    awmf.initSpi()
+    awmf.enableVerify(lambda m: print("mismatch in words {0}".format(m.words)))
+
+    for d in range(32):
+      awmf.setBeam(RX_MODE, d, 6, 7, 8, 9, 10, 11, 12)
+      if d == 16:
+        chip.latched ^= 1 << 40 #flip a latched bit
+
+    awmf.flushVerify()
+    print("verified {0} frames, {1} mismatches".format(awmf.verifyCount,
+                                                       awmf.mismatchCount))
+    awmf.disableVerify()
+    awmf.closeSPI()
+
+  ##### Three emulated chips on one chain, wired out of order
+  if chainTest:
+    from ni845xsim import Ni845xSim
+    from awmfemu import Awmf0108Chain
+    lib = Ni845xSim()
+    chips = Awmf0108Chain(3)
+    lib.attach(chips)
+    awmf = AwmfCommander(lib=lib, chainLength=3, chainOrder=[2, 0, 1])
+    awmf.initSpi()
+
+    beams = [(c, c, c, c, 8 + c, 8, 8, 8) for c in range(3)]
+    awmf.setChainBeams(TX_MODE, beams)
+    byChip = [chips.chips[pos] for pos in awmf.chain.chainOrder]
+    for c, chip in enumerate(byChip):
+      print("chip {0}: {1}".format(c, chip.getActiveChannels()))
+
+    readBack = awmf.chain.split(awmf.readRegisters())
+    print("latches: {0}, read back ok: {1}".format(byChip[0].latchCount,
+          readBack == [chip.registers for chip in byChip]))
+    awmf.closeSPI()
 
 if __name__ == '__main__':
     main()
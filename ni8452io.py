@@ -22,6 +22,22 @@
 # 1.00.07  16-05-23   Added ioWriteSPI3(): workaround protocol for ODIN
 # 1.00.08  17-01-06   Added support for Mercury chipset
 # 1.00.09  17-05-19   Added ioWritePulse() for Mercury OTP
+# 1.00.10  26-10-19   Pluggable driver backend: SPI(lib=...) or
+#                     NI845X_BACKEND=sim for the ni845xsim stand-in
+# 1.00.11  26-10-19   loadLibrary() caches the loaded driver across SPI()
+# 1.00.12  26-10-19   ioWriteSPI2()/ioReadSPI2(): whole payload per WriteRead
+#                     (up to maxXferBytes), reused ctypes buffers, one
+#                     contiguous read-back. bulkXfer=False restores per word
+# 1.00.13  26-10-19   ioOpenByName() accepts str resource names (python3)
+# 1.00.14  26-10-19   Added ioWriteSPI2Seq(): several latched frames, DIO
+#                     changes and timed gaps in one script run
+# 1.00.15  26-10-19   Script build/run/extract timed as stagetime stages
+# 1.00.16  26-10-19   Diagnostic prints go through logging (awmf.ni8452io)
+# 1.00.17  26-10-19   NI845X_CAPTURE records driver calls, NI845X_BACKEND=
+#                     replay plays a capture back (spicapture)
+# 1.00.18  26-10-19   ioWriteSPI2Seq() returns ([], -1) for a bad wordSize
+# 1.00.19  26-10-19   ioPrepareSPI2Seq()/ioRunSPI2Seq(): build a sequence
+#                     script on its own handle ahead of time, run it later
 #-------------------------------------------------------------------------------
 
 
@@ -31,14 +47,65 @@
 #
 #-------------------------------------------------------------------------------
 import ctypes as c
+import os
+import struct
 import sys
+import threading
+from collections import namedtuple
+
+from stagetime import stage
+from awmflog import getLogger
+
+log = getLogger("ni8452io")
+
+# A sequence script built ahead of time by SPI.ioPrepareSPI2Seq()
+#   handle   its own driver script handle
+#   steps    per frame (first read, payload length, bytes per word, words), None = no write
+#   reads    (read index, offset, size) of every WriteRead
+#   Nbytes   payload bytes in all
+SeqScript = namedtuple('SeqScript', ['handle', 'steps', 'reads', 'Nbytes'])
+
+# Driver handle shared by every SPI() once it has loaded
+_libCache = {}
+_libLock = threading.Lock()
+
+def loadLibrary():
+    '''Returns the ni845x driver selected by the NI845X_BACKEND environment
+    variable: "sim" for the pure python simulator, "replay" to play back the
+    capture named by NI845X_REPLAY, otherwise Ni845x.dll.
+    NI845X_CAPTURE=<file> records every call to the driver in that file
+    (see spicapture).
+    The library is only loaded once per backend; failures are not cached so
+    a later call can still succeed. Raises if the library can't be loaded'''
+    backend = os.environ.get('NI845X_BACKEND', 'dll').lower()
+    with _libLock:
+        lib = _libCache.get(backend)
+        if lib is None:
+            if backend == 'sim':
+                import ni845xsim
+                lib = ni845xsim.Ni845xSim()
+            elif backend == 'replay':
+                import spicapture
+                lib = spicapture.ReplayLib(os.environ['NI845X_REPLAY'])
+            else:
+                fSpec = 'c:/windows/system32/Ni845x.dll'
+                lib = c.windll.LoadLibrary(fSpec)
+            capture = os.environ.get('NI845X_CAPTURE')
+            if capture:
+                import spicapture
+                lib = spicapture.CaptureLib(lib, capture)
+            _libCache[backend] = lib
+    return lib
+
 
 class SPI(object):
-    def __init__(self):
+    def __init__(self, lib=None):
+        '''lib: object providing the ni845x* calls (e.g. ni845xsim.Ni845xSim).
+        None loads the backend chosen by loadLibrary()'''
 
         # Version info
-        self.__version =    '1.00.09'
-        self.__versDate =   '17-05-19'
+        self.__version =    '1.00.19'
+        self.__versDate =   '26-10-19'
         self.__versStatus = 'Released'
 
         # cType parameters
@@ -62,6 +129,12 @@ class SPI(object):
         self.delayLDB    = 10        # LDB delay (-ve width) in us
         self.delayCS2LDB = 2         # Delay between CS HIGH and LDB
         self._gpioDir    = 31        # GPIO configuration
+        self.bulkXfer    = True      # ioWriteSPI2/ioReadSPI2: many words per WriteRead
+        self.maxXferBytes = 64       # max bytes per ni845xSpiScriptWriteRead
+
+        # Reused by the bulk transfers
+        self._cWbuf     = (c.c_uint8 * self.maxXferBytes)()
+        self._cIdxRead  = c.c_uint32()
 
         # Status
         self.status   = 0
@@ -75,15 +148,15 @@ class SPI(object):
         # CONSTANTS
         self.__IOPORT = c.c_uint8(0)    # Port# for GPIO on 8452
 
-        # Load Ni8452x.dll
-        self._lspi = None
-        try:
-            fSpec = 'c:/windows/system32/Ni845x.dll'
-            self._lspi = c.windll.LoadLibrary(fSpec)
+        # Load Ni8452x.dll (or the backend we were given)
+        self._lspi = lib
+        if self._lspi is None:
+            try:
+                self._lspi = loadLibrary()
 
-        except:
-            self.status = -1
-            self.errMsg = 'Unable to load Ni845x.dll'
+            except:
+                self.status = -1
+                self.errMsg = 'Unable to load Ni845x.dll'
 
     # --------------------------------------------------------------------------
     # HELPER FUNCTIONS
@@ -100,6 +173,135 @@ class SPI(object):
         return ((byteList[0]<<8)+byteList[1])
 
 
+    def __serialize(self, wData, wordSize):
+        '''Returns (payload bytes, bytes per word): 1 byte per word up to 8
+        bits, else 2 bytes (MSB first)'''
+        if wordSize<9:
+            return bytes([w & 0xFF for w in wData]), 1
+        return struct.pack('>%dH' % len(wData), *[w & 0xFFFF for w in wData]), 2
+
+
+    def __scriptHeader(self, hScr=None):
+        '''Reset the script and set up SPI with CS0 (CSB) and CS1 (LDB) high'''
+        lspi = self._lspi
+        hScr = self._cHdlScr if hScr is None else hScr
+        fRet = 0
+        # Reset script
+        fRet += lspi.ni845xSpiScriptReset(hScr)
+        # Enable SPI
+        fRet += lspi.ni845xSpiScriptEnableSPI(hScr)
+        # Configure polarity and phase
+        fRet += lspi.ni845xSpiScriptClockPolarityPhase(hScr, 0, 0)
+        # Configure clock rate
+        fRet += lspi.ni845xSpiScriptClockRate(hScr, self.spiClk)
+        # Set CS0 HIGH
+        fRet += lspi.ni845xSpiScriptCSHigh(hScr, c.c_uint32(0))
+        # Set CS1 HIGH
+        fRet += lspi.ni845xSpiScriptCSHigh(hScr, c.c_uint32(1))
+        return fRet
+
+
+    def __scriptWords(self, payload, bytesPerWord, wordSize, reads, base=0, hScr=None):
+        '''Adds CS0 low, payload in as few WriteRead operations as
+        maxXferBytes allows, CS0 high. Appends (read index, offset, size) to
+        reads, offsets counted from base. Returns summed status'''
+        lspi = self._lspi
+        hScr = self._cHdlScr if hScr is None else hScr
+        fRet = 0
+        Nbytes = len(payload)
+
+        # Largest whole number of words per WriteRead
+        chunk = max(bytesPerWord, self.maxXferBytes - self.maxXferBytes % bytesPerWord)
+        if len(self._cWbuf) < chunk:
+            self._cWbuf = (c.c_uint8 * chunk)()
+        cWbuf = self._cWbuf
+        cIdx = self._cIdxRead
+
+        # SET CS0 LOW
+        fRet += lspi.ni845xSpiScriptCSLow(hScr, c.c_uint32(0))
+        fRet += lspi.ni845xSpiScriptNumBitsPerSample(hScr, c.c_uint16(wordSize))
+
+        # *** WRITE: one operation per chunk ***
+        for off in range(0, Nbytes, chunk):
+            n = min(chunk, Nbytes - off)
+            c.memmove(cWbuf, payload[off:off+n], n)
+            fRet += lspi.ni845xSpiScriptWriteRead(hScr, c.c_uint32(n), c.byref(cWbuf), c.byref(cIdx))
+            reads.append((cIdx.value, base + off, n))
+
+        # Set CS0 HIGH
+        fRet += lspi.ni845xSpiScriptCSHigh(hScr, c.c_uint32(0))
+        return fRet
+
+
+    def __scriptStrobeLDB(self, hScr=None):
+        '''Pulses LDB (CS1) low after the CS->LDB delay'''
+        lspi = self._lspi
+        hScr = self._cHdlScr if hScr is None else hScr
+        fRet = 0
+        # Set delay: 2us
+        fRet += lspi.ni845xSpiScriptUsDelay(hScr, c.c_uint8(self.delayCS2LDB))
+        # Set CS1 LOW
+        fRet += lspi.ni845xSpiScriptCSLow(hScr, c.c_uint32(1))
+        # Delay LDB us
+        fRet += lspi.ni845xSpiScriptUsDelay(hScr, c.c_uint8(self.delayLDB))
+        # Set CS1 HIGH
+        fRet += lspi.ni845xSpiScriptCSHigh(hScr, c.c_uint32(1))
+        return fRet
+
+
+    def __scriptDelay(self, us, hScr=None):
+        '''Adds a delay of us microseconds (UsDelay takes at most 255)'''
+        hScr = self._cHdlScr if hScr is None else hScr
+        fRet = 0
+        us = int(round(us))
+        while us > 0:
+            d = min(us, 255)
+            fRet += self._lspi.ni845xSpiScriptUsDelay(hScr, c.c_uint8(d))
+            us -= d
+        return fRet
+
+
+    def __extract(self, reads, Nbytes, hScr=None):
+        '''Runs nothing: pulls every read of the last run into one bytearray.
+        Each read is as long as its write. Returns (bytearray, summed status)'''
+        hScr = self._cHdlScr if hScr is None else hScr
+        fRet = 0
+        rBuf = bytearray(Nbytes)
+        for pIdx, off, n in reads:
+            cRdata = (c.c_uint8 * n).from_buffer(rBuf, off)
+            fRet += self._lspi.ni845xSpiScriptExtractReadData(hScr, c.c_uint32(pIdx), c.byref(cRdata))
+        return rBuf, fRet
+
+
+    def __xferWords(self, wData, wordSize, strobeLDB):
+        '''5-wire transfer shared by ioWriteSPI2()/ioReadSPI2(). Clocks all of
+        wData out in as few WriteRead operations as maxXferBytes allows, then
+        extracts the read-back straight into one bytearray.
+        Returns (list of words read back, summed status)'''
+        reads = []
+        with stage("spi.scriptBuild"):
+            payload, bytesPerWord = self.__serialize(wData, wordSize)
+            fRet = self.__scriptHeader()
+            fRet += self.__scriptWords(payload, bytesPerWord, wordSize, reads)
+            if strobeLDB:
+                fRet += self.__scriptStrobeLDB()
+
+        # Run script
+        with stage("spi.scriptRun"):
+            fRet += self._lspi.ni845xSpiScriptRun(self._cHdlScr, self._cHdl, 0)
+
+        with stage("spi.extract"):
+            rBuf, fRetX = self.__extract(reads, len(payload))
+        fRet += fRetX
+
+        if bytesPerWord == 2:
+            wordArr = list(struct.unpack('>%dH' % len(wData), rBuf))
+        else:
+            wordArr = list(rBuf)
+
+        return wordArr, fRet
+
+
     def __errStatus(self, statusCode):
         '''Return error message based on NI8452 error code. Updates
         .status=errCode and .errMsg= NI8452 error string'''
@@ -161,6 +363,8 @@ class SPI(object):
 
         if self._lspi is None:
             return -1
+        if not isinstance(ResourceName, bytes):
+            ResourceName = ResourceName.encode()
         cResourceName = c.create_string_buffer(ResourceName)
 
         fRet = self._lspi.ni845xOpen(cResourceName, c.byref(self._cHdl))
@@ -421,6 +625,9 @@ class SPI(object):
         else:
             wFlag=1
 
+        if self.bulkXfer:
+            return self.__xferWords(wData, wordSize, True)
+
         # Reset script
         fRet += self._lspi.ni845xSpiScriptReset(self._cHdlScr)
         # Enable SPI
@@ -501,6 +708,117 @@ class SPI(object):
 
 
 
+    # --------------------------- ioWriteSPI2Seq() -----------------------------
+    def ioWriteSPI2Seq(self, frames, dios=None, gapsUs=None, wordSize=8):
+        '''Writes several frames in ONE script run (one USB round trip). Each
+        frame is clocked out like ioWriteSPI2() and latched with its own LDB
+        strobe; the adapter times the gaps, not the PC.
+            frames:  list of word lists (None = no SPI write for that step)
+            dios:    optional per step value for DIO lines 0 (TX_EN) and 1
+                     (RX_EN), set before the frame. None leaves them alone
+            gapsUs:  optional per step delay in us after the step
+           Returns (list of read back per frame, fRet)'''
+        if self._lspi is None:
+            return [], 0
+        if wordSize<4 or wordSize>16:
+            return [], -1
+
+        with stage("spi.scriptBuild"):
+            steps, reads, Nbytes, fRet = self.__scriptSeq(self._cHdlScr, frames, dios, gapsUs, wordSize)
+        rFrames, fRetR = self.__runSeq(self._cHdlScr, steps, reads, Nbytes)
+        return rFrames, fRet + fRetR
+
+
+    # --------------------------- ioPrepareSPI2Seq() ---------------------------
+    def ioPrepareSPI2Seq(self, frames, dios=None, gapsUs=None, wordSize=8):
+        '''Builds the ioWriteSPI2Seq() script now, on a script handle of its
+        own, so that running it later (ioRunSPI2Seq) is the only work left at
+        send time. Free it with ioCloseSPI2Seq().
+           Returns (SeqScript, fRet); the script is None if nothing was built'''
+        if self._lspi is None:
+            return None, 0
+        if wordSize<4 or wordSize>16:
+            return None, -1
+
+        hScr = c.c_ulonglong() if sys.version_info[0] == 3 else c.c_ulong()
+        fRet = self._lspi.ni845xSpiScriptOpen(c.byref(hScr))
+        if fRet != 0:
+            return None, fRet
+        with stage("spi.scriptBuild"):
+            steps, reads, Nbytes, fRet = self.__scriptSeq(hScr, frames, dios, gapsUs, wordSize)
+        script = SeqScript(hScr, steps, reads, Nbytes)
+        if fRet != 0:
+            self.ioCloseSPI2Seq(script)
+            return None, fRet
+        return script, 0
+
+
+    # --------------------------- ioRunSPI2Seq() -------------------------------
+    def ioRunSPI2Seq(self, script):
+        '''Runs a script from ioPrepareSPI2Seq(). It can be run again.
+           Returns (list of read back per frame, fRet) like ioWriteSPI2Seq()'''
+        if self._lspi is None:
+            return [], 0
+        return self.__runSeq(script.handle, script.steps, script.reads, script.Nbytes)
+
+
+    # --------------------------- ioCloseSPI2Seq() -----------------------------
+    def ioCloseSPI2Seq(self, script):
+        '''Frees the script handle of an ioPrepareSPI2Seq() script'''
+        if self._lspi is None:
+            return 0
+        return self._lspi.ni845xSpiScriptClose(script.handle)
+
+
+    def __scriptSeq(self, hScr, frames, dios, gapsUs, wordSize):
+        '''Adds the ioWriteSPI2Seq() steps to script hScr.
+           Returns (steps, reads, Nbytes, summed status)'''
+        lspi = self._lspi
+        fRet = self.__scriptHeader(hScr)
+        steps = []          # (first read, payload length, bytes per word, words)
+        reads = []
+        Nbytes = 0
+        for i, wData in enumerate(frames):
+            dio = dios[i] if dios is not None else None
+            if dio is not None:
+                for line in (0, 1):
+                    fRet += lspi.ni845xSpiScriptDioWriteLine(hScr, self.__IOPORT, c.c_uint8(line),
+                                                             c.c_int32((dio >> line) & 1))
+            if wData is not None:
+                payload, bytesPerWord = self.__serialize(wData, wordSize)
+                steps.append((Nbytes, len(payload), bytesPerWord, len(wData)))
+                fRet += self.__scriptWords(payload, bytesPerWord, wordSize, reads, Nbytes, hScr)
+                fRet += self.__scriptStrobeLDB(hScr)
+                Nbytes += len(payload)
+            else:
+                steps.append(None)
+            if gapsUs is not None and gapsUs[i] > 0:
+                fRet += self.__scriptDelay(gapsUs[i], hScr)
+        return steps, reads, Nbytes, fRet
+
+
+    def __runSeq(self, hScr, steps, reads, Nbytes):
+        '''Runs a sequence script and splits the read back per frame'''
+        with stage("spi.scriptRun"):
+            fRet = self._lspi.ni845xSpiScriptRun(hScr, self._cHdl, 0)
+
+        with stage("spi.extract"):
+            rBuf, fRetX = self.__extract(reads, Nbytes, hScr)
+        fRet += fRetX
+
+        rFrames = []
+        for step in steps:
+            if step is None:
+                rFrames.append([])
+                continue
+            off, n, bytesPerWord, Nwords = step
+            if bytesPerWord == 2:
+                rFrames.append(list(struct.unpack_from('>%dH' % Nwords, rBuf, off)))
+            else:
+                rFrames.append(list(rBuf[off:off+n]))
+        return rFrames, fRet
+
+
     # --------------------------- ioWriteSPI3() --------------------------------
     def ioWriteSPI3(self, wData, wordSize=8):
         '''Write wData array over SPI in wordSize chunks using SPIscript
@@ -653,6 +971,9 @@ class SPI(object):
             else:
                 wFlag=1
 
+            if self.bulkXfer:
+                return self.__xferWords(wData, wordSize, False)[0]
+
             # Reset script
             fRet += self._lspi.ni845xSpiScriptReset(self._cHdlScr)
             # Enable SPI
@@ -740,7 +1061,7 @@ class SPI(object):
         else:
             Nclks = addr
 
-        print( Nclks)
+        log.debug('ioWritePulse: %d clocks', Nclks)
 
         # Reset script
         f.append(self._lspi.ni845xSpiScriptReset(self._cHdlScr))
@@ -0,0 +1,451 @@
+#-------------------------------------------------------------------------------
+# Name:        ni845x simulator
+# Purpose:     Pure python stand-in for Ni845x.dll so the SPI class can run
+#              (and be timed) without the USB adapter or windows
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# Usage:
+#
+#   spi = SPI(lib=Ni845xSim())      # or set NI845X_BACKEND=sim
+#
+# Every ni845x* entry point used by ni8452io is implemented with the same
+# argument conventions as the dll (ctypes values, c.byref() out parameters).
+# SpiScript calls are recorded and only executed on ni845xSpiScriptRun, like
+# the real adapter. Whatever is on the other end of the bus is a "device":
+#
+#   device.csLow(line) / device.csHigh(line)    chip select edges (CS1 = LDB)
+#   device.transfer(value, nBits) -> value      clock nBits MSB first
+#   device.dioWrite(portValue)                  DIO port changed
+#
+# The default device is a MOSI->MISO loopback.
+#
+# Timing model: each USB transaction costs usbLatency seconds plus the time
+# the script keeps the bus busy (bits / SPI clock + us delays). The modelled
+# time is accumulated in adapter.busTime; with realTime=True the calls also
+# block for that long so wall clock benchmarks look like the real thing.
+#
+# A script reaches the adapter half a round trip after ni845xSpiScriptRun is
+# called. Each rising edge of the strobe chip select (CS1, the chips' LDB) is
+# time stamped on the perf_counter clock at that point plus the bus time the
+# script has used so far; takeStrobeTimes() hands the stamps over.
+#-------------------------------------------------------------------------------
+import ctypes as c
+import time
+import threading
+from collections import Counter, deque
+
+#simulated status codes (negative = error, like the real driver)
+kSimSuccess = 0
+kSimErrNoDevice = -301700
+kSimErrInvalidHandle = -301701
+kSimErrInvalidIndex = -301702
+kSimErrBadParameter = -301703
+
+_statusText = {
+    kSimSuccess:            'Success (simulated)',
+    kSimErrNoDevice:        'Simulated adapter not found',
+    kSimErrInvalidHandle:   'Invalid simulated handle',
+    kSimErrInvalidIndex:    'Invalid script read index',
+    kSimErrBadParameter:    'Invalid parameter',
+}
+
+DEFAULT_RESOURCE = b'USB0::0x3923::0x7514::SIM0::RAW'
+
+
+def _val(x):
+    '''Plain python value of a ctypes scalar (or of an int)'''
+    return x.value if hasattr(x, 'value') else x
+
+
+def _obj(ref):
+    '''Object behind a c.byref() argument'''
+    return getattr(ref, '_obj', ref)
+
+
+class Loopback(object):
+    '''Default device: MISO is wired to MOSI'''
+    def csLow(self, line):
+        pass
+
+    def csHigh(self, line):
+        pass
+
+    def transfer(self, value, nBits):
+        return value
+
+    def dioWrite(self, portValue):
+        pass
+
+
+class SimAdapter(object):
+    '''State of one simulated NI-845x: attached device, DIO port and bus time'''
+    def __init__(self, name, device=None):
+        self.name = name
+        self.device = device if device is not None else Loopback()
+        self.dioPort = 0
+        self.vio = 0
+        self.lineDirection = 0
+        self.busTime = 0.0          # modelled seconds spent on USB + SPI
+        self.transactions = 0       # USB round trips
+        self.strobeTimes = deque(maxlen=4096)   # perf_counter time of each strobe
+
+
+class Ni845xSim(object):
+    '''Simulated Ni845x.dll
+
+    adapters        list of resource names (bytes) that ni845xFindDevice reports
+    usbLatency      seconds per USB round trip
+    maxClockKHz     fastest SPI clock the adapter really supports
+    realTime        block for the modelled time on every transaction
+    logDepth        number of executed scripts kept in scriptLog
+    strobeLine      chip select whose rising edges are time stamped
+    '''
+    def __init__(self, adapters=None, usbLatency=1e-3, maxClockKHz=50000,
+                 realTime=False, logDepth=64, strobeLine=1):
+        self.usbLatency = usbLatency
+        self.maxClockKHz = maxClockKHz
+        self.realTime = realTime
+        self.strobeLine = strobeLine
+
+        self.adapters = {}
+        for name in (adapters or [DEFAULT_RESOURCE]):
+            self.addAdapter(name)
+
+        self.calls = Counter()                  # ni845x* call counts
+        self.scriptLog = deque(maxlen=logDepth) # (time, adapter name, ops)
+
+        self._lock = threading.Lock()
+        self._nextHandle = 1
+        self._handles = {}          # device handle -> SimAdapter
+        self._scripts = {}          # script handle -> list of ops
+        self._readData = {}         # script handle -> list of bytes
+
+    # --------------------------------------------------------------------------
+    # SIMULATION CONTROL
+    # --------------------------------------------------------------------------
+    def addAdapter(self, name, device=None):
+        '''Plugs in another adapter. Returns its SimAdapter'''
+        if not isinstance(name, bytes):
+            name = name.encode()
+        adapter = SimAdapter(name, device)
+        self.adapters[name] = adapter
+        return adapter
+
+    def attach(self, device, name=None):
+        '''Connects device to the bus of adapter name (default: the first one)'''
+        if name is None:
+            name = next(iter(self.adapters))
+        elif not isinstance(name, bytes):
+            name = name.encode()
+        self.adapters[name].device = device
+
+    def resetCounters(self):
+        self.calls.clear()
+        for adapter in self.adapters.values():
+            adapter.busTime = 0.0
+            adapter.transactions = 0
+
+    def takeStrobeTimes(self, name=None):
+        '''Strobe time stamps of adapter name (default: the first one) since the last call'''
+        if name is None:
+            name = next(iter(self.adapters))
+        elif not isinstance(name, bytes):
+            name = name.encode()
+        stamps = self.adapters[name].strobeTimes
+        out = list(stamps)
+        stamps.clear()
+        return out
+
+    def _newHandle(self):
+        with self._lock:
+            h = self._nextHandle
+            self._nextHandle += 1
+        return h
+
+    def _usb(self, adapter, busy=0.0, start=None):
+        '''Account for one USB round trip that keeps the bus busy for busy s.
+        start is the perf_counter time the call began, if it has been running'''
+        t = self.usbLatency + busy
+        adapter.busTime += t
+        adapter.transactions += 1
+        if self.realTime and t > 0:
+            if start is not None:
+                t -= time.perf_counter() - start
+            if t > 0:
+                time.sleep(t)
+
+    # --------------------------------------------------------------------------
+    # DEVICE / SESSION
+    # --------------------------------------------------------------------------
+    def ni845xFindDevice(self, firstDevice, findHandle, numFound):
+        self.calls['ni845xFindDevice'] += 1
+        names = list(self.adapters)
+        _obj(numFound).value = len(names)
+        if names:
+            _obj(firstDevice).value = names[0]
+        _obj(findHandle).value = self._newHandle()
+        return kSimSuccess
+
+    def ni845xOpen(self, resourceName, deviceHandle):
+        self.calls['ni845xOpen'] += 1
+        name = _obj(resourceName).value
+        adapter = self.adapters.get(name)
+        if adapter is None:
+            return kSimErrNoDevice
+        h = self._newHandle()
+        self._handles[h] = adapter
+        _obj(deviceHandle).value = h
+        self._usb(adapter)
+        return kSimSuccess
+
+    def ni845xClose(self, deviceHandle):
+        self.calls['ni845xClose'] += 1
+        if self._handles.pop(_val(deviceHandle), None) is None:
+            return kSimErrInvalidHandle
+        return kSimSuccess
+
+    def ni845xStatusToString(self, statusCode, maxSize, statusString):
+        self.calls['ni845xStatusToString'] += 1
+        text = _statusText.get(_val(statusCode), 'Unknown simulated error')
+        _obj(statusString).value = text.encode()[:_val(maxSize) - 1]
+        return kSimSuccess
+
+    def ni845xSetIoVoltageLevel(self, deviceHandle, vio):
+        self.calls['ni845xSetIoVoltageLevel'] += 1
+        adapter = self._handles.get(_val(deviceHandle))
+        if adapter is None:
+            return kSimErrInvalidHandle
+        adapter.vio = _val(vio)
+        self._usb(adapter)
+        return kSimSuccess
+
+    # --------------------------------------------------------------------------
+    # DIO
+    # --------------------------------------------------------------------------
+    def ni845xDioSetPortLineDirectionMap(self, deviceHandle, port, direction):
+        self.calls['ni845xDioSetPortLineDirectionMap'] += 1
+        adapter = self._handles.get(_val(deviceHandle))
+        if adapter is None:
+            return kSimErrInvalidHandle
+        adapter.lineDirection = _val(direction)
+        self._usb(adapter)
+        return kSimSuccess
+
+    def ni845xDioWritePort(self, deviceHandle, port, value):
+        self.calls['ni845xDioWritePort'] += 1
+        adapter = self._handles.get(_val(deviceHandle))
+        if adapter is None:
+            return kSimErrInvalidHandle
+        adapter.dioPort = _val(value) & 0xFF
+        adapter.device.dioWrite(adapter.dioPort)
+        self._usb(adapter)
+        return kSimSuccess
+
+    def ni845xDioReadPort(self, deviceHandle, port, value):
+        self.calls['ni845xDioReadPort'] += 1
+        adapter = self._handles.get(_val(deviceHandle))
+        if adapter is None:
+            return kSimErrInvalidHandle
+        _obj(value).value = adapter.dioPort
+        self._usb(adapter)
+        return kSimSuccess
+
+    # --------------------------------------------------------------------------
+    # SPI SCRIPT: recording
+    # --------------------------------------------------------------------------
+    def ni845xSpiScriptOpen(self, scriptHandle):
+        self.calls['ni845xSpiScriptOpen'] += 1
+        h = self._newHandle()
+        self._scripts[h] = []
+        self._readData[h] = []
+        _obj(scriptHandle).value = h
+        return kSimSuccess
+
+    def ni845xSpiScriptClose(self, scriptHandle):
+        self.calls['ni845xSpiScriptClose'] += 1
+        h = _val(scriptHandle)
+        if self._scripts.pop(h, None) is None:
+            return kSimErrInvalidHandle
+        self._readData.pop(h, None)
+        return kSimSuccess
+
+    def _record(self, name, scriptHandle, *args):
+        self.calls[name] += 1
+        ops = self._scripts.get(_val(scriptHandle))
+        if ops is None:
+            return kSimErrInvalidHandle
+        ops.append((name, args))
+        return kSimSuccess
+
+    def ni845xSpiScriptReset(self, scriptHandle):
+        self.calls['ni845xSpiScriptReset'] += 1
+        h = _val(scriptHandle)
+        if h not in self._scripts:
+            return kSimErrInvalidHandle
+        self._scripts[h] = []
+        return kSimSuccess
+
+    def ni845xSpiScriptEnableSPI(self, scriptHandle):
+        return self._record('ni845xSpiScriptEnableSPI', scriptHandle)
+
+    def ni845xSpiScriptDisableSPI(self, scriptHandle):
+        return self._record('ni845xSpiScriptDisableSPI', scriptHandle)
+
+    def ni845xSpiScriptClockPolarityPhase(self, scriptHandle, polarity, phase):
+        return self._record('ni845xSpiScriptClockPolarityPhase', scriptHandle,
+                            _val(polarity), _val(phase))
+
+    def ni845xSpiScriptClockRate(self, scriptHandle, clockRate):
+        return self._record('ni845xSpiScriptClockRate', scriptHandle, _val(clockRate))
+
+    def ni845xSpiScriptCSHigh(self, scriptHandle, chipSelect):
+        return self._record('ni845xSpiScriptCSHigh', scriptHandle, _val(chipSelect))
+
+    def ni845xSpiScriptCSLow(self, scriptHandle, chipSelect):
+        return self._record('ni845xSpiScriptCSLow', scriptHandle, _val(chipSelect))
+
+    def ni845xSpiScriptDioConfigureLine(self, scriptHandle, port, line, direction):
+        return self._record('ni845xSpiScriptDioConfigureLine', scriptHandle,
+                            _val(port), _val(line), _val(direction))
+
+    def ni845xSpiScriptDioWriteLine(self, scriptHandle, port, line, value):
+        return self._record('ni845xSpiScriptDioWriteLine', scriptHandle,
+                            _val(port), _val(line), _val(value))
+
+    def ni845xSpiScriptNumBitsPerSample(self, scriptHandle, numBits):
+        return self._record('ni845xSpiScriptNumBitsPerSample', scriptHandle, _val(numBits))
+
+    def ni845xSpiScriptUsDelay(self, scriptHandle, delay):
+        return self._record('ni845xSpiScriptUsDelay', scriptHandle, _val(delay))
+
+    def ni845xSpiScriptWriteRead(self, scriptHandle, writeSize, writeData, readIndex):
+        '''Copies the write data now (the caller may reuse its buffer) and
+        returns the read index the data can be extracted from after the run'''
+        self.calls['ni845xSpiScriptWriteRead'] += 1
+        ops = self._scripts.get(_val(scriptHandle))
+        if ops is None:
+            return kSimErrInvalidHandle
+        n = _val(writeSize)
+        data = c.string_at(c.addressof(_obj(writeData)), n)
+        idx = sum(1 for op in ops if op[0] == 'ni845xSpiScriptWriteRead')
+        ops.append(('ni845xSpiScriptWriteRead', (data,)))
+        _obj(readIndex).value = idx
+        return kSimSuccess
+
+    # --------------------------------------------------------------------------
+    # SPI SCRIPT: execution
+    # --------------------------------------------------------------------------
+    def ni845xSpiScriptRun(self, scriptHandle, deviceHandle, port):
+        self.calls['ni845xSpiScriptRun'] += 1
+        start = time.perf_counter()
+        h = _val(scriptHandle)
+        ops = self._scripts.get(h)
+        adapter = self._handles.get(_val(deviceHandle))
+        if ops is None or adapter is None:
+            return kSimErrInvalidHandle
+
+        dev = adapter.device
+        clockHz = 1000.0 * self.maxClockKHz
+        bitsPerSample = 8
+        busy = 0.0
+        readData = []
+        arrive = start + self.usbLatency / 2
+        strobeLow = False
+
+        for name, args in ops:
+            if name == 'ni845xSpiScriptWriteRead':
+                data = args[0]
+                nBytes = (bitsPerSample + 7) // 8
+                mask = (1 << bitsPerSample) - 1
+                out = bytearray()
+                for i in range(0, len(data) - nBytes + 1, nBytes):
+                    v = int.from_bytes(data[i:i + nBytes], 'big') & mask
+                    r = dev.transfer(v, bitsPerSample) & mask
+                    out += r.to_bytes(nBytes, 'big')
+                busy += bitsPerSample * (len(data) // nBytes) / clockHz
+                readData.append(bytes(out))
+            elif name == 'ni845xSpiScriptCSLow':
+                dev.csLow(args[0])
+                if args[0] == self.strobeLine:
+                    strobeLow = True
+            elif name == 'ni845xSpiScriptCSHigh':
+                dev.csHigh(args[0])
+                if args[0] == self.strobeLine and strobeLow:
+                    adapter.strobeTimes.append(arrive + busy)
+                    strobeLow = False
+            elif name == 'ni845xSpiScriptNumBitsPerSample':
+                bitsPerSample = args[0]
+            elif name == 'ni845xSpiScriptClockRate':
+                clockHz = 1000.0 * min(args[0], self.maxClockKHz)
+            elif name == 'ni845xSpiScriptUsDelay':
+                busy += args[0] * 1e-6
+            elif name == 'ni845xSpiScriptDioWriteLine':
+                _, line, value = args
+                if value:
+                    adapter.dioPort |= (1 << line)
+                else:
+                    adapter.dioPort &= ~(1 << line) & 0xFF
+                dev.dioWrite(adapter.dioPort)
+
+        self._readData[h] = readData
+        self.scriptLog.append((time.time(), adapter.name, list(ops)))
+        self._usb(adapter, busy, start)
+        return kSimSuccess
+
+    def ni845xSpiScriptExtractReadDataSize(self, scriptHandle, readIndex, readDataSize):
+        self.calls['ni845xSpiScriptExtractReadDataSize'] += 1
+        data = self._readData.get(_val(scriptHandle))
+        idx = _val(readIndex)
+        if data is None:
+            return kSimErrInvalidHandle
+        if idx >= len(data):
+            return kSimErrInvalidIndex
+        _obj(readDataSize).value = len(data[idx])
+        return kSimSuccess
+
+    def ni845xSpiScriptExtractReadData(self, scriptHandle, readIndex, readData):
+        self.calls['ni845xSpiScriptExtractReadData'] += 1
+        data = self._readData.get(_val(scriptHandle))
+        idx = _val(readIndex)
+        if data is None:
+            return kSimErrInvalidHandle
+        if idx >= len(data):
+            return kSimErrInvalidIndex
+        c.memmove(c.addressof(_obj(readData)), data[idx], len(data[idx]))
+        return kSimSuccess
+
+
+# ------------------------------------------------------------------------------
+# MAIN PROGRAM - TEST HARNESS
+# ------------------------------------------------------------------------------
+def main():
+    from ni8452io import SPI
+
+    print( '**********************************************')
+    print( '***   Test Harness for ni845x simulator    ***')
+    print( '**********************************************')
+
+    lib = Ni845xSim()
+    spi = SPI(lib=lib)
+    print( 'ioOpen():     \t{0}'.format(spi.ioOpen()))
+    print( 'ioSetConfig():\t{0}'.format(spi.ioSetConfig(spiClk=1000)))
+    print( 'ioInit():     \t{0}'.format(spi.ioInit()))
+
+    for wordSize in (4, 8, 10, 12):
+        wArr = list(range(7))
+        rData, fRet = spi.ioWriteSPI2(wArr, wordSize)
+        if wArr != rData or fRet != 0:
+            print( 'MOSI/MISO Error @ {0} bit words: {1}'.format(wordSize, rData))
+    print( 'ioReadSPI2():\t{0}'.format(spi.ioReadSPI2(18, 12)))
+
+    adapter = lib.adapters[DEFAULT_RESOURCE]
+    print( 'USB transactions:\t{0}'.format(adapter.transactions))
+    print( 'Modelled bus time:\t{0:.3f} ms'.format(adapter.busTime * 1e3))
+    print( 'ioClose():    \t{0}'.format(spi.ioClose()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#-------------------------------------------------------------------------------
+# Name:        patterncache
+# Purpose:     Remember computed array factor patterns, in memory and across
+#              runs, so a view can be drawn before the pattern is recomputed
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+import json
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+
+_MAGIC = b"AWPC"
+_ENTRY = struct.Struct("<II") #key length, number of points
+
+def patternKey(theta, phi, waveLength, grid, invert, spacing, n_theta=30, n_phi=30, quantized=False,
+               calId=None):
+  """
+    hashable description of everything generateAllAF depends on. A quantized
+    pattern also depends on the phase cal: calId (see calIdentity) says which
+  """
+  return (float(theta), float(phi), float(waveLength),
+          tuple(tuple(row) for row in grid), tuple(tuple(row) for row in invert),
+          float(spacing), n_theta, n_phi, bool(quantized), calId if quantized else None)
+
+def calIdentity(phaseCalFile):
+  """file name, size and modification time of a phase cal; None if there's no file"""
+  try:
+    st = os.stat(phaseCalFile)
+  except (OSError, TypeError):
+    return None
+  return "{0}:{1}:{2}".format(os.path.abspath(phaseCalFile), st.st_size, st.st_mtime_ns)
+
+class PatternCache:
+  """
+  LRU of generateAllAF results keyed by patternKey(...)
+
+  cache = PatternCache("pattern_cache.bin")
+  cache.load()                      #whatever the last run saved
+  points = cache.get(key)           #None on a miss
+  cache.put(key, points)
+  cache.save()                      #the most recent diskEntries patterns
+  """
+
+  def __init__(self, path=None, maxEntries=64, diskEntries=8):
+    self.path = path
+    self.maxEntries = maxEntries
+    self.diskEntries = diskEntries
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      points = self._entries.get(key)
+      if points is not None:
+        self._entries.move_to_end(key)
+      return points
+
+  def put(self, key, points):
+    with self._lock:
+      self._entries[key] = points
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxEntries:
+        self._entries.popitem(last=False)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def save(self, path=None):
+    """writes the newest diskEntries patterns as (theta, phi, af) doubles"""
+    path = path or self.path
+    with self._lock:
+      newest = list(self._entries.items())[-self.diskEntries:]
+    out = [_MAGIC]
+    for key, points in newest:
+      rawKey = json.dumps(key).encode()
+      flat = array("d", [v for p in points for v in p])
+      out.append(_ENTRY.pack(len(rawKey), len(points)))
+      out.append(rawKey)
+      out.append(flat.tobytes())
+    with open(path, "wb") as stream:
+      stream.write(b"".join(out))
+
+  def load(self, path=None):
+    """adds the patterns saved in path. Returns how many (0 if none or unreadable)"""
+    path = path or self.path
+    try:
+      with open(path, "rb") as stream:
+        data = stream.read()
+    except (IOError, TypeError):
+      return 0
+    if data[:len(_MAGIC)] != _MAGIC:
+      return 0
+
+    pos = len(_MAGIC)
+    loaded = 0
+    try:
+      while pos < len(data):
+        nKey, nPoints = _ENTRY.unpack_from(data, pos)
+        pos += _ENTRY.size
+        key = _tuplify(json.loads(data[pos:pos + nKey].decode()))
+        pos += nKey
+        flat = array("d")
+        flat.frombytes(data[pos:pos + 24 * nPoints])
+        pos += 24 * nPoints
+        self.put(key, [tuple(flat[i:i + 3]) for i in range(0, len(flat), 3)])
+        loaded += 1
+    except (struct.error, ValueError):
+      pass #truncated file: keep what was read
+    return loaded
+
+def _tuplify(x):
+  """json turns the key's tuples into lists -- turn them back"""
+  if isinstance(x, list):
+    return tuple(_tuplify(v) for v in x)
+  return x
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  import os
+  import tempfile
+  import time
+  from beamdef import BeamDefinition, NE, NW, SE, SW
+
+  grid, invert = [[NE, NW, SE, SW]], [[True, False, True, False]]
+  path = os.path.join(tempfile.gettempdir(), "awmf_pattern_cache_test.bin")
+  cache = PatternCache(path)
+  for theta in range(0, 40, 10):
+    b = BeamDefinition(theta, 90, 0.0107)
+    b.setAntenna(grid, invert, 5.4e-3)
+    t0 = time.perf_counter()
+    points = b.generateAllAF()
+    compute = time.perf_counter() - t0
+    cache.put(patternKey(theta, 90, 0.0107, grid, invert, 5.4e-3), points)
+  cache.save()
+
+  t0 = time.perf_counter()
+  again = PatternCache(path)
+  again.load()
+  hit = again.get(patternKey(30, 90, 0.0107, grid, invert, 5.4e-3))
+  print("compute {0:.1f} ms, load from disk {1:.1f} ms, same: {2}".format(
+    1e3 * compute, 1e3 * (time.perf_counter() - t0), hit == points))
+  os.remove(path)
+
+if __name__ == '__main__':
+  main()
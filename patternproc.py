@@ -0,0 +1,263 @@
+#-------------------------------------------------------------------------------
+# Name:        patternproc
+# Purpose:     Work out array factor patterns in a separate process and hand
+#              them to the viewer through a shared memory double buffer
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# A thread running generateAllAF holds the GIL and the GUI stutters with it.
+# PatternProcess runs it in another process instead:
+#
+#   proc = PatternProcess()                       #makes the shared buffer
+#   viewer.attachPatternBuffer(proc.buffer)       #viewer polls it
+#   proc.request(request, theta, phi, waveLength, grid, invert, spacing)
+#   ...
+#   viewer.detachPatternBuffer(); proc.stop()
+#
+# The worker only does the newest request waiting for it.
+#
+# Shared memory layout, native doubles throughout so the whole block is read
+# through one memoryview cast to 'd':
+#
+#   header   magic, max points, latest frame number
+#   slot 0   seq, request, n_theta, n_phi, n points, beam strength, padding,
+#            then max points x (theta, phi, af)
+#   slot 1   the same
+#
+# Frame f goes in slot f % 2. While a slot is written its seq is odd
+# (2f - 1); it is 2f once the frame is complete, and then the header's latest
+# frame number moves to f. A reader goes by the latest frame number and keeps
+# a PatternView onto that slot -- no copy. The writer only comes back to the
+# slot two frames later; PatternView.valid() tells whether that happened
+# while it was being read.
+#-------------------------------------------------------------------------------
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+_MAGIC = float(0x41575342) #"AWSB"
+_HEADER = 4                #doubles: magic, max points, latest frame, padding
+_SLOT_HEADER = 8           #doubles: seq, request, n_theta, n_phi, n, strength, 2 x padding
+_SEQ, _REQUEST, _NTHETA, _NPHI, _NPOINTS, _STRENGTH = range(6)
+
+class PatternView:
+  """
+  Read only sequence of (theta, phi, af) straight out of a shared buffer slot,
+  what QAntennaViewer.setAFPoints would otherwise get as a list
+  """
+  __slots__ = ("_d", "_base", "_n", "_seq", "_slot")
+
+  def __init__(self, doubles, slot, base, n, seq):
+    self._d = doubles
+    self._slot = slot
+    self._base = base
+    self._n = n
+    self._seq = seq
+
+  def __len__(self):
+    return self._n
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self._n
+    if not 0 <= i < self._n:
+      raise IndexError(i)
+    k = self._base + 3 * i
+    d = self._d
+    return (d[k], d[k + 1], d[k + 2])
+
+  def __iter__(self):
+    d = self._d
+    for k in range(self._base, self._base + 3 * self._n, 3):
+      yield (d[k], d[k + 1], d[k + 2])
+
+  def valid(self):
+    """False once the writer has started reusing this slot"""
+    return self._d[self._slot + _SEQ] == self._seq
+
+class PatternBuffer:
+  """
+  The shared memory double buffer. create=True makes it (and unlink() removes
+  it); otherwise name opens one made elsewhere
+  """
+
+  def __init__(self, name=None, maxPoints=180 * 360, create=False):
+    slotSize = _SLOT_HEADER + 3 * maxPoints
+    size = 8 * (_HEADER + 2 * slotSize)
+    if create:
+      self.shm = shared_memory.SharedMemory(create=True, size=size)
+    else:
+      self.shm = shared_memory.SharedMemory(name=name)
+    self.name = self.shm.name
+    self._d = self.shm.buf[:size].cast("d")
+    if create:
+      self._d[0] = _MAGIC
+      self._d[1] = maxPoints
+      self._d[2] = 0
+    elif self._d[0] != _MAGIC:
+      raise ValueError("{0} is not a pattern buffer".format(name))
+    self.maxPoints = int(self._d[1])
+    self._slotSize = _SLOT_HEADER + 3 * self.maxPoints
+
+  def _slot(self, frame):
+    return _HEADER + (frame % 2) * self._slotSize
+
+  def latestFrame(self):
+    return int(self._d[2])
+
+  def publish(self, points, request=0, n_theta=30, n_phi=30, beamStrength=1.0):
+    """writer side: copies points in as the next frame. Returns its number"""
+    if len(points) > self.maxPoints:
+      raise ValueError("{0} points, buffer holds {1}".format(len(points), self.maxPoints))
+    d = self._d
+    frame = int(d[2]) + 1
+    s = self._slot(frame)
+    d[s + _SEQ] = 2 * frame - 1
+    d[s + _REQUEST] = request
+    d[s + _NTHETA] = n_theta
+    d[s + _NPHI] = n_phi
+    d[s + _NPOINTS] = len(points)
+    d[s + _STRENGTH] = beamStrength
+    k = s + _SLOT_HEADER
+    for p in points:
+      d[k], d[k + 1], d[k + 2] = p
+      k += 3
+    d[s + _SEQ] = 2 * frame
+    d[2] = frame
+    return frame
+
+  def latest(self):
+    """
+    reader side: (frame, request, n_theta, n_phi, beamStrength, PatternView)
+    for the newest complete frame, None if there isn't one yet
+    """
+    d = self._d
+    frame = int(d[2])
+    if frame == 0:
+      return None
+    s = self._slot(frame)
+    seq = d[s + _SEQ]
+    if seq != 2 * frame:
+      return None #overtaken while we looked: try again next poll
+    view = PatternView(d, s, s + _SLOT_HEADER, int(d[s + _NPOINTS]), seq)
+    return (frame, int(d[s + _REQUEST]), int(d[s + _NTHETA]), int(d[s + _NPHI]),
+            d[s + _STRENGTH], view)
+
+  def close(self):
+    """drop every PatternView onto this buffer first"""
+    self._d.release()
+    self.shm.close()
+
+  def unlink(self):
+    self.shm.unlink()
+
+def _worker(name, requests):
+  """compute process: newest request wins, each result goes into the buffer"""
+  from beamdef import BeamDefinition
+  import queue
+  buf = PatternBuffer(name)
+  try:
+    while True:
+      req = requests.get()
+      try:
+        while True:
+          req = requests.get_nowait()
+      except queue.Empty:
+        pass
+      if req is None:
+        break
+      request, theta, phi, waveLength, grid, invert, spacing, beamStrength, n_theta, n_phi, quantized, phaseCal = req
+      b = BeamDefinition(theta, phi, waveLength, phaseCalFile=None, beamStrength=beamStrength)
+      b.setPhaseCal(phaseCal)
+      b.setAntenna(grid, invert, spacing)
+      buf.publish(b.generateAllAF(n_theta=n_theta, n_phi=n_phi, quantized=quantized),
+                  request, n_theta, n_phi, beamStrength)
+  finally:
+    buf.close()
+
+class PatternProcess:
+  """Owns the buffer and the process that fills it"""
+
+  def __init__(self, maxPoints=180 * 360):
+    self.buffer = PatternBuffer(maxPoints=maxPoints, create=True)
+    self._requests = multiprocessing.Queue()
+    self._process = multiprocessing.Process(target=_worker, name="PatternProcess",
+                                            args=(self.buffer.name, self._requests), daemon=True)
+    self._process.start()
+
+  def request(self, request, theta, phi, waveLength, grid, invert, spacing,
+              beamStrength=1.0, n_theta=30, n_phi=30, quantized=False, phaseCal=None):
+    """
+    queues a pattern; request is handed back with the frame. quantized and
+    phaseCal (a loaded cal map) as for BeamDefinition.generateAllAF
+    """
+    self._requests.put((request, theta, phi, waveLength, grid, invert, spacing,
+                        beamStrength, n_theta, n_phi, quantized, phaseCal))
+
+  def stop(self, timeout=2.0):
+    self._requests.put(None)
+    self._process.join(timeout)
+    if self._process.is_alive():
+      self._process.terminate()
+    self.buffer.close()
+    self.buffer.unlink()
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  import threading
+  import time
+  from beamdef import BeamDefinition, NE, NW, SE, SW
+
+  grid, invert = [[NE, NW, SE, SW]], [[True, False, True, False]]
+  proc = PatternProcess()
+  buf = PatternBuffer(proc.buffer.name) #as another process would see it
+
+  #how much of this thread the compute takes: a ticker that should run every 1 ms
+  ticks = []
+  done = threading.Event()
+  def ticker():
+    while not done.is_set():
+      ticks.append(time.perf_counter())
+      time.sleep(1e-3)
+
+  for where in ("thread", "process"):
+    ticks[:] = []
+    done.clear()
+    t = threading.Thread(target=ticker)
+    t.start()
+    t0 = time.perf_counter()
+    for theta in range(0, 60, 5):
+      if where == "thread":
+        b = BeamDefinition(theta, 90, 0.0107, phaseCalFile=None)
+        b.setAntenna(grid, invert, 5.4e-3)
+        b.generateAllAF(n_theta=60, n_phi=60)
+      else:
+        proc.request(theta, theta, 90, 0.0107, grid, invert, 5.4e-3, n_theta=60, n_phi=60)
+        while True:
+          latest = buf.latest()
+          if latest is not None and latest[1] == theta:
+            break
+          time.sleep(1e-3)
+    elapsed = time.perf_counter() - t0
+    done.set()
+    t.join()
+    gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+    print("{0:<8} 12 patterns in {1:6.1f} ms, worst 1 ms tick took {2:5.1f} ms".format(
+      where, 1e3 * elapsed, 1e3 * max(gaps)))
+
+  frame, request, n_theta, n_phi, strength, view = buf.latest()
+  b = BeamDefinition(55, 90, 0.0107, phaseCalFile=None)
+  b.setAntenna(grid, invert, 5.4e-3)
+  print("frame {0}, {1} points, same as computed here: {2}, valid: {3}".format(
+    frame, len(view), list(view) == b.generateAllAF(n_theta=60, n_phi=60), view.valid()))
+  del view
+  buf.close()
+  proc.stop()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,295 @@
+#-------------------------------------------------------------------------------
+# Name:        phaseopt
+# Purpose:     Pick the 5 bit awmf-0108 phase states of a beam by search
+#              instead of rounding each channel on its own
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# python3 phaseopt.py                                   4x1, gain, theta 0-60
+# python3 phaseopt.py --antenna 2x2 --phi 0:360:15 --objective sidelobe -j 8
+# python3 phaseopt.py --cache codebook_opt.json         reuse earlier results
+#
+# Rounding every channel to its nearest state (_radiansToAwmf0108) is not the
+# best set of states for the beam, less so once calibration errors move the
+# states about. PhaseOptimizer searches the states around the rounded ones:
+#
+#   objective "gain"      most |AF| towards the requested direction
+#   objective "sidelobe"  lowest peak sidelobe among the candidates within
+#                         gainTolDb of the best gain
+#
+# Each element's 32 states are turned into 32 complex contributions towards
+# the target once; a candidate's gain is then a sum of table entries, and all
+# (2 span + 1)^N candidates are summed element by element as one list.
+# Arrays with more candidates than exhaustiveLimit are searched one element
+# at a time (coordinate descent over all 32 states, repeated until nothing
+# improves). Sidelobes are only worked out for the maxSidelobeChecks best
+# candidates by gain.
+#
+# optimizeCodebook spreads a codebook over processes and keeps results in a
+# JSON cache, so an unchanged codebook is free the second time.
+#-------------------------------------------------------------------------------
+
+import sys
+from collections import namedtuple
+from cmath import exp
+from math import pi, radians, log10
+
+from beamdef import NE, SE, SW, NW, directionCosines
+
+#one optimized beam
+#   registers   phase state of every element (getElementPositions order)
+#   settings    NE-SE-SW-NW like getPhaseSettings, None if the elements
+#               aren't the four channels
+#   rounded     registers plain rounding gives
+#   gainDb      |AF| at the target relative to the rounded registers
+#   sidelobeDb  peak sidelobe level relative to the peak (None if not worked out)
+OptResult = namedtuple('OptResult', ['theta', 'phi', 'registers', 'settings', 'rounded', 'gainDb', 'sidelobeDb'])
+
+class PhaseOptimizer:
+  """
+  opt = PhaseOptimizer(beamDef, objective="gain")
+  r = opt.optimize(30, 90)      #OptResult, cached per direction
+  awmf.setBeam(mode, *(r.settings + amps))
+  """
+
+  def __init__(self, beamDef, objective="gain", span=2, exhaustiveLimit=4096,
+               gainTolDb=0.5, maxSidelobeChecks=16, n_theta=30, n_phi=60):
+    if objective not in ("gain", "sidelobe"):
+      raise ValueError("objective is gain or sidelobe, not {0}".format(objective))
+    self.beamDef = beamDef
+    self.objective = objective
+    self.span = span
+    self.exhaustiveLimit = exhaustiveLimit
+    self.gainTolDb = gainTolDb
+    self.maxSidelobeChecks = maxSidelobeChecks
+    self.n_theta = n_theta
+    self.n_phi = n_phi
+    self.cache = {}
+    self._grid = None
+
+    #complex excitation of every element in each of its 32 states
+    bd = beamDef
+    if bd.elementPositions is None:
+      invert = [j for i in bd.antennaInvert for j in i]
+      channels = [j for i in bd.antennaGrid for j in i]
+      gains = [j for i in bd.getRelativeGain() for j in i]
+    else:
+      invert = bd.elementInvert or [False] * len(bd.elementPositions)
+      channels = bd.elementChannels or [None] * len(bd.elementPositions)
+      gains = bd.getRelativeGain()
+    self.channels = channels
+    step = 2 * pi / 32
+    self.states = []
+    for ch, inv, g in zip(channels, invert, gains):
+      row = []
+      for reg in range(32):
+        err = 0
+        if bd.phaseCal and ch is not None:
+          errs = bd.phaseCal[ch]
+          err = errs[min(errs.keys(), key=lambda x:abs(x - reg))]
+        row.append(g * exp(1j * ((reg + err) * step - (pi if inv else 0))))
+      self.states.append(row)
+    k = 2 * pi / bd.waveLength
+    self.scaled = [(k * x, k * y, k * z) for x, y, z in bd.getElementPositions()]
+
+  def _contributions(self, theta, phi):
+    """[element][state] contribution to AF towards theta/phi (degrees)"""
+    u, v, w = directionCosines(radians(theta), radians(phi))
+    out = []
+    for (kx, ky, kz), row in zip(self.scaled, self.states):
+      e = exp(1j * (kx * u + ky * v + kz * w))
+      out.append([c * e for c in row])
+    return out
+
+  def _patternGrid(self):
+    if self._grid is None:
+      from beamcompare import PatternGrid
+      self._grid = PatternGrid(self.beamDef.getElementPositions(), self.beamDef.waveLength,
+                               self.n_theta, self.n_phi)
+    return self._grid
+
+  def sidelobeDb(self, registers, theta, phi):
+    grid = self._patternGrid()
+    weights = [row[r] for row, r in zip(self.states, registers)]
+    af = grid.arrayFactor(weights)
+    return grid.peakSidelobeDb(af, grid.climb(af, grid.nearest(theta, phi)))
+
+  #-----------------------------------------------------------------------------
+  # search
+  #-----------------------------------------------------------------------------
+  def _exhaustive(self, contrib, rounded):
+    """every candidate within span of rounded: [(|AF|, registers)], best first"""
+    choices = [[(r + d) % 32 for d in range(-self.span, self.span + 1)] for r in rounded]
+    sums = [0]
+    for c, regs in zip(contrib, choices):
+      row = [c[r] for r in regs]
+      sums = [s + x for s in sums for x in row]
+    width = len(choices[0])
+    n = len(choices)
+    scored = sorted(((abs(s), i) for i, s in enumerate(sums)), reverse=True)
+    out = []
+    for a, i in scored[:max(self.maxSidelobeChecks, 1) if self.objective == "sidelobe" else 1]:
+      regs = [0] * n
+      for e in range(n - 1, -1, -1):
+        i, d = divmod(i, width)
+        regs[e] = choices[e][d]
+      out.append((a, regs))
+    return out
+
+  def _descend(self, contrib, rounded):
+    """coordinate descent on |AF|: each element in turn to its best state"""
+    regs = list(rounded)
+    total = sum(c[r] for c, r in zip(contrib, regs))
+    improved = True
+    while improved:
+      improved = False
+      for e, c in enumerate(contrib):
+        rest = total - c[regs[e]]
+        best = max(range(32), key=lambda r: abs(rest + c[r]))
+        if abs(rest + c[best]) > abs(total) * (1 + 1e-12):
+          regs[e] = best
+          total = rest + c[best]
+          improved = True
+    return [(abs(total), regs)]
+
+  def optimize(self, theta, phi):
+    key = (float(theta), float(phi))
+    result = self.cache.get(key)
+    if result is not None:
+      return result
+
+    bd = self.beamDef
+    bd.setDirection(theta, phi)
+    rounded = bd.getElementPhaseSettings()
+    contrib = self._contributions(theta, phi)
+    roundedGain = abs(sum(c[r] for c, r in zip(contrib, rounded)))
+
+    if (2 * self.span + 1) ** len(rounded) <= self.exhaustiveLimit:
+      candidates = self._exhaustive(contrib, rounded)
+    else:
+      candidates = self._descend(contrib, rounded)
+
+    bestGain, registers = candidates[0]
+    if bestGain <= roundedGain * (1 + 1e-9):
+      #shifting every state by the same amount ties: keep what rounding gave
+      bestGain, registers = roundedGain, rounded
+    sidelobe = None
+    if self.objective == "sidelobe":
+      #prune: only candidates that keep the gain get their sidelobes checked
+      floor = bestGain * pow(10, -self.gainTolDb / 20)
+      checked = []
+      for a, regs in [(roundedGain, rounded)] + candidates:
+        if a >= floor:
+          sl = self.sidelobeDb(regs, theta, phi)
+          changes = sum(1 for x, y in zip(regs, rounded) if x != y)
+          checked.append((round(sl, 6) if sl is not None else 0.0, -round(a, 9), changes, sl, a, regs))
+      best = min(checked, key=lambda c: c[:3])
+      sidelobe, bestGain, registers = best[3:]
+
+    result = OptResult(theta, phi, registers, self._settings(registers), rounded,
+                       20 * log10(bestGain / roundedGain) if roundedGain > 0 else 0.0, sidelobe)
+    self.cache[key] = result
+    return result
+
+  def _settings(self, registers):
+    if sorted(c for c in self.channels if c is not None) != sorted([NE, SE, SW, NW]):
+      return None
+    byChannel = dict(zip(self.channels, registers))
+    return [byChannel[x] for x in [NE, SE, SW, NW]]
+
+#-------------------------------------------------------------------------------
+# codebooks
+#-------------------------------------------------------------------------------
+_worker = None
+
+def _initWorker(config):
+  global _worker
+  _worker = _makeOptimizer(config)
+
+def _optimizeOne(direction):
+  return tuple(_worker.optimize(*direction))
+
+def _makeOptimizer(config):
+  from beamcli import BeamEngine
+  eng = BeamEngine(config["freq"], config["antenna"], config["cal"])
+  return PhaseOptimizer(eng.beamDef, config["objective"], **config.get("options", {}))
+
+def optimizeCodebook(codebook, freq=28.0, antenna="4x1", cal="phaseCal.yaml", objective="gain",
+                     processes=None, cachePath=None, **options):
+  """
+    [OptResult] for every (theta, phi) of codebook. processes=None uses
+    every core, 1 runs here. Results already in cachePath (for the same
+    configuration and the same cal file contents) aren't worked out again
+  """
+  import json
+  from patterncache import calIdentity
+  config = {"freq": freq, "antenna": antenna, "cal": cal, "objective": objective, "options": options}
+  #a recalibration rewrites the cal file in place: key on the file, not its name
+  configKey = json.dumps(dict(config, calId=calIdentity(cal)), sort_keys=True)
+  cached = {}
+  if cachePath is not None:
+    try:
+      with open(cachePath, "r") as stream:
+        data = json.load(stream)
+      if data.get("config") == configKey:
+        cached = dict(((r[0], r[1]), OptResult(*r)) for r in data["results"])
+    except (IOError, ValueError):
+      pass
+
+  todo = [(float(t), float(p)) for t, p in codebook if (float(t), float(p)) not in cached]
+  if todo:
+    if processes == 1 or len(todo) < 8:
+      opt = _makeOptimizer(config)
+      done = [tuple(opt.optimize(*d)) for d in todo]
+    else:
+      import multiprocessing
+      with multiprocessing.Pool(processes, initializer=_initWorker, initargs=(config,)) as pool:
+        done = pool.map(_optimizeOne, todo, chunksize=max(1, len(todo) // (4 * (processes or multiprocessing.cpu_count()))))
+    for r in done:
+      cached[(r[0], r[1])] = OptResult(*r)
+
+  if cachePath is not None and todo:
+    with open(cachePath, "w") as stream:
+      json.dump({"config": configKey, "results": [list(r) for r in cached.values()]}, stream)
+  return [cached[(float(t), float(p))] for t, p in codebook]
+
+
+# ------------------------------------------------------------------------------
+# MAIN PROGRAM
+# ------------------------------------------------------------------------------
+def main(argv=None):
+  import argparse
+  import time
+  from beamcli import ANTENNAS, DEFAULT_FREQ_GHZ, frange
+
+  parser = argparse.ArgumentParser(description="awmf-0108 phase state optimizer")
+  parser.add_argument("--freq", type=float, default=DEFAULT_FREQ_GHZ, help="GHz")
+  parser.add_argument("--antenna", choices=sorted(ANTENNAS), default="4x1")
+  parser.add_argument("--cal", default="phaseCal.yaml", help="phase cal yaml")
+  parser.add_argument("--theta", default="0:61:5", help="start:stop:step degrees")
+  parser.add_argument("--phi", default="90", help="start:stop:step degrees")
+  parser.add_argument("--objective", choices=["gain", "sidelobe"], default="gain")
+  parser.add_argument("-j", "--processes", type=int, help="worker processes (default: all cores)")
+  parser.add_argument("--cache", help="JSON file of earlier results")
+  args = parser.parse_args(argv)
+
+  codebook = [(t, p) for t in frange(args.theta) for p in frange(args.phi)]
+  t0 = time.perf_counter()
+  results = optimizeCodebook(codebook, args.freq, args.antenna, args.cal, args.objective,
+                             args.processes, args.cache)
+  elapsed = time.perf_counter() - t0
+
+  print(" theta   phi  rounded           optimized         gain dB  SLL dB")
+  for r in results:
+    print("{0:6.1f} {1:5.1f}  {2:<16}  {3:<16}  {4:+6.2f}  {5}".format(
+      r.theta, r.phi, str(r.rounded), str(r.registers), r.gainDb,
+      "   --" if r.sidelobeDb is None else "{0:6.1f}".format(r.sidelobeDb)))
+  changed = sum(1 for r in results if r.registers != r.rounded)
+  sys.stderr.write("{0} beams in {1:.2f} s, {2} differ from rounding, best gain {3:+.2f} dB\n".format(
+    len(results), elapsed, changed, max(r.gainDb for r in results)))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -14,6 +14,7 @@
 
 import sys
 import math
+import logging
 from math import sin, cos, radians, acos
 from collections import namedtuple
 from itertools import cycle
@@ -22,9 +23,16 @@ from PyQt5 import QtGui, QtCore, QtWidgets
 from PyQt5.QtWidgets import (QApplication, QHBoxLayout, QOpenGLWidget, QSlider,
         QWidget)
 from PyQt5.QtCore import pyqtSignal, QPoint, QSize, Qt
-from PyQt5.QtGui import QColor
+from PyQt5.QtGui import QColor, QPainter, QFont
 
 import OpenGL.GL as gl
+
+import stagetime
+from stagetime import timed
+from awmflog import getLogger
+from patternproc import PatternView
+
+log = getLogger("viewer")
 #import OpenGL.GLU as glu
 
 class QAntennaViewer(QOpenGLWidget):
@@ -34,6 +42,8 @@ class QAntennaViewer(QOpenGLWidget):
     xRotationChanged = pyqtSignal(int)
     zoomChanged = pyqtSignal(int)
     zRotationChanged = pyqtSignal(int)
+    firstFrame = pyqtSignal()     #once, after the first paintGL
+    sharedPatternShown = pyqtSignal(int)  #request number of a pattern taken from the shared buffer
 
     #3D, cartesian / 3D, polar object types
     Point3C = namedtuple('Point3C', ['x','y','z'])
@@ -74,6 +84,15 @@ class QAntennaViewer(QOpenGLWidget):
         self.dirtyBeamPattern = False 
         self.dirtyCurrentSettings = True
         self.dirtyAntennaBox = True
+        self.dirtyAxisLines = True
+        self.framesDrawn = 0
+        self.glSize = (self.width(), self.height()) #last resizeGL, to restore after a QPainter
+
+        #patterns from a PatternProcess (attachPatternBuffer)
+        self.patternBuffer = None
+        self.patternAccept = None
+        self.patternFrame = 0
+        self.patternTimer = None
 
         #current setting vector
         self.csTheta = cst0
@@ -83,6 +102,7 @@ class QAntennaViewer(QOpenGLWidget):
         #draw options
         self.drawAxis = True 
         self.antenna4x1 = True
+        self.stageOverlay = False
 
     def setAntenna4x1(self, antenna4x1):
       """ True = draw 4x1 antenna
@@ -91,6 +111,13 @@ class QAntennaViewer(QOpenGLWidget):
       self.antenna4x1 = antenna4x1
       self.update()
 
+    def setStageOverlay(self, show):
+      """ True = draw the stagetime timings over the view (turns timing on)"""
+      self.stageOverlay = show
+      if show:
+        stagetime.enable()
+      self.update()
+
     def getOpenglInfo(self):
         info = """
             Vendor: {0}
@@ -148,6 +175,7 @@ class QAntennaViewer(QOpenGLWidget):
             self.zRotationChanged.emit(angle)
             self.update()
 
+    @timed("viewer.setAFPoints")
     def setAFPoints(self, afList, n_phi=30, n_theta=30, beamStrength=1.0):
         """expects a list of sorted (theta, phi, AF) points to plot 
             this antenna's AF
@@ -172,13 +200,55 @@ class QAntennaViewer(QOpenGLWidget):
             self.dirtyBeamPattern = True
             self.update()
 
+    def attachPatternBuffer(self, patternBuffer, accept=None, pollMs=15):
+        """Draws what a PatternProcess puts in patternBuffer, read in place.
+            accept(request) -> False skips a frame (e.g. one already superseded)"""
+        self.patternBuffer = patternBuffer
+        self.patternAccept = accept
+        self.patternFrame = 0
+        if self.patternTimer is None:
+            self.patternTimer = QtCore.QTimer(self)
+            self.patternTimer.timeout.connect(self.pollPatternBuffer)
+        self.patternTimer.start(pollMs)
+
+    def detachPatternBuffer(self):
+        """Stops reading the buffer and lets go of any view onto it"""
+        if self.patternTimer is not None:
+            self.patternTimer.stop()
+        self.patternBuffer = None
+        if isinstance(self.afPoints, PatternView):
+            self.afPoints = []
+
+    def pollPatternBuffer(self):
+        if self.patternBuffer is None or self.patternBuffer.latestFrame() == self.patternFrame:
+            return
+        latest = self.patternBuffer.latest()
+        if latest is None:
+            return
+        self.patternFrame, request, n_theta, n_phi, beamStrength, view = latest
+        if self.patternAccept is not None and not self.patternAccept(request):
+            return
+        self.afPoints = view
+        self.afNTheta = n_theta
+        self.afNPhi = n_phi
+        self.afBeamScale = 0.5 * min(max(beamStrength, 0), 1)
+        self.dirtyBeamPattern = True
+        self.update()
+        self.sharedPatternShown.emit(request)
+
     def initializeGL(self):
-        print(self.getOpenglInfo())
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s", self.getOpenglInfo())
 
         self.setClearColor(self.backgroundPurple.darker())
-        self.substrate = self.makeSubstrate()
-        self.beamPattern = self.makeBeamPattern()
-        self.axisLines = self.makeAxisLines()
+        #call lists are built by the first paintGL, once the pattern is in
+        self.dirtyAntennaBox = True
+        self.dirtyBeamPattern = True
+        self.dirtyAxisLines = True
+        self.setGLState()
+
+    def setGLState(self):
+        """The fixed function state the scene is drawn with"""
         gl.glShadeModel(gl.GL_FLAT)
         gl.glEnable(gl.GL_DEPTH_TEST)
 
@@ -189,6 +259,7 @@ class QAntennaViewer(QOpenGLWidget):
         gl.glHint(gl.GL_LINE_SMOOTH_HINT, gl.GL_NICEST)
         gl.glEnable(gl.GL_LINE_SMOOTH)
 
+    @timed("viewer.paintGL")
     def paintGL(self):
         gl.glClear(
             gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
@@ -202,20 +273,46 @@ class QAntennaViewer(QOpenGLWidget):
         if self.dirtyAntennaBox:
             self.substrate = self.makeSubstrate()
             self.dirtyAntennaBox = False
+        if self.dirtyAxisLines:
+            self.axisLines = self.makeAxisLines()
+            self.dirtyAxisLines = False
         if self.drawAxis:
             pass
             gl.glCallList(self.axisLines)
         if self.dirtyBeamPattern: #redraw if necessary
             self.beamPattern = self.makeBeamPattern()
-            self.dirtyBeamPattern = False
+            #a shared buffer slot rewritten while it was read: read it again
+            self.dirtyBeamPattern = isinstance(self.afPoints, PatternView) and not self.afPoints.valid()
         if self.dirtyCurrentSettings:
             self.currentSettings = self.makeCurrentSettings()
             self.dirtyCurrentSettings = False
         gl.glCallList(self.substrate)
         gl.glCallList(self.currentSettings)
         gl.glCallList(self.beamPattern)
+        if self.stageOverlay:
+            self.drawStageOverlay()
+        self.framesDrawn += 1
+        if self.framesDrawn == 1:
+            self.firstFrame.emit()
+
+    def drawStageOverlay(self):
+        """Stage timings as text in the top left corner"""
+        painter = QPainter(self)
+        painter.setPen(Qt.white)
+        painter.setFont(QFont("Monospace", 8))
+        y = 14
+        for line in stagetime.summaryLines():
+            painter.drawText(6, y, line)
+            y += 12
+        painter.end()
+        #QPainter leaves its own viewport, projection, program and blend/depth
+        #state behind: put the scene's back for the next paintGL
+        gl.glUseProgram(0)
+        self.setGLState()
+        self.resizeGL(*self.glSize)
 
     def resizeGL(self, width, height):
+        self.glSize = (width, height)
         side = min(width, height)
         if side < 0:
             return
@@ -242,6 +339,7 @@ class QAntennaViewer(QOpenGLWidget):
 
         self.lastPos = event.pos()
 
+    @timed("viewer.makeBeamPattern")
     def makeBeamPattern(self):
         """ Draws the beam pattern from self.afPoints 
             Expec"""
@@ -300,7 +398,7 @@ class QAntennaViewer(QOpenGLWidget):
     
     def AfToColor(self, af):
         """0 <= af <= 1"""
-        h = 240 - (af * 240)
+        h = int(round(240 - (min(max(af, 0.0), 1.0) * 240))) #fromHsl takes ints
         return QColor.fromHsl(h,200,182, self.beamTransparancy)
 
     def drawVector(self, p3c_s, p3c_p, color):
@@ -0,0 +1,169 @@
+#-------------------------------------------------------------------------------
+# Name:        qcutplot
+# Purpose:     Draw pattern cuts (BeamDefinition.phiCut and friends) as a
+#              flat dB against angle plot
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# plot = QCutPlot()
+# plot.setCut("phi = 90", beamDef.phiCut(90))
+# plot.setCut("phi = 0", beamDef.phiCut(0))
+#
+# Each cut becomes one QPainterPath in (angle, dB) coordinates when it is set;
+# painting maps that path onto the widget with one transform, so a repaint
+# doesn't touch the points again. Levels below floorDb are drawn at floorDb.
+#-------------------------------------------------------------------------------
+
+import sys
+from math import log10
+from collections import OrderedDict
+
+from PyQt5.QtWidgets import QApplication, QWidget
+from PyQt5.QtCore import QPointF, QRectF, QSize, Qt
+from PyQt5.QtGui import QColor, QPainter, QPainterPath, QPen, QTransform, QFont
+
+class QCutPlot(QWidget):
+  """1-D pattern cuts, |AF| in dB against angle"""
+
+  colors = [QColor(255, 200, 40), QColor(90, 200, 255), QColor(255, 110, 150), QColor(140, 235, 120)]
+
+  def __init__(self, parent=None, floorDb=-40):
+    super(QCutPlot, self).__init__(parent)
+    self.floorDb = floorDb
+    self.cuts = OrderedDict() #name -> (QPainterPath, QColor, points)
+    self.angleRange = None    #(first, last) over every cut
+    self.background = QColor.fromCmykF(0.39, 0.39, 0.0, 0.0) #as QAntennaViewer
+    self.gridColor = QColor(255, 255, 255, 70)
+
+  def minimumSizeHint(self):
+    return QSize(160, 120)
+
+  def sizeHint(self):
+    return QSize(300, 300)
+
+  def setFloorDb(self, floorDb):
+    """bottom of the plot; cuts already set are redrawn at the new floor"""
+    self.floorDb = floorDb
+    for name in list(self.cuts):
+      path, color, points = self.cuts[name]
+      self.cuts[name] = (self._path(points), color, points)
+    self.update()
+
+  def setCut(self, name, points, color=None):
+    """
+      points [(angle, AF)] as from BeamDefinition.generateCut, AF linear
+      (normalized). Replaces a cut of the same name
+    """
+    points = list(points)
+    if color is None:
+      old = self.cuts.get(name)
+      color = old[1] if old else self.colors[len(self.cuts) % len(self.colors)]
+    if points:
+      self.cuts[name] = (self._path(points), color, points)
+    else:
+      self.cuts.pop(name, None)
+    self._updateRange()
+    self.update()
+
+  def removeCut(self, name):
+    self.cuts.pop(name, None)
+    self._updateRange()
+    self.update()
+
+  def clearCuts(self):
+    self.cuts.clear()
+    self.angleRange = None
+    self.update()
+
+  def _path(self, points):
+    """the cut as one path in (angle, dB) coordinates"""
+    floor = self.floorDb
+    path = QPainterPath()
+    for i, (angle, af) in enumerate(points):
+      db = 20 * log10(abs(af)) if af else floor
+      y = max(db, floor)
+      if i == 0:
+        path.moveTo(angle, y)
+      else:
+        path.lineTo(angle, y)
+    return path
+
+  def _updateRange(self):
+    if not self.cuts:
+      self.angleRange = None
+      return
+    first = min(points[0][0] for path, color, points in self.cuts.values())
+    last = max(points[-1][0] for path, color, points in self.cuts.values())
+    self.angleRange = (first, last) if last > first else (first - 1, first + 1)
+
+  #-----------------------------------------------------------------------------
+  # drawing
+  #-----------------------------------------------------------------------------
+  def paintEvent(self, event):
+    painter = QPainter(self)
+    painter.setRenderHint(QPainter.Antialiasing)
+    painter.fillRect(self.rect(), self.background)
+    painter.setFont(QFont("Monospace", 7))
+
+    plot = QRectF(self.rect()).adjusted(34, 8, -8, -18)
+    first, last = self.angleRange or (-90, 90)
+    #(angle, dB) -> widget: 0 dB at the top, floorDb at the bottom
+    sx = plot.width() / (last - first)
+    sy = plot.height() / float(-self.floorDb)
+    toWidget = QTransform(sx, 0, 0, -sy, plot.left() - first * sx, plot.top())
+
+    #grid: every 10 dB, every 30 degrees (15 for short cuts)
+    painter.setPen(QPen(self.gridColor, 0))
+    db = 0
+    while db >= self.floorDb:
+      y = toWidget.map(QPointF(first, db)).y()
+      painter.drawLine(QPointF(plot.left(), y), QPointF(plot.right(), y))
+      painter.drawText(QRectF(0, y - 6, 30, 12), Qt.AlignRight | Qt.AlignVCenter, str(db))
+      db -= 10
+    tick = 30 if last - first > 90 else 15
+    angle = tick * -(-first // tick)
+    while angle <= last:
+      x = toWidget.map(QPointF(angle, 0)).x()
+      painter.drawLine(QPointF(x, plot.top()), QPointF(x, plot.bottom()))
+      painter.drawText(QRectF(x - 20, plot.bottom() + 2, 40, 14), Qt.AlignHCenter | Qt.AlignTop,
+                       "{0:g}".format(angle))
+      angle += tick
+
+    #the cuts: one path each, mapped by the painter
+    painter.save()
+    painter.setClipRect(plot)
+    painter.setTransform(toWidget, True)
+    for name, (path, color, points) in self.cuts.items():
+      pen = QPen(color, 1.5)
+      pen.setCosmetic(True) #width in pixels whatever the transform
+      painter.setPen(pen)
+      painter.drawPath(path)
+    painter.restore()
+
+    #legend
+    y = plot.top() + 12
+    for name, (path, color, points) in self.cuts.items():
+      painter.setPen(color)
+      painter.drawText(QPointF(plot.right() - 80, y), name)
+      y += 12
+    painter.end()
+
+
+########################################################################
+############ Tests
+
+if __name__ == '__main__':
+  from beamdef import BeamDefinition, NE, NW, SE, SW
+
+  app = QApplication(sys.argv)
+  b = BeamDefinition(20, 90, 0.0107, phaseCalFile=None)
+  b.setAntenna([[NE, NW, SE, SW]], [[True, False, True, False]], 5.4 * pow(10,-3))
+  plot = QCutPlot()
+  plot.setCut("phi = 90", b.phiCut(90))
+  plot.setCut("phi = 0", b.phiCut(0))
+  plot.setCut("quantized", b.phiCut(90, quantized=True))
+  plot.setWindowTitle("QCutPlot")
+  plot.show()
+  sys.exit(app.exec_())
@@ -0,0 +1,348 @@
+#-------------------------------------------------------------------------------
+# Name:        spicapture
+# Purpose:     Record every ni845x call an SPI session makes to a compact
+#              binary file, and play such a file back as a driver backend
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# Usage:
+#
+#   spi = SPI(lib=CaptureLib(loadLibrary(), "session.ni8c"))   # record
+#   spi = SPI(lib=ReplayLib("session.ni8c"))                    # play back
+#
+# or with the environment (see ni8452io.loadLibrary):
+#
+#   NI845X_CAPTURE=session.ni8c          record whatever backend is in use
+#   NI845X_BACKEND=replay NI845X_REPLAY=session.ni8c
+#
+# CaptureLib sits in front of any backend (the dll, Ni845xSim, ...) and
+# writes one record per call: time since the capture started, function,
+# status and the arguments. Script operations, payloads (WriteRead data) and
+# read backs (ExtractReadData buffers) are all arguments, so nothing else
+# needs hooking. Out parameters are stored as they were after the call.
+#
+# ReplayLib hands the calls back in the same order: out parameters and
+# status come from the file. With strict=True the in parameters are compared
+# too and ReplayMismatch is raised where the caller diverges from the
+# recording. realTime=True keeps the recorded spacing between calls; the
+# default runs as fast as the caller goes.
+#
+# File layout (little endian):
+#   header   b'NI8C', uint16 version
+#   name     0xFE, uint16 id, uint8 length, function name
+#   call     0x01, double t, uint16 id, int32 status, uint8 nArgs, args...
+#   arg      'i' int64 | 'f' double | 'b' uint32 length + bytes | 'n'
+#-------------------------------------------------------------------------------
+import atexit
+import ctypes as c
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from ni845xsim import _obj
+
+_MAGIC = b'NI8C'
+_VERSION = 1
+_TAG_NAME = 0xFE
+_TAG_CALL = 0x01
+
+_HEADER = struct.Struct('<4sH')
+_NAME = struct.Struct('<HB')
+_CALL = struct.Struct('<dHiB')
+_INT = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+_LEN = struct.Struct('<I')
+
+# Out parameters (argument positions) of the calls ni8452io makes. Everything
+# else is an in parameter
+OUTPUTS = {
+    'ni845xFindDevice':                     (0, 1, 2),
+    'ni845xFindDeviceNext':                 (1,),
+    'ni845xOpen':                           (1,),
+    'ni845xStatusToString':                 (2,),
+    'ni845xDioReadPort':                    (2,),
+    'ni845xSpiScriptOpen':                  (0,),
+    'ni845xSpiScriptWriteRead':             (3,),
+    'ni845xSpiScriptExtractReadDataSize':   (2,),
+    'ni845xSpiScriptExtractReadData':       (2,),
+}
+
+kReplayEnd = -301800            # recording exhausted
+
+CallRecord = namedtuple('CallRecord', ['t', 'name', 'status', 'args'])
+
+
+class ReplayMismatch(Exception):
+    '''The caller made a different call (or passed different data) than the
+    recording did at this point'''
+    def __init__(self, index, expected, got):
+        Exception.__init__(self, 'call {0}: recorded {1}, got {2}'.format(index, expected, got))
+        self.index = index
+        self.expected = expected
+        self.got = got
+
+
+# ------------------------------------------------------------------------------
+# argument values
+# ------------------------------------------------------------------------------
+def _isCharArray(x):
+    return isinstance(x, c.Array) and x._type_ is c.c_char
+
+def _contents(x):
+    '''Plain python value of an argument (or of what a byref points at)'''
+    x = _obj(x)
+    if _isCharArray(x):
+        return x.value
+    if isinstance(x, c.Array):
+        return c.string_at(c.addressof(x), c.sizeof(x))
+    if hasattr(x, 'value'):
+        return x.value
+    return x
+
+def _store(ref, value):
+    '''Writes a recorded out value into the object behind ref'''
+    x = _obj(ref)
+    if _isCharArray(x) or not isinstance(x, c.Array):
+        x.value = value
+    else:
+        c.memmove(c.addressof(x), value, min(len(value), c.sizeof(x)))
+
+def _encode(out, v):
+    if v is None:
+        out.append(b'n')
+    elif isinstance(v, bool) or isinstance(v, int):
+        out.append(b'i' + _INT.pack(v))
+    elif isinstance(v, float):
+        out.append(b'f' + _FLOAT.pack(v))
+    else:
+        if isinstance(v, str):
+            v = v.encode()
+        v = bytes(v)
+        out.append(b'b' + _LEN.pack(len(v)) + v)
+
+def _decode(data, pos):
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == b'n':
+        return None, pos
+    if tag == b'i':
+        return _INT.unpack_from(data, pos)[0], pos + _INT.size
+    if tag == b'f':
+        return _FLOAT.unpack_from(data, pos)[0], pos + _FLOAT.size
+    n = _LEN.unpack_from(data, pos)[0]
+    pos += _LEN.size
+    return bytes(data[pos:pos + n]), pos + n
+
+
+def readCapture(path):
+    '''Returns the [CallRecord] in a capture file'''
+    with open(path, 'rb') as stream:
+        data = stream.read()
+    magic, version = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError('{0} is not an ni845x capture'.format(path))
+    pos = _HEADER.size
+    names = {}
+    calls = []
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+        if tag == _TAG_NAME:
+            fid, n = _NAME.unpack_from(data, pos)
+            pos += _NAME.size
+            names[fid] = data[pos:pos + n].decode()
+            pos += n
+        elif tag == _TAG_CALL:
+            t, fid, status, nArgs = _CALL.unpack_from(data, pos)
+            pos += _CALL.size
+            args = []
+            for _ in range(nArgs):
+                v, pos = _decode(data, pos)
+                args.append(v)
+            calls.append(CallRecord(t, names[fid], status, tuple(args)))
+        else:
+            raise ValueError('corrupt capture at byte {0}'.format(pos - 1))
+    return calls
+
+
+# ------------------------------------------------------------------------------
+# capture
+# ------------------------------------------------------------------------------
+class CaptureLib(object):
+    '''Passes every ni845x* call on to lib and records it to path'''
+    def __init__(self, lib, path):
+        self.lib = lib
+        self.path = path
+        self.count = 0
+        self._ids = {}
+        self._lock = threading.Lock()
+        self._stream = open(path, 'wb')
+        self._stream.write(_HEADER.pack(_MAGIC, _VERSION))
+        self._t0 = time.perf_counter()
+        atexit.register(self.close)
+
+    def __getattr__(self, name):
+        if not name.startswith('ni845x'):
+            return getattr(self.lib, name)
+        fn = getattr(self.lib, name)
+
+        def call(*args):
+            status = fn(*args)
+            self._write(name, status, [_contents(a) for a in args])
+            if name == 'ni845xClose':
+                self.flush()
+            return status
+
+        call.__name__ = name
+        setattr(self, name, call)   # next time skip __getattr__
+        return call
+
+    def _write(self, name, status, values):
+        t = time.perf_counter() - self._t0
+        out = []
+        with self._lock:
+            if self._stream is None:
+                return
+            fid = self._ids.get(name)
+            if fid is None:
+                fid = self._ids[name] = len(self._ids)
+                raw = name.encode()
+                out.append(bytes([_TAG_NAME]) + _NAME.pack(fid, len(raw)) + raw)
+            out.append(bytes([_TAG_CALL]) + _CALL.pack(t, fid, status or 0, len(values)))
+            for v in values:
+                _encode(out, v)
+            self._stream.write(b''.join(out))
+            self.count += 1
+
+    def flush(self):
+        with self._lock:
+            if self._stream is not None:
+                self._stream.flush()
+
+    def close(self):
+        with self._lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+
+
+# ------------------------------------------------------------------------------
+# replay
+# ------------------------------------------------------------------------------
+class ReplayLib(object):
+    '''Serves the calls of a capture file back, in order
+
+    path        capture written by CaptureLib
+    strict      raise ReplayMismatch when the in parameters differ
+    realTime    wait so calls are no closer together than when recorded
+    '''
+    def __init__(self, path, strict=True, realTime=False):
+        self.calls = readCapture(path)
+        self.strict = strict
+        self.realTime = realTime
+        self.position = 0
+        self._lock = threading.Lock()
+        self._t0 = None
+
+    def remaining(self):
+        return len(self.calls) - self.position
+
+    def rewind(self):
+        self.position = 0
+        self._t0 = None
+
+    def __getattr__(self, name):
+        if not name.startswith('ni845x'):
+            raise AttributeError(name)
+        outputs = OUTPUTS.get(name, ())
+
+        def call(*args):
+            with self._lock:
+                i = self.position
+                if i >= len(self.calls):
+                    return kReplayEnd
+                rec = self.calls[i]
+                if rec.name != name:
+                    raise ReplayMismatch(i, rec.name, name)
+                if self.strict:
+                    for k, a in enumerate(args):
+                        if k not in outputs and _contents(a) != rec.args[k]:
+                            raise ReplayMismatch(i, (rec.name, k, rec.args[k]), (name, k, _contents(a)))
+                self.position += 1
+
+            if self.realTime:
+                now = time.perf_counter()
+                if self._t0 is None:
+                    self._t0 = now - rec.t
+                wait = self._t0 + rec.t - now
+                if wait > 0:
+                    time.sleep(wait)
+
+            for k in outputs:
+                if k < len(args):
+                    _store(args[k], rec.args[k])
+            return rec.status
+
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+
+
+# ------------------------------------------------------------------------------
+# MAIN PROGRAM - TEST HARNESS
+# ------------------------------------------------------------------------------
+def main():
+    import os
+    import sys
+    import tempfile
+    from awmfemu import emulatedLib
+    from fake_spiwrite import AwmfCommander, RX_MODE, TX_MODE
+
+    if len(sys.argv) > 1:       # list a capture
+        for rec in readCapture(sys.argv[1]):
+            print('{0:10.6f} {1:<36} {2:>8} {3}'.format(rec.t, rec.name, rec.status, rec.args))
+        return
+
+    path = os.path.join(tempfile.gettempdir(), 'awmf_capture_test.ni8c')
+
+    def session(lib):
+        awmf = AwmfCommander(lib=lib)
+        awmf.initSpi()
+        for n in range(50):
+            awmf.setBeam(RX_MODE if n % 2 else TX_MODE, n % 32, 3, 5, 7, 8, 8, 8, 8)
+        regs = awmf.readRegisters()
+        awmf.closeSPI()
+        return regs
+
+    lib, chip = emulatedLib(realTime=True)
+    cap = CaptureLib(lib, path)
+    t0 = time.perf_counter()
+    recorded = session(cap)
+    tRec = time.perf_counter() - t0
+    cap.close()
+    print('recorded {0} calls, {1} bytes'.format(cap.count, os.path.getsize(path)))
+
+    for realTime in (False, True):
+        replay = ReplayLib(path, realTime=realTime)
+        t0 = time.perf_counter()
+        replayed = session(replay)
+        print('replay realTime={0}: {1:.1f} ms (recorded {2:.1f} ms), same read back: {3}, left over: {4}'
+              .format(realTime, 1e3 * (time.perf_counter() - t0), 1e3 * tRec,
+                      replayed == recorded, replay.remaining()))
+
+    # a sequence that differs from the recording is caught where it diverges
+    replay = ReplayLib(path)
+    awmf = AwmfCommander(lib=replay)
+    awmf.initSpi()
+    awmf.setBeam(TX_MODE, 0, 3, 5, 7, 8, 8, 8, 8)
+    try:
+        awmf.setBeam(RX_MODE, 9, 9, 9, 9, 8, 8, 8, 8)
+    except ReplayMismatch as e:
+        print('diverged: {0}'.format(str(e)[:80]))
+    os.remove(path)
+
+if __name__ == '__main__':
+    main()
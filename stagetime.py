@@ -0,0 +1,195 @@
+#-------------------------------------------------------------------------------
+# Name:        stagetime
+# Purpose:     Opt-in timing of each stage of a beam update (compute, pack,
+#              script build, USB run, read back, drawing)
+#
+# Licence:     <tbd Anokiwave>
+#-------------------------------------------------------------------------------
+
+#-------------------------------------------------------------------------------
+# Off by default. Turn it on with enable() or by setting AWMF_STAGE_TIMING=1
+# before starting. While off, stage() hands back a shared do-nothing context
+# manager and @timed functions cost one flag test.
+#
+#   with stage("spi.scriptRun"):
+#     ...
+#
+#   @timed("beamdef.getPhaseSettings")
+#   def getPhaseSettings(self): ...
+#
+#   dumpJSON("stages.json")
+#
+# Each stage keeps count/total/min/max and a histogram with power of two
+# microsecond buckets: bucket b holds durations in [2^(b-1), 2^b) us.
+#-------------------------------------------------------------------------------
+
+import functools
+import os
+import threading
+from time import perf_counter
+
+N_BUCKETS = 24 #up to ~8 s
+
+_enabled = os.environ.get("AWMF_STAGE_TIMING", "") not in ("", "0")
+_lock = threading.Lock()
+_stages = {}
+
+class StageHistogram:
+  """timings of one stage"""
+  __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+  def __init__(self):
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = 0.0
+    self.buckets = [0] * N_BUCKETS
+
+  def add(self, seconds):
+    self.count += 1
+    self.total += seconds
+    if self.min is None or seconds < self.min:
+      self.min = seconds
+    if seconds > self.max:
+      self.max = seconds
+    self.buckets[min(int(seconds * 1e6).bit_length(), N_BUCKETS - 1)] += 1
+
+  def percentile(self, p):
+    """upper edge (us) of the bucket holding the p-th percentile"""
+    target = self.count * p / 100.0
+    seen = 0
+    for b, n in enumerate(self.buckets):
+      seen += n
+      if n and seen >= target:
+        return float(1 << b)
+    return 0.0
+
+  def asDict(self):
+    return {"count": self.count,
+            "meanUs": 1e6 * self.total / self.count if self.count else 0.0,
+            "minUs": 1e6 * (self.min or 0.0),
+            "maxUs": 1e6 * self.max,
+            "p50Us": self.percentile(50),
+            "p99Us": self.percentile(99),
+            "buckets": self.buckets}
+
+
+def enable(on=True):
+  global _enabled
+  _enabled = on
+
+def isEnabled():
+  return _enabled
+
+def reset():
+  with _lock:
+    _stages.clear()
+
+def record(name, seconds):
+  """adds one duration to stage name"""
+  with _lock:
+    h = _stages.get(name)
+    if h is None:
+      h = _stages[name] = StageHistogram()
+    h.add(seconds)
+
+class _Stage:
+  __slots__ = ('name', 't0')
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.t0 = perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    record(self.name, perf_counter() - self.t0)
+    return False
+
+class _NoStage:
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+_NO_STAGE = _NoStage()
+
+def stage(name):
+  """context manager timing its body as stage name (does nothing when disabled)"""
+  if not _enabled:
+    return _NO_STAGE
+  return _Stage(name)
+
+def timed(name):
+  """decorator: times every call of the function as stage name"""
+  def decorate(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not _enabled:
+        return fn(*args, **kwargs)
+      t0 = perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        record(name, perf_counter() - t0)
+    return wrapper
+  return decorate
+
+def snapshot():
+  """{stage name: histogram dict}"""
+  with _lock:
+    return dict((name, h.asDict()) for name, h in _stages.items())
+
+def dumpJSON(target=None):
+  """writes the snapshot to a path or open file, or returns it as a string"""
+  import json
+  text = json.dumps(snapshot(), indent=2, sort_keys=True)
+  if target is None:
+    return text
+  if hasattr(target, "write"):
+    target.write(text)
+  else:
+    with open(target, "w") as stream:
+      stream.write(text)
+  return text
+
+def summaryLines(prefixes=None):
+  """one short line per stage, for on-screen display"""
+  lines = []
+  for name, d in sorted(snapshot().items()):
+    if prefixes and not name.startswith(tuple(prefixes)):
+      continue
+    lines.append("{0:<26} n={1:<6} mean {2:8.1f} us  max {3:8.1f} us"
+                 .format(name, d["count"], d["meanUs"], d["maxUs"]))
+  return lines
+
+
+# ------------------------------------------------------------------------------
+# Tests
+# ------------------------------------------------------------------------------
+def main():
+  #run as a script this file is __main__: use the module the others import
+  import stagetime
+  from awmfemu import beamSwitchHarness
+  from beamdef import BeamDefinition
+
+  stagetime.enable()
+  for theta in range(0, 60, 2):
+    BeamDefinition(theta, 90, 0.0107).getPhaseSettings()
+  beamSwitchHarness(nBeams=100)
+  print("\n".join(stagetime.summaryLines()))
+
+  #cost of a disabled stage
+  stagetime.enable(False)
+  t0 = perf_counter()
+  for _ in range(100000):
+    with stagetime.stage("off"):
+      pass
+  print("disabled stage: {0:.3f} us".format(10 * (perf_counter() - t0)))
+
+if __name__ == '__main__':
+  main()